@@ -1,14 +1,48 @@
 #!/usr/bin/env python3
 import os
+import select
+import socket
 import struct
 import time
 
 from elan import session, neuron, rdns
-from elan.capture import Capture
 from elan.event import ExceptionEvent
+from elan.libnflog_cffi import NFLOG, NFWouldBlock
 from elan.utils  import if_indextoname
 
 CONNECTION_NFLOG_QUEUE = int(os.environ.get('CONNECTION_NFLOG_QUEUE', 5))
+# Packets are processed by batches: Redis lookups of a batch are done together.
+CONNECTION_BATCH_SIZE = int(os.environ.get('CONNECTION_BATCH_SIZE', 100))  # packets
+CONNECTION_BATCH_DELAY = float(os.environ.get('CONNECTION_BATCH_DELAY', 0.005))  # seconds
+# Interface indexes may be reused by other interfaces: names are only cached for a while.
+IF_INDEX_CACHE_TTL = float(os.environ.get('IF_INDEX_CACHE_TTL', 60))  # seconds
+
+IP_PROTOCOLS = {
+    1: 'icmp',
+    6: 'tcp',
+    17: 'udp',
+    58: 'icmpv6',
+    132: 'sctp',
+}
+# Transports that carry ports in their first 4 bytes
+PORT_TRANSPORTS = ('tcp', 'udp', 'sctp')
+# IPv6 extension headers we may have to skip to reach the transport header
+IPV6_EXTENSION_HEADERS = (0, 43, 60)  # Hop-by-Hop, Routing, Destination Options
+IPV6_FRAGMENT_HEADER = 44
+
+# Application protocols guessed from well known UDP ports, as tshark would name them.
+UDP_PROTOCOLS = {
+    53: 'dns',
+    67: 'bootp',
+    68: 'bootp',
+    123: 'ntp',
+    137: 'nbns',
+    138: 'nbdgm',
+    546: 'dhcpv6',
+    547: 'dhcpv6',
+    1900: 'ssdp',
+    5353: 'mdns',
+}
 
 
 def ignorePacket(pkt):
@@ -31,83 +65,213 @@ def ignorePacket(pkt):
     return False
 
 
+def format_mac(raw):
+    return ':'.join('{:02x}'.format(b) for b in raw)
+
+
+def decode_packet(packet, hwhdr):
+    '''
+    Decodes the L2 header `hwhdr` and L3/L4 headers of `packet` (as received from NFLOG).
+    Returns packet parameters as a dict with src and dst macs, ips and ports (if any), transport and protocol.
+    Returns None if packet is not an IP packet or if headers are truncated.
+    '''
+    if len(hwhdr) < 12:
+        return
+
+    pkt_params = {
+            'src': { 'mac': format_mac(hwhdr[6:12]) },
+            'dst': { 'mac': format_mac(hwhdr[0:6]) },
+    }
+
+    if not packet:
+        return
+
+    version = packet[0] >> 4
+    if version == 4:
+        if len(packet) < 20:
+            return
+        header_length = (packet[0] & 0x0f) * 4
+        next_header = packet[9]
+        pkt_params['src']['ip'] = socket.inet_ntop(socket.AF_INET, packet[12:16])
+        pkt_params['dst']['ip'] = socket.inet_ntop(socket.AF_INET, packet[16:20])
+        protocol = 'ip'
+        # Only first fragment holds the transport header
+        if struct.unpack_from('!H', packet, 6)[0] & 0x1fff:
+            next_header = None
+    elif version == 6:
+        if len(packet) < 40:
+            return
+        next_header = packet[6]
+        header_length = 40
+        pkt_params['src']['ip'] = socket.inet_ntop(socket.AF_INET6, packet[8:24])
+        pkt_params['dst']['ip'] = socket.inet_ntop(socket.AF_INET6, packet[24:40])
+        protocol = 'ipv6'
+        while next_header in IPV6_EXTENSION_HEADERS and len(packet) >= header_length + 2:
+            next_header, length = packet[header_length], packet[header_length + 1]
+            header_length += (length + 1) * 8
+        if next_header == IPV6_FRAGMENT_HEADER and len(packet) >= header_length + 8:
+            if struct.unpack_from('!H', packet, header_length + 2)[0] & 0xfff8:
+                next_header = None  # Not first fragment
+            else:
+                next_header = packet[header_length]
+                header_length += 8
+    else:
+        return
+
+    transport = IP_PROTOCOLS.get(next_header, None)
+    if transport:
+        protocol = transport
+
+        if transport in PORT_TRANSPORTS and len(packet) >= header_length + 4:
+            pkt_params['transport'] = transport
+            src_port, dst_port = struct.unpack_from('!HH', packet, header_length)
+            pkt_params['src']['port'] = str(src_port)
+            pkt_params['dst']['port'] = str(dst_port)
+
+            if transport == 'udp':
+                protocol = UDP_PROTOCOLS.get(dst_port, UDP_PROTOCOLS.get(src_port, protocol))
+
+    pkt_params['protocol'] = protocol
+
+    return pkt_params
+
+
+_if_index_vlans = {}  # if_index -> (vlan, expiry)
+
+
+def if_index_to_vlan(if_index):
+    ''' returns VLAN name (<nic>.<vlan_id>) of interface index, cached for IF_INDEX_CACHE_TTL if found '''
+    now = time.monotonic()
+    cached = _if_index_vlans.get(if_index, None)
+    if cached is not None and cached[1] > now:
+        return cached[0]
+
+    vlan = if_indextoname(if_index)
+    if vlan and '.' not in vlan:
+        vlan += '.0'
+    if vlan:
+        _if_index_vlans[if_index] = (vlan, now + IF_INDEX_CACHE_TTL)
+    else:
+        _if_index_vlans.pop(if_index, None)
+    return vlan
+
+
 class ConnectionTracker():
 
-    def __init__(self, dendrite=None):
+    def __init__(self, dendrite=None, batch_size=CONNECTION_BATCH_SIZE, batch_delay=CONNECTION_BATCH_DELAY):
         if dendrite is None:
             dendrite = neuron.Dendrite()
         self.dendrite = dendrite
 
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.batch = []
+        self.batch_deadline = None
+
     def capture(self):
-        capture = Capture(name='connection-tracker', interface=['nflog:{id}'.format(id=CONNECTION_NFLOG_QUEUE)])
-        capture.remove_files()
-        for packet in capture:
-            self.process_packet(packet)
+        nflog = NFLOG().generator(
+                CONNECTION_NFLOG_QUEUE,
+                extra_attrs=['msg_packet_hwhdr', 'physindev', 'physoutdev', 'ts'],
+                nlbufsiz=2 ** 24
+        )
+        fd = next(nflog)
+
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+
+        result = NFWouldBlock
+        while True:
+            if result is NFWouldBlock:
+                # wait for packets, but not longer than current batch is allowed to wait
+                if self.batch_deadline is None:
+                    timeout = None
+                else:
+                    timeout = max(0, (self.batch_deadline - time.monotonic()) * 1000)
+                if not poller.poll(timeout):
+                    self.flush()
+                    continue
+                result = next(nflog)  # recv and yield first packet
+            else:
+                self.process_packet(*result)
+                result = nflog.send(True)  # next already received packet or NFWouldBlock
 
-        raise RuntimeError('Capture Stopped ! if it ever started...')
+            if self.batch_deadline is not None and time.monotonic() >= self.batch_deadline:
+                self.flush()
 
-    def process_packet(self, packet):
+    def process_packet(self, packet, hwhdr, physindev=0, physoutdev=0, ts=None):
+        '''
+        Decodes packet and adds it to current batch. Batch is processed when full.
+        '''
         try:
-            ip = packet.layers[1]
-            pkt_params = {
-                    'src': { 'ip': ip.src },
-                    'dst': { 'ip': ip.dst },
-            }
-            # TODO: Better way to find macs from nflog layer...
-            for tlv in packet.nflog.tlv.alternate_fields:
-                if tlv.showname_value.startswith('NFULA_HWHEADER'):
-                    pkt_params['src']['mac'] = tlv.show[30:47]
-                    pkt_params['dst']['mac'] = tlv.show[12:29]
-                    break
-
-            if not ignorePacket(pkt_params):
-                pkt_params['start'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(float(packet.frame_info.time_epoch)))
-
-                if packet.transport_layer:
-                    pkt_params['transport'] = packet.transport_layer.lower()
-
-                for layer in reversed(packet.layers):
-                    if layer.layer_name != 'data':
-                        pkt_params['protocol'] = layer.layer_name
-                        break
-
-                if len(packet.layers) > 2 and getattr(packet.layers[2], 'srcport', None) is not None:
-                    pkt_params['src']['port'] = packet.layers[2].srcport
-                    pkt_params['dst']['port'] = packet.layers[2].dstport
-
-                for tlv in packet.nflog.tlv.alternate_fields:
-                    if tlv.showname_value.startswith('NFULA_IFINDEX_PHYSINDEV'):
-                        physindev = struct.unpack(">L", tlv.binary_value[-4:])[0]
-                        pkt_params['src']['vlan'] = if_indextoname(physindev)
-                        if pkt_params['src']['vlan'] and '.' not in pkt_params['src']['vlan']:
-                            pkt_params['src']['vlan'] += '.0'
-
-                    if tlv.showname_value.startswith('NFULA_IFINDEX_PHYSOUTDEV'):
-                        physoutdev = struct.unpack(">L", tlv.binary_value[-4:])[0]
-                        pkt_params['dst']['vlan'] = if_indextoname(physoutdev)
-                        if pkt_params['dst']['vlan'] and '.' not in pkt_params['dst']['vlan']:
-                            pkt_params['dst']['vlan'] += '.0'
-
-                for t in ('src', 'dst'):
-                    tip = pkt_params[t]
-                    if 'ip' in tip:
-                        tip['is_mac_ip'] = session.mac_has_ip_on_vlan(tip['mac'], tip['ip'], tip['vlan'])
-                    else:
-                        tip['is_mac_ip'] = False
-
-                probable_dns = rdns.get_cached_rdns(source=pkt_params['dst']['ip'], mac=pkt_params['src']['mac'])
-                if probable_dns:
-                    pkt_params['dst']['probable_dns'] = probable_dns
-
-                self.dendrite.publish('connection', pkt_params)
+            pkt_params = decode_packet(packet, hwhdr)
+
+            if pkt_params is not None and not ignorePacket(pkt_params):
+                if ts is None:
+                    ts = time.time()
+                pkt_params['start'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(ts))
+
+                if physindev:
+                    pkt_params['src']['vlan'] = if_index_to_vlan(physindev)
+                if physoutdev:
+                    pkt_params['dst']['vlan'] = if_index_to_vlan(physoutdev)
+
+                if not self.batch:
+                    self.batch_deadline = time.monotonic() + self.batch_delay
+                self.batch.append(pkt_params)
 
         except Exception as e:
             ExceptionEvent(source='connection-tracker')\
-                 .add_data('packet', str(packet))\
+                 .add_data('packet', (hwhdr + packet).hex())\
                  .notify()
 
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Processes current batch of packets.
+        '''
+        batch = self.batch
+        self.batch = []
+        self.batch_deadline = None
+
+        if batch:
+            try:
+                self.process_batch(batch)
+            except Exception:
+                ExceptionEvent(source='connection-tracker')\
+                     .add_data('batch size', len(batch))\
+                     .notify()
+
+    def process_batch(self, batch):
+        '''
+        Adds is_mac_ip and probable_dns to packets parameters of the batch, with lookups done together, and publishes them.
+        '''
+        mac_ip_lookups = []
+        for pkt_params in batch:
+            for t in ('src', 'dst'):
+                tip = pkt_params[t]
+                if 'ip' in tip and 'vlan' in tip:
+                    mac_ip_lookups.append((tip['mac'], tip['ip'], tip['vlan']))
+        is_mac_ips = iter(session.macs_have_ips_on_vlans(mac_ip_lookups))
+
+        probable_dnss = rdns.get_cached_rdns_many([(pkt_params['dst']['ip'], pkt_params['src']['mac']) for pkt_params in batch])
+
+        for pkt_params, probable_dns in zip(batch, probable_dnss):
+            for t in ('src', 'dst'):
+                tip = pkt_params[t]
+                if 'ip' in tip and 'vlan' in tip:
+                    tip['is_mac_ip'] = next(is_mac_ips)
+                else:
+                    tip['is_mac_ip'] = False
+
+            if probable_dns:
+                pkt_params['dst']['probable_dns'] = probable_dns
+
+            self.dendrite.publish('connection', pkt_params)
+
 
 if __name__ == '__main__':
+    rdns.enable_cache()
     ct = ConnectionTracker()
     ct.capture()
-
@@ -1,14 +1,115 @@
 #!/usr/bin/env python3
 
 import functools
+import os
 import re
 import threading
 
 from elan import session, nac, neuron, utils, device
+from elan.afpacket import RingCapture
 from elan.capture import Capture
+from elan.dissect import Record, dissect_frame
 from elan.event import Event, ExceptionEvent
 from elan.snmp import DeviceSnmpManager
 
+# Capture engine: 'afpacket' (kernel ring, frames dissected here) or 'tshark'
+DEVICE_TRACKER_CAPTURE = os.environ.get('DEVICE_TRACKER_CAPTURE', 'afpacket')
+
+CAPTURE_FILTER = 'udp port 67 or arp or udp port 138 or udp port 547 or (icmp6 and ip6[40] == 0x88) or (udp src port 5353 and udp dst port 5353) or ( !ip and !ip6)'
+
+
+def decode_pyshark_packet(packet):
+    '''
+    Same as `elan.dissect.dissect_frame` for a pyshark packet.
+    '''
+    ip = None
+    hostname = None
+    mdns_answers = ()
+    fingerprint = None
+
+    source = packet.highest_layer
+    # more meaningful name
+    if source == 'BROWSER':
+        source = 'NetBIOS'
+    elif source == 'BOOTP':
+        source = 'DHCPV4'
+
+    if packet.highest_layer == 'ARP':
+        ip = packet.arp.src_proto_ipv4
+    elif packet.highest_layer == 'ICMPV6' and str(packet.icmpv6.type) in ('136', '135'):  # ('Neighbor Advertisement', 'Neighbor Solicitation')
+        ip = packet.ipv6.src
+
+    # Hostname: grab it from netbios or dhcpv4 or dhcpv6
+    try:
+        hostname = str(packet.nbdgm.source_name)  # ends with <??>
+        p = re.compile('<..>$')
+        hostname = p.sub('', hostname)
+    except AttributeError:
+        pass
+
+    try:
+        hostname = str(packet.bootp.option_hostname)
+    except AttributeError:
+        pass
+
+    try:
+        hostname = str(packet.dhcpv6.client_fqdn)
+    except AttributeError:
+        pass
+
+    try:
+        if int(packet.mdns.dns_flags_response) and int(packet.mdns.dns_flags_authoritative):
+            mdns = packet.mdns
+            try:
+                a_list = mdns.dns_a.fields.copy()
+                a_list.reverse()
+            except AttributeError:
+                a_list = []
+            try:
+                aaaa_list = mdns.dns_aaaa.fields.copy()
+                aaaa_list.reverse()
+            except AttributeError:
+                aaaa_list = []
+            resp_types = mdns.dns_resp_type.fields.copy()
+            resp_types.reverse()
+            answers = []
+            for field in mdns.dns_resp_name.fields:
+                name, *domain = field.showname_value.split('.')
+                if domain == ['local']:
+                    resp_type = resp_types.pop().showname_value.split(' ')[0]
+                    target = None
+                    if resp_type == 'A':
+                        target = a_list.pop().showname_value
+                    elif resp_type == 'AAAA':
+                        target = aaaa_list.pop().showname_value
+                    if target:
+                        answers.append((name, target))
+            mdns_answers = tuple(answers)
+    except AttributeError:
+        pass
+
+    # DHCP fingerprint
+    if source == 'DHCPV4':
+        try:
+            fingerprint = {
+                        'request_list': ','.join(str(option.hex_value) for option in packet.bootp.option_request_list_item.fields),
+                        'vendor': str(getattr(packet.bootp, 'option_vendor_class_id', ''))
+            }
+        except AttributeError:
+            pass
+
+    elif source == 'DHCPV6':
+        try:
+            fingerprint = {
+                        'request_list': ','.join(str(option.hex_value) for option in packet.dhcpv6.requested_option_code.fields),
+                        'vendor': str(getattr(packet.dhcpv6, 'vendorclass_data', '')),
+                        'enterprise': str(getattr(packet.dhcpv6, 'vendorclass_enterprise', ''))
+            }
+        except AttributeError:
+            pass
+
+    return Record(packet.eth.src, source, ip, hostname, fingerprint, mdns_answers)
+
 
 class DeviceTracker():
 
@@ -20,11 +121,30 @@ class DeviceTracker():
 
         self.interfaces = list(utils.physical_ifaces())
 
-    def capture(self):
+        # ARP/NDP sightings of known sessions are written to Redis by batches
+        self.last_seen = session.LastSeenAggregator(on_added=self.on_session_added)
+
+    def capture(self, engine=DEVICE_TRACKER_CAPTURE):
+        self.last_seen.start()
+
+        if engine == 'tshark':
+            self.capture_tshark()
+        else:
+            self.capture_afpacket()
+
+        raise RuntimeError('Capture Stopped ! if it ever started...')
+
+    def capture_afpacket(self):
+        capture = RingCapture(self.interfaces, capture_filter=CAPTURE_FILTER, inbound=True)
+
+        for interface_index, frame, vlan_id, timestamp in capture:
+            self.process_frame(frame, self.interfaces[interface_index], vlan_id, timestamp)
+
+    def capture_tshark(self):
         capture = Capture(
                 name='device-tracker',
                 interface=self.interfaces,
-                capture_filter='inbound and ( udp port 67 or arp or udp port 138 or udp port 547 or (icmp6 and ip6[40] == 0x88) or (udp src port 5353 and udp dst port 5353) or ( !ip and !ip6) )'
+                capture_filter='inbound and ( {filter} )'.format(filter=CAPTURE_FILTER)
         )
 
         capture.remove_files()
@@ -32,15 +152,19 @@ class DeviceTracker():
         for packet in capture:
             self.process_packet(packet)
 
-        raise RuntimeError('Capture Stopped ! if it ever started...')
+    def process_frame(self, frame, nic, vlan_id, timestamp):
+        try:
+            record = dissect_frame(frame)
+            if record is not None:
+                vlan = '{nic}.{vlan_id}'.format(nic=nic, vlan_id=vlan_id)
+                self.process_record(record, vlan, int(timestamp))
+        except Exception:
+            ExceptionEvent(source='device-tracker')\
+                 .add_data('packet', frame.hex())\
+                 .notify()
 
     def process_packet(self, packet):
         try:
-            # device sessions
-            mac = packet.eth.src
-            if session.ignore_MAC(mac):
-                return
-
             nic = self.interfaces[int(packet.frame_info.interface_id)]
             vlan_id = 0
             packet_vlan = getattr(packet, 'vlan', None)
@@ -49,122 +173,53 @@ class DeviceTracker():
             vlan = '{nic}.{vlan_id}'.format(nic=nic, vlan_id=vlan_id)
             epoch = int(float(packet.frame_info.time_epoch))
 
-            if packet.highest_layer == 'ARP' \
-                or \
-               packet.highest_layer == 'ICMPV6' and str(packet.icmpv6.type) in ('136', '135'):  # ('Neighbor Advertisement', 'Neighbor Solicitation')
+            self.process_record(decode_pyshark_packet(packet), vlan, epoch)
 
-                if packet.highest_layer == 'ARP':
-                    ip = packet.arp.src_proto_ipv4
-                else:
-                    ip = packet.ipv6.src
+        except Exception:
+            ExceptionEvent(source='device-tracker')\
+                 .add_data('packet', str(packet))\
+                 .notify()
 
-                if session.ignore_IP(ip):
-                    mac_added, vlan_added, _ip_added = session.seen(mac, vlan=vlan, time=epoch)
-                else:
-                    mac_added, vlan_added, _ip_added = session.seen(mac, vlan=vlan, ip=ip, time=epoch)
-            else:
-                mac_added, vlan_added, _ip_added = session.seen(mac, vlan=vlan, time=epoch)
+    def process_record(self, record, vlan, epoch):
+        # device sessions
+        mac = record.mac
+        if session.ignore_MAC(mac):
+            return
 
-            tasks = []  # tasks to be launched in thread
+        ip = record.ip
+        if ip is not None and session.ignore_IP(ip):
+            ip = None
+        mac_added, vlan_added, ip_added = self.last_seen.seen(mac, vlan=vlan, ip=ip, time=epoch)
+        self.on_session_added(mac, vlan, ip, mac_added, vlan_added, ip_added)
 
-            if mac_added:
-                tasks.append(functools.partial(DeviceSnmpManager().set_port_of_mac, mac))
+        source = record.source
 
-            if vlan_added and nac.vlan_has_access_control(vlan):
-                tasks.append(functools.partial(self.checkAuthzOnVlan, mac, vlan))
+        # Hostname: grab it from netbios or dhcpv4 or dhcpv6 or mdns
+        hostname = record.hostname
+        for name, target in record.mdns_answers:
+            if session.mac_has_ip_on_vlan(mac, target, vlan):
+                hostname = name
+                break  # Only first one found...
 
-            if tasks:
-                task = threading.Thread(target=lambda: [task() for task in tasks])
-                task.start()
+        if hostname:
+            device.seen_hostname(mac, hostname, source)
 
-            source = packet.highest_layer
-            # more meaningful name
-            if source == 'BROWSER':
-                source = 'NetBIOS'
-            elif source == 'BOOTP':
-                source = 'DHCPV4'
+        # DHCP fingerprint
+        if record.fingerprint is not None:
+            device.seen_fingerprint(mac, record.fingerprint, source, hostname)
 
-            # Hostname: grab it from netbios or dhcpv4 or dhcpv6 or mdns
-            hostname = None
-            try:
-                hostname = str(packet.nbdgm.source_name)  # ends with <??>
-                p = re.compile('<..>$')
-                hostname = p.sub('', hostname)
-            except AttributeError:
-                pass
+    def on_session_added(self, mac, vlan, ip, mac_added, vlan_added, ip_added):
+        tasks = []  # tasks to be launched in thread
 
-            try:
-                hostname = str(packet.bootp.option_hostname)
-            except AttributeError:
-                pass
+        if mac_added:
+            tasks.append(functools.partial(DeviceSnmpManager().set_port_of_mac, mac))
 
-            try:
-                hostname = str(packet.dhcpv6.client_fqdn)
-            except AttributeError:
-                pass
-
-            try:
-                if int(packet.mdns.dns_flags_response) and int(packet.mdns.dns_flags_authoritative):
-                    mdns = packet.mdns
-                    try:
-                        a_list = mdns.dns_a.fields.copy()
-                        a_list.reverse()
-                    except AttributeError:
-                        a_list = []
-                    try:
-                        aaaa_list = mdns.dns_aaaa.fields.copy()
-                        aaaa_list.reverse()
-                    except AttributeError:
-                        aaaa_list = []
-                    resp_types = mdns.dns_resp_type.fields.copy()
-                    resp_types.reverse()
-                    for field in mdns.dns_resp_name.fields:
-                        name, *domain = field.showname_value.split('.')
-                        if domain == ['local']:
-                            resp_type = resp_types.pop().showname_value.split(' ')[0]
-                            target = None
-                            if resp_type == 'A':
-                                target = a_list.pop().showname_value
-                            elif resp_type == 'AAAA':
-                                target = aaaa_list.pop().showname_value
-                            if target:
-                                if session.mac_has_ip_on_vlan(mac, target, vlan):
-                                    hostname = name
-                                    break  # Only first one found...
-            except AttributeError:
-                pass
-
-            if hostname:
-                device.seen_hostname(mac, hostname, source)
-
-            # DHCP fingerprint
-            if source == 'DHCPV4':
-                try:
-                    fingerprint = {
-                                'request_list': ','.join(str(option.hex_value) for option in packet.bootp.option_request_list_item.fields),
-                                'vendor': str(getattr(packet.bootp, 'option_vendor_class_id', ''))
-                    }
-                except AttributeError:
-                    pass
-                else:
-                    device.seen_fingerprint(mac, fingerprint, source, hostname)
-
-            elif source == 'DHCPV6':
-                try:
-                    fingerprint = {
-                                'request_list': ','.join(str(option.hex_value) for option in packet.dhcpv6.requested_option_code.fields),
-                                'vendor': str(getattr(packet.dhcpv6, 'vendorclass_data', '')),
-                                'enterprise': str(getattr(packet.dhcpv6, 'vendorclass_enterprise', ''))
-                    }
-                except AttributeError:
-                    pass
-                else:
-                    device.seen_fingerprint(mac, fingerprint, source, hostname)
+        if vlan_added and nac.vlan_has_access_control(vlan):
+            tasks.append(functools.partial(self.checkAuthzOnVlan, mac, vlan))
 
-        except Exception:
-            ExceptionEvent(source='device-tracker')\
-                 .add_data('packet', str(packet))\
-                 .notify()
+        if tasks:
+            task = threading.Thread(target=lambda: [task() for task in tasks])
+            task.start()
 
     def checkAuthzOnVlan(self, mac, vlan):
         authz = nac.checkAuthz(mac)
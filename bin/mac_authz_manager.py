@@ -1,12 +1,13 @@
 #!/usr/bin/env python3
 
 from elan.nac.manager import MacAuthorizationManager
-from elan.nac import AUTHORIZATION_CHANGE_TOPIC, CHECK_AUTHZ_PATH
+from elan.nac import AUTHORIZATION_CHANGE_TOPIC, CHECK_AUTHZ_PATH, enable_decision_cache
 from elan.session import MAC_SESSION_TOPIC
 from elan.neuron import Dendrite
 
 if __name__ == "__main__":
     dendrite = Dendrite()
+    enable_decision_cache()
     manager = MacAuthorizationManager(dendrite=dendrite)
     
     def handle_disconnection(data):
@@ -15,7 +16,8 @@ if __name__ == "__main__":
             manager.handle_disconnection(data['mac'])
     
     dendrite.subscribe(AUTHORIZATION_CHANGE_TOPIC, manager.handle_authz_changed)
-    dendrite.subscribe(MAC_SESSION_TOPIC, handle_disconnection)
+    # keep session events of a MAC in order
+    dendrite.subscribe(MAC_SESSION_TOPIC, handle_disconnection, key=lambda data: data['mac'])
     dendrite.subscribe(CHECK_AUTHZ_PATH, manager.check_authz)
 
     dendrite.wait_complete()
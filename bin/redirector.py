@@ -1,104 +1,150 @@
 #!/usr/bin/env python3
-import datetime
+import collections
 import os
-import subprocess
+import select
+import time
 
 from scapy.all import Ether, sendp
 
 from elan.event import ExceptionEvent
-import elan.libnflog_cffi
+from elan.libnflog_cffi import NFLOG, NFWouldBlock
+from elan.nft import element_commands, get_nft, NftError
 
 REDIRECTOR_NFLOG_QUEUE = int(os.environ.get('REDIRECTOR_NFLOG_QUEUE', 20))
+# nft element changes are applied by batches, at most REDIRECTOR_FLUSH_DELAY after the packet
+REDIRECTOR_FLUSH_DELAY = float(os.environ.get('REDIRECTOR_FLUSH_DELAY', 0.005))  # seconds
 
 
 class Redirector():
     REDIRECTION_EXPIRY = 60  # seconds
 
-    def __init__(self):
-        self.nft_process = self.start_nft_process()
-        self.cmd_count = 0
+    def __init__(self, nft=None, flush_delay=REDIRECTOR_FLUSH_DELAY):
+        if nft is None:
+            nft = get_nft()
+        self.nft = nft
+        self.flush_delay = flush_delay
 
-        self.live_redirections = {}
+        self.live_redirections = {}  # (src_ip, src_port, dst_ip, dst_port) -> expiry (monotonic)
+        self.expiries = collections.deque()  # (expiry, redirection) in expiry order, obsolete if expiry changed since
 
-    def start_nft_process(self):
-        return subprocess.Popen(['nft', '-i'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True)
+        self.pending = {}  # redirection -> 'add' or 'delete', waiting to be flushed
+        self.flush_deadline = None
 
-    def do_redirect(self, src_ip, src_port, dst_ip, dst_port, action, is_retry=False):
-        if ':' in src_ip:
-            family = 'ip6'
-        else:
-            family = 'ip'
+    def do_redirect(self, src_ip, src_port, dst_ip, dst_port, action):
+        redirection = (src_ip, src_port, dst_ip, dst_port)
 
         if action == 'add':
-            cmd = 'add'
-            self.live_redirections[(src_ip, src_port, dst_ip, dst_port)] = datetime.datetime.now()
+            expiry = time.monotonic() + self.REDIRECTION_EXPIRY
+            if redirection not in self.live_redirections:
+                self.queue_command(redirection, 'add')
+            self.live_redirections[redirection] = expiry
+            self.expiries.append((expiry, redirection))
         else:
-            if self.live_redirections.pop((src_ip, src_port, dst_ip, dst_port), None):
-                cmd = 'delete'
-            else:
-                cmd = None
-
-        if cmd is not None:
-            try:
-                print('{cmd} element bridge elan {family}_conn2mark {{ {src_ip} . {src_port} . {dst_ip} . {dst_port} }}'.format(
-                                            cmd=cmd,
-                                            family=family,
-                                            src_ip=src_ip,
-                                            src_port=src_port,
-                                            dst_ip=dst_ip,
-                                            dst_port=dst_port
-                        ),
-                        file=self.nft_process.stdin,
-                        flush=True
-                )
-            except IOError:
-                if is_retry:
-                    self.nft_process.terminate(timeout=0)
-                    raise
-                # try launching again the nft process
-                self.restart_nft_process()
-                self.do_redirect(src_ip, src_port, dst_ip, dst_port, action, is_retry=True)
-
-            self.cmd_count += 1
-            if self.cmd_count > 100:
-                self.restart_nft_process()
-
-    def restart_nft_process(self, timeout=3):
+            if self.live_redirections.pop(redirection, None):
+                self.queue_command(redirection, 'delete')
+
+    def queue_command(self, redirection, cmd):
+        if cmd == 'delete' and self.pending.get(redirection) == 'add':
+            # not even added yet
+            del self.pending[redirection]
+        else:
+            self.pending[redirection] = cmd
+
+        if self.flush_deadline is None:
+            self.flush_deadline = time.monotonic() + self.flush_delay
+
+    def flush(self):
         '''
-        Soft restart (send quit) of nft process unless timeout=0, then terminate immediately
-        After timeout (seconds), terminate process.
-        if timeout is None, soft restart with no timeout
+        Applies pending element changes in one nft batch.
         '''
-        if timeout == 0:
-            self.nft_process.terminate()
-        else:
-            print('quit', file=self.nft_process.stdin, flush=True)
-            try:
-                self.nft_process.wait(timeout)
-            except subprocess.TimeoutExpired:
-                self.nft_process.terminate()
-        self.cmd_count = 0
-        self.nft_process = self.start_nft_process()
+        pending = self.pending
+        self.pending = {}
+        self.flush_deadline = None
 
-    def do_cleanup(self):
-        to_remove = []
-        now = datetime.datetime.now()
-        for args, setup_time in self.live_redirections.items():
-            if setup_time + datetime.timedelta(seconds=self.REDIRECTION_EXPIRY) < now:
-                to_remove.append(args)
+        commands = self.commands(pending)
+        try:
+            self.nft.run(commands)
+        except NftError:
+            # whole batch is rejected because of some element: apply them one by one so others are not lost
+            failed = 0
+            for redirection, cmd in pending.items():
+                try:
+                    self.nft.run(self.commands({redirection: cmd}))
+                except NftError:
+                    failed += 1
+                    if cmd == 'add':
+                        # forget it so next packet of the connection queues it again
+                        self.live_redirections.pop(redirection, None)
+            ExceptionEvent(source='network')\
+                 .add_data('commands', len(commands))\
+                 .add_data('failed', failed)\
+                 .notify()
+
+    @staticmethod
+    def commands(pending):
+        commands = []
+        for cmd in ('delete', 'add'):
+            for family in ('ip', 'ip6'):
+                elements = [
+                        redirection for redirection, redirection_cmd in pending.items()
+                        if redirection_cmd == cmd and (':' in redirection[0]) == (family == 'ip6')
+                ]
+                commands.extend(element_commands(cmd, '{family}_conn2mark'.format(family=family), elements))
+        return commands
 
-        for args in to_remove:
-            self.do_redirect(*args, action='remove')
+    def do_cleanup(self):
+        '''
+        Removes expired redirections. Only expired ones are looked at.
+        '''
+        now = time.monotonic()
+        while self.expiries and self.expiries[0][0] <= now:
+            expiry, redirection = self.expiries.popleft()
+            if self.live_redirections.get(redirection) == expiry:
+                self.do_redirect(*redirection, action='remove')
+
+    def next_deadline(self):
+        deadlines = []
+        if self.flush_deadline is not None:
+            deadlines.append(self.flush_deadline)
+        if self.expiries:
+            deadlines.append(self.expiries[0][0])
+        if deadlines:
+            return min(deadlines)
+
+    def tick(self):
+        self.do_cleanup()
+        if self.flush_deadline is not None and time.monotonic() >= self.flush_deadline:
+            self.flush()
 
     def run(self):
         self.listen_packets()
 
     def listen_packets(self):
-        nflog = elan.libnflog_cffi.NFLOG().generator(REDIRECTOR_NFLOG_QUEUE, extra_attrs=['msg_packet_hwhdr', 'prefix'], nlbufsiz=2 ** 24, handle_overflows=False)
-        next(nflog)
+        nflog = NFLOG().generator(REDIRECTOR_NFLOG_QUEUE, extra_attrs=['msg_packet_hwhdr', 'prefix'], nlbufsiz=2 ** 24, handle_overflows=False)
+        fd = next(nflog)
+
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+
+        result = NFWouldBlock
+        while True:
+            if result is NFWouldBlock:
+                # wait for packets, but not longer than next flush or expiry
+                deadline = self.next_deadline()
+                if deadline is None:
+                    timeout = None
+                else:
+                    timeout = max(0, (deadline - time.monotonic()) * 1000)
+                if not poller.poll(timeout):
+                    self.tick()
+                    continue
+                result = next(nflog)  # recv and yield first packet
+            else:
+                pkt, hwhdr, action = result
+                self.process_packet(hwhdr + pkt, action.decode())
+                result = nflog.send(True)  # next already received packet or NFWouldBlock
 
-        for pkt, hwhdr, action in nflog:
-            self.process_packet(hwhdr + pkt, action.decode())
+            self.tick()
 
     def process_packet(self, packet, action):
         try:
@@ -107,7 +153,6 @@ class Redirector():
             tcp_obj = ip_obj.payload
 
             self.do_redirect(ip_obj.src, tcp_obj.sport, ip_obj.dst, tcp_obj.dport, action)
-            self.do_cleanup()
 
             # TODO : reinject the packet instead of waiting for client retry
             # sendp(eth_obj, iface='injector') does not work: loose vlan info
@@ -4,10 +4,10 @@ from aiohttp import web
 import asyncio
 import json
 
-from elan import freeradius, neuron
+from elan import freeradius, nac, neuron
 from elan.freeradius.utils import request_as_hash_of_values
 
-dendrite = neuron.Dendrite()
+dendrite = neuron.AsyncDendrite()
 
 
 async def get_radius_request(request):
@@ -16,7 +16,7 @@ async def get_radius_request(request):
 
 
 async def call_service(service, data):
-    return await asyncio.get_event_loop().run_in_executor(None, dendrite.call, service, data)
+    return await dendrite.call(service, data)
 
 
 async def post_auth(request):
@@ -131,6 +131,9 @@ app.router.add_route('POST', '/authentication/provider/failed', provider_failed)
 app.router.add_route('POST', '/authentication/provider/failed-in-group', provider_failed_in_group)
 app.router.add_route('POST', '/authentication/group/all-failed', group_all_failed)
 
+# Repeated authentications of devices do not need to wait for control center
+nac.enable_decision_cache()
+
 loop = asyncio.get_event_loop()
 handler = app.make_handler()
 f = loop.create_server(handler, '127.0.0.1', 8080)
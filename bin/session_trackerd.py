@@ -1,149 +1,359 @@
 #!/usr/bin/env python3
-import datetime
+import heapq
+import os
+import socket
+import struct
 import time
 
-from scapy.all import sendp, Ether, ARP, Dot1Q, IPv6, ICMPv6ND_NS
-
 from elan import session, network
 from elan.neuron import Synapse
 from elan.utils import get_ether_address
 
-LAST_SEEN_PATH = 'device:macs:last_seen'
-
 PING_OBJECTS_AFTER = 240  #  4 minutes
 PING_EVERY = 10  # 10 seconds
 EXPIRY_OBJECT_AFTER = 300  #  5 minutes
+# Objects written with a last seen time already behind the cursor (late time, clock going backwards) are caught by rescans
+RESCAN_EVERY = EXPIRY_OBJECT_AFTER
 
-netconf = network.NetworkConfiguration()
-
-
-def pingIP(mac, vlan, ip):
-    if ':' in ip:
-        ndpPing(mac, vlan, ip)
-    else:
-        arpPing(mac, vlan, ip)
+# Probes are sent by bursts of PROBE_BURST frames, at most PROBE_RATE frames per second
+PROBE_BURST = int(os.environ.get('PROBE_BURST', 500))
+PROBE_RATE = int(os.environ.get('PROBE_RATE', 50000))
 
+ETH_P_IP = 0x0800
+ETH_P_ARP = 0x0806
+ETH_P_IPV6 = 0x86DD
+ETH_P_8021Q = 0x8100
 
-def ndpPing(mac, vlan, ip):
-    src_mac = get_ether_address(network.BRIDGE_NAME)
-    packet = Ether(src=src_mac, dst=mac)
+ARP_REQUEST = 1
+ICMPV6_NEIGHBOR_SOLICITATION = 135
+IPPROTO_ICMPV6 = 58
 
-    if_name = vlan
-    if '.' in vlan:
-        if_name, vlan_id = vlan.rsplit('.', 1)
-        vlan_id = int(vlan_id)
-        if vlan_id:
-            packet = packet / Dot1Q(vlan=vlan_id)
-
-    local_ip = None
-    for ip6 in netconf.get_current_ipv6(cidr=False)['ips']:
-        if ip6.startswith('fe80'):
-            local_ip = ip6
-        else:
-            src_ip = ip6
-            break
-    else:
-        if local_ip is None:
-            src_ip = 'fe80::66:66'  # we need a source IP...
-        else:
-            src_ip = local_ip
+DEFAULT_IPV4 = '169.254.66.66'  # we need a source IP...
+DEFAULT_IPV6 = 'fe80::66:66'
 
-    packet = packet / IPv6(src=src_ip, dst=ip)
-    packet = packet / ICMPv6ND_NS(tgt=ip)
+netconf = network.NetworkConfiguration()
 
-    sendp(packet, iface=if_name)
 
+def mac_to_bytes(mac):
+    return bytes.fromhex(mac.replace(':', ''))
 
-def arpPing(mac, vlan, ip):
-    src_mac = get_ether_address(network.BRIDGE_NAME)
-    packet = Ether(src=src_mac, dst=mac)
 
-    if_name = vlan
+def split_vlan(vlan):
+    ''' returns interface name and vlan id of vlan (<nic>.<vlan_id>) '''
     if '.' in vlan:
         if_name, vlan_id = vlan.rsplit('.', 1)
-        vlan_id = int(vlan_id)
-        if vlan_id:
-            packet = packet / Dot1Q(vlan=vlan_id)
-
-    try:
-        src_ip = netconf.get_current_ipv4(cidr=False)['ips'][0]
-    except IndexError:
-        src_ip = '169.254.66.66'  # we need a source IP...
-
-    packet = packet / ARP(hwsrc=src_mac, psrc=src_ip, hwdst=mac, pdst=ip)
-
-    sendp(packet, iface=if_name)
+        return if_name, int(vlan_id)
+    return vlan, 0
+
+
+def ethernet_header(src_mac, dst_mac, ethertype, vlan_id=0):
+    ''' `src_mac` and `dst_mac` as bytes. 802.1Q tag is added if `vlan_id` is not 0 '''
+    if vlan_id:
+        return struct.pack('!6s6sHHH', dst_mac, src_mac, ETH_P_8021Q, vlan_id & 0x0fff, ethertype)
+    return struct.pack('!6s6sH', dst_mac, src_mac, ethertype)
+
+
+def arp_request(src_mac, src_ip, dst_mac, dst_ip):
+    ''' ARP who-has `dst_ip`, MACs and IPs as bytes '''
+    return struct.pack('!HHBBH6s4s6s4s', 1, ETH_P_IP, 6, 4, ARP_REQUEST, src_mac, src_ip, dst_mac, dst_ip)
+
+
+def checksum(data):
+    ''' Internet checksum (RFC 1071) '''
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!{}H'.format(len(data) // 2), data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def neighbor_solicitation(src_ip, dst_ip):
+    ''' IPv6 packet of a unicast Neighbor Solicitation for `dst_ip`, IPs as bytes '''
+    icmp = struct.pack('!BBHI16s', ICMPV6_NEIGHBOR_SOLICITATION, 0, 0, 0, dst_ip)
+    pseudo_header = struct.pack('!16s16sI3xB', src_ip, dst_ip, len(icmp), IPPROTO_ICMPV6)
+    icmp = icmp[:2] + struct.pack('!H', checksum(pseudo_header + icmp)) + icmp[4:]
+    # version 6, payload length, next header, hop limit 255 (RFC 4861)
+    return struct.pack('!IHBB16s16s', 6 << 28, len(icmp), IPPROTO_ICMPV6, 255, src_ip, dst_ip) + icmp
+
+
+class Prober():
+    '''
+    Sends ARP requests and Neighbor Solicitations to check hosts are still there.
+    Keeps a raw socket per interface and sends frames by rate limited bursts.
+    '''
+
+    def __init__(self, burst=PROBE_BURST, rate=PROBE_RATE):
+        self.burst = burst
+        self.rate = rate
+        self.sockets = {}
+        self.src_mac = None
+        self.src_ipv4 = None
+        self.src_ipv6 = None
+        self.headers = {}
+
+    def refresh(self):
+        '''
+        Gets source MAC and IPs, as they may have changed since last probes.
+        '''
+        self.src_mac = mac_to_bytes(get_ether_address(network.BRIDGE_NAME) or '00:00:00:00:00:00')
+
+        try:
+            src_ipv4 = netconf.get_current_ipv4(cidr=False)['ips'][0]
+        except IndexError:
+            src_ipv4 = DEFAULT_IPV4
+        self.src_ipv4 = socket.inet_pton(socket.AF_INET, src_ipv4)
+
+        local_ip = None
+        for ip6 in netconf.get_current_ipv6(cidr=False)['ips']:
+            if ip6.startswith('fe80'):
+                local_ip = ip6
+            else:
+                src_ipv6 = ip6
+                break
+        else:
+            src_ipv6 = local_ip or DEFAULT_IPV6
+        self.src_ipv6 = socket.inet_pton(socket.AF_INET6, src_ipv6)
+
+        # ethernet headers depend on source MAC
+        self.headers = {}
+
+    def header(self, vlan, mac, ethertype):
+        '''
+        returns interface name and ethernet header of frames to `mac` on `vlan`.
+        '''
+        key = (vlan, ethertype)
+        try:
+            if_name, prefix = self.headers[key]
+        except KeyError:
+            if_name, vlan_id = split_vlan(vlan)
+            # header without destination MAC, that is prepended
+            prefix = ethernet_header(self.src_mac, bytes(6), ethertype, vlan_id)[6:]
+            self.headers[key] = if_name, prefix
+        return if_name, mac_to_bytes(mac) + prefix
+
+    def frame(self, mac, vlan, ip):
+        '''
+        returns interface name and frame to probe `ip` of `mac` on `vlan`.
+        '''
+        if ':' in ip:
+            if_name, header = self.header(vlan, mac, ETH_P_IPV6)
+            return if_name, header + neighbor_solicitation(self.src_ipv6, socket.inet_pton(socket.AF_INET6, ip))
+
+        if_name, header = self.header(vlan, mac, ETH_P_ARP)
+        return if_name, header + arp_request(self.src_mac, self.src_ipv4, mac_to_bytes(mac), socket.inet_pton(socket.AF_INET, ip))
+
+    def get_socket(self, if_name):
+        try:
+            return self.sockets[if_name]
+        except KeyError:
+            sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW)
+            try:
+                sock.bind((if_name, 0))
+            except:
+                sock.close()
+                raise
+            self.sockets[if_name] = sock
+            return sock
+
+    def close_socket(self, if_name):
+        sock = self.sockets.pop(if_name, None)
+        if sock is not None:
+            sock.close()
+
+    def send(self, if_name, frame):
+        try:
+            self.get_socket(if_name).send(frame)
+        except OSError:
+            # interface may have been removed or recreated: a new socket will be opened next time
+            self.close_socket(if_name)
+
+    def probe_many(self, targets):
+        '''
+        Probes all (mac, vlan, ip) of `targets`.
+        '''
+        self.refresh()
+
+        burst_duration = self.burst / self.rate
+        next_burst = time.monotonic()
+        sent = 0
+        for mac, vlan, ip in targets:
+            if sent and sent % self.burst == 0:
+                next_burst += burst_duration
+                delay = next_burst - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self.send(*self.frame(mac, vlan, ip))
+            sent += 1
+
+        return sent
+
+    def close(self):
+        for if_name in list(self.sockets):
+            self.close_socket(if_name)
 
 
 class SessionTracker():
+    '''
+    Pings objects of last seen sorted set when they have been idle for PING_OBJECTS_AFTER and ends their session after EXPIRY_OBJECT_AFTER.
+
+    Objects are fetched when they cross PING_OBJECTS_AFTER, using a score cursor on the sorted set, and their deadlines are kept in a local heap:
+    Redis is only queried at the next deadline.
+    '''
 
     def __init__(self):
         self.synapse = Synapse()
+        self.prober = Prober()
+
+        # objects with a score up to cursor have been fetched
+        self.cursor = float('-inf')
+        self.last_rescan = None
+        # heap of (deadline, member, last_seen)
+        self.deadlines = []
+        # last_seen of scheduled members, heap entries with another last_seen are obsolete
+        self.scheduled = {}
 
     def run(self):
+        session.migrate_last_seen()
         while True:
-            self.check_sessions()
-            wait_time = self.getSecondsBeforeNextCheck()
-            if(wait_time > 0):
+            next_check = self.check_sessions()
+            wait_time = next_check - time.time()
+            if wait_time > 0:
                 time.sleep(wait_time)
 
-    def check_sessions(self):
-        now = (datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)).total_seconds()  # EPOCH
-
-        expired_objects = self.synapse.zrangebyscore(LAST_SEEN_PATH, float('-inf'), now - EXPIRY_OBJECT_AFTER, withscores=True)
-
-        # Expire all objects
-        # Don't send expire if object level up has expired as it will be done on its own
-        expired_macs = []
-        expired_vlans = []
-        expired_ips = []
+    def check_sessions(self, now=None):
+        '''
+        Pings and expires objects whose deadline has been reached.
+        Returns time of next check.
+        '''
+        if now is None:
+            now = time.time()
+
+        self.fetch(now)
+
+        expired_objects = []
+        targets = []
+        while self.deadlines and self.deadlines[0][0] <= now:
+            due = []
+            while self.deadlines and self.deadlines[0][0] <= now:
+                deadline, member, last_seen = heapq.heappop(self.deadlines)
+                if self.scheduled.get(member) == last_seen:
+                    due.append((member, last_seen))
+
+            # Check objects have not been seen meanwhile
+            pipe = self.synapse.pipeline(transaction=False)
+            for member, _ in due:
+                pipe.zscore(session.LAST_SEEN_PATH, member)
+
+            for (member, last_seen), current_last_seen in zip(due, pipe.execute()):
+                if current_last_seen is None:
+                    # session ended
+                    del self.scheduled[member]
+                elif current_last_seen != last_seen:
+                    if current_last_seen > self.cursor:
+                        # will be fetched again when it crosses PING_OBJECTS_AFTER
+                        del self.scheduled[member]
+                    else:
+                        self.schedule(member, current_last_seen, current_last_seen + PING_OBJECTS_AFTER)
+                elif now >= last_seen + EXPIRY_OBJECT_AFTER:
+                    del self.scheduled[member]
+                    expired_objects.append((member, last_seen))
+                else:
+                    mac, vlan, ip = session.parse_last_seen_member(member)
+                    if ip is not None:
+                        targets.append((mac, vlan, ip))
+                    self.schedule(member, last_seen, min(now + PING_EVERY, last_seen + EXPIRY_OBJECT_AFTER))
+
+        self.expire(expired_objects)
+
+        if targets:
+            self.prober.probe_many(targets)
+
+        return self.next_check(now)
+
+    def schedule(self, member, last_seen, deadline):
+        mac, vlan, ip = session.parse_last_seen_member(member)
+        if ip is None:
+            # Can not ping a MAC without an IP. MAC, VLAN are just there to know that the session has ended...
+            deadline = max(deadline, last_seen + EXPIRY_OBJECT_AFTER)
+        self.scheduled[member] = last_seen
+        heapq.heappush(self.deadlines, (deadline, member, last_seen))
+
+    def fetch(self, now):
+        '''
+        Schedules objects that crossed PING_OBJECTS_AFTER since last fetch.
+        Every RESCAN_EVERY, also schedules objects up to cursor that are not scheduled: they were written behind it.
+        '''
+        if self.last_rescan is None or not self.last_rescan <= now < self.last_rescan + RESCAN_EVERY:
+            if self.last_rescan is not None:
+                self.rescan()
+            self.last_rescan = now
+
+        cursor = now - PING_OBJECTS_AFTER
+        if cursor <= self.cursor:
+            return
+
+        for member, last_seen in self.synapse.zrangebyscore(session.LAST_SEEN_PATH, '({}'.format(self.cursor), cursor, withscores=True):
+            self.schedule(member, last_seen, last_seen + PING_OBJECTS_AFTER)
+        self.cursor = cursor
+
+    def rescan(self):
+        for member, last_seen in self.synapse.zrangebyscore(session.LAST_SEEN_PATH, '-inf', self.cursor, withscores=True):
+            if member not in self.scheduled:
+                self.schedule(member, last_seen, last_seen + PING_OBJECTS_AFTER)
+
+    def next_check(self, now):
+        '''
+        Returns time of next deadline: either a scheduled one or the next object crossing PING_OBJECTS_AFTER.
+        Objects seen meanwhile will only delay deadlines, so we can not miss one.
+        '''
+        next_check = now + PING_OBJECTS_AFTER
+
+        if self.deadlines:
+            next_check = min(next_check, self.deadlines[0][0])
+
+        if self.last_rescan is not None:
+            next_check = min(next_check, self.last_rescan + RESCAN_EVERY)
+
+        next_objects = self.synapse.zrangebyscore(session.LAST_SEEN_PATH, '({}'.format(self.cursor), '+inf', start=0, num=1, withscores=True)
+        if next_objects:
+            next_check = min(next_check, next_objects[0][1] + PING_OBJECTS_AFTER)
+
+        return next_check
+
+    def expire(self, expired_objects):
+        '''
+        Ends sessions of expired (member, last_seen).
+        Don't send expire if object level up has expired as it will be done on its own
+        '''
+        expired_macs = set()
+        expired_vlans = set()
         last_seen_macs = []
         last_seen_vlans = []
         last_seen_ips = []
 
-        for obj, last_seen in expired_objects:
-            if 'ip' in obj:
-                expired_ips.append(obj)
-                last_seen_ips.append((obj, last_seen))
-            elif 'vlan' in obj:
-                expired_vlans.append(obj)
-                last_seen_vlans.append((obj, last_seen))
+        for member, last_seen in expired_objects:
+            mac, vlan, ip = session.parse_last_seen_member(member)
+            if ip is not None:
+                last_seen_ips.append((mac, vlan, ip, last_seen))
+            elif vlan is not None:
+                expired_vlans.add((mac, vlan))
+                last_seen_vlans.append((mac, vlan, last_seen))
             else:
-                expired_macs.append(obj)
-                last_seen_macs.append((obj, last_seen))
+                expired_macs.add(mac)
+                last_seen_macs.append((mac, last_seen))
 
-        for obj, last_seen in last_seen_ips:
-            if {'mac': obj['mac'], 'vlan': obj['vlan']} not in expired_vlans and {'mac': obj['mac']} not in expired_macs:
-                session.end(time=int(last_seen), **obj)
+        for mac, vlan, ip, last_seen in last_seen_ips:
+            if (mac, vlan) not in expired_vlans and mac not in expired_macs:
+                session.end(mac=mac, vlan=vlan, ip=ip, time=int(last_seen))
 
-        for obj, last_seen in last_seen_vlans:
-            if {'mac': obj['mac']} not in expired_macs:
-                session.end(time=last_seen, **obj)
+        for mac, vlan, last_seen in last_seen_vlans:
+            if mac not in expired_macs:
+                session.end(mac=mac, vlan=vlan, time=last_seen)
 
-        for obj, last_seen in last_seen_macs:
+        for mac, last_seen in last_seen_macs:
             # Consider Mac as disconnected...
-            session.end(mac=obj['mac'], time=last_seen)
-
-        # ping Objects
-        for obj in self.synapse.zrangebyscore(LAST_SEEN_PATH, float('-inf'), now - PING_OBJECTS_AFTER):
-            if 'ip' in obj:
-                pingIP(**obj)
-            else:
-                pass  # Can not ping a MAC without an IP. MAC, VLAN are just there to know that the session has ended...
-
-    def getSecondsBeforeNextCheck(self, now=None):
-        if not now:
-            now = (datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)).total_seconds()  # EPOCH
-        nextobj_arr = self.synapse.zrange(LAST_SEEN_PATH, 0, 0, withscores=True)
-        if nextobj_arr:
-            last_seen = nextobj_arr[0][1]
-            if last_seen + PING_OBJECTS_AFTER <= now:
-                return PING_EVERY
-            else:
-                return int(last_seen + PING_OBJECTS_AFTER - now) + 1  # can be 0 if PING_OBJECTS_AFTER + last_seen slightly higher than now 0.1sec for ex.
-        else:
-            # No objects to be watched, we can sleep for PING_OBJECTS_AFTER
-            return PING_OBJECTS_AFTER
+            session.end(mac=mac, time=last_seen)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,193 @@
+import ctypes
+import ctypes.util
+import mmap
+import select
+import socket
+import struct
+
+# Linux constants (linux/if_packet.h, linux/if_ether.h, asm/socket.h)
+ETH_P_ALL = 0x0003
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+SO_ATTACH_FILTER = 26
+
+PACKET_OUTGOING = 4
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+TP_STATUS_VLAN_VALID = 1 << 4
+
+# struct tpacket_block_desc: version, offset_to_priv, then struct tpacket_hdr_v1
+BLOCK_STATUS_OFFSET = 8
+BLOCK_HEADER = struct.Struct('=III')  # block_status, num_pkts, offset_to_first_pkt
+
+# struct tpacket3_hdr, followed by struct sockaddr_ll (at TPACKET_ALIGN(sizeof(tpacket3_hdr)))
+PACKET_HEADER = struct.Struct('=IIIIIIHHII')  # next_offset, sec, nsec, snaplen, len, status, mac, net, rxhash, vlan_tci
+PACKET_HEADER_LEN = 48
+SLL_PKTTYPE_OFFSET = PACKET_HEADER_LEN + 10
+
+DLT_EN10MB = 1
+PCAP_NETMASK_UNKNOWN = 0xffffffff
+
+
+class BpfInstruction(ctypes.Structure):
+    _fields_ = [
+        ('code', ctypes.c_ushort),
+        ('jt', ctypes.c_ubyte),
+        ('jf', ctypes.c_ubyte),
+        ('k', ctypes.c_uint32),
+    ]
+
+
+class BpfProgram(ctypes.Structure):
+    _fields_ = [
+        ('bf_len', ctypes.c_uint),
+        ('bf_insns', ctypes.POINTER(BpfInstruction)),
+    ]
+
+
+def compile_filter(capture_filter, snaplen=65535):
+    '''
+    Compiles a pcap filter expression for ethernet frames, using libpcap.
+    Returns the BPF program as a list of (code, jt, jf, k) tuples.
+    Direction qualifiers (inbound/outbound) are not supported: use `RingCapture` `inbound` instead.
+    '''
+    libpcap = ctypes.CDLL(ctypes.util.find_library('pcap'))
+    libpcap.pcap_open_dead.restype = ctypes.c_void_p
+    libpcap.pcap_open_dead.argtypes = [ctypes.c_int, ctypes.c_int]
+    libpcap.pcap_compile.argtypes = [ctypes.c_void_p, ctypes.POINTER(BpfProgram), ctypes.c_char_p, ctypes.c_int, ctypes.c_uint32]
+    libpcap.pcap_geterr.restype = ctypes.c_char_p
+    libpcap.pcap_geterr.argtypes = [ctypes.c_void_p]
+    libpcap.pcap_freecode.argtypes = [ctypes.POINTER(BpfProgram)]
+    libpcap.pcap_close.argtypes = [ctypes.c_void_p]
+
+    pcap = libpcap.pcap_open_dead(DLT_EN10MB, snaplen)
+    try:
+        program = BpfProgram()
+        if libpcap.pcap_compile(pcap, ctypes.byref(program), capture_filter.encode(), 1, PCAP_NETMASK_UNKNOWN) != 0:
+            raise ValueError('Invalid capture filter "{filter}": {error}'.format(filter=capture_filter, error=libpcap.pcap_geterr(pcap).decode()))
+        try:
+            return [(i.code, i.jt, i.jf, i.k) for i in program.bf_insns[:program.bf_len]]
+        finally:
+            libpcap.pcap_freecode(ctypes.byref(program))
+    finally:
+        libpcap.pcap_close(pcap)
+
+
+def attach_filter(sock, program):
+    ''' Attaches BPF `program` (as returned by `compile_filter`) to socket '''
+    instructions = (BpfInstruction * len(program))(*program)
+    fprog = struct.pack('HL', len(program), ctypes.addressof(instructions))
+    sock.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+class Ring():
+    '''
+    TPACKET_V3 receive ring of an AF_PACKET socket bound to an interface.
+    Kernel fills blocks of frames in the ring, shared with us by mmap: no syscall is needed per frame.
+    '''
+
+    def __init__(self, interface, program=None, block_size=1 << 20, block_nr=16, frame_size=2048, block_timeout=50):
+        self.interface = interface
+        self.block_size = block_size
+        self.block_nr = block_nr
+        self.current_block = 0
+
+        # protocol 0: no frame is received until bound to interface, so frames of other interfaces do not end up in the ring
+        self.socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        try:
+            if program is not None:
+                attach_filter(self.socket, program)
+            self.socket.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            # struct tpacket_req3: block_size, block_nr, frame_size, frame_nr, retire_blk_tov (ms), sizeof_priv, feature_req_word
+            self.socket.setsockopt(
+                    SOL_PACKET, PACKET_RX_RING,
+                    struct.pack('IIIIIII', block_size, block_nr, frame_size, block_size * block_nr // frame_size, block_timeout, 0, 0)
+            )
+            self.ring = mmap.mmap(self.socket.fileno(), block_size * block_nr, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+            self.socket.bind((interface, ETH_P_ALL))  # protocol in host order: python converts it
+        except:
+            self.socket.close()
+            raise
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        self.ring.close()
+        self.socket.close()
+
+    def ready(self):
+        ''' Returns True if kernel has handed over the current block '''
+        return bool(BLOCK_HEADER.unpack_from(self.ring, self.current_block * self.block_size + BLOCK_STATUS_OFFSET)[0] & TP_STATUS_USER)
+
+    def frames(self, inbound=False, max_blocks=None):
+        '''
+        Yields (frame, vlan_id, timestamp) of all frames of ready blocks, or of the first `max_blocks` ready blocks.
+        '''
+        blocks = 0
+        while max_blocks is None or blocks < max_blocks:
+            block_offset = self.current_block * self.block_size
+            status, num_pkts, offset = BLOCK_HEADER.unpack_from(self.ring, block_offset + BLOCK_STATUS_OFFSET)
+            if not status & TP_STATUS_USER:
+                return
+            blocks += 1
+
+            offset += block_offset
+            for _ in range(num_pkts):
+                next_offset, sec, nsec, snaplen, _len, tp_status, mac, _net, _rxhash, vlan_tci = PACKET_HEADER.unpack_from(self.ring, offset)
+                if not inbound or self.ring[offset + SLL_PKTTYPE_OFFSET] != PACKET_OUTGOING:
+                    vlan_id = vlan_tci & 0x0fff if tp_status & TP_STATUS_VLAN_VALID else 0
+                    yield self.ring[offset + mac:offset + mac + snaplen], vlan_id, sec + nsec / 1e9
+                offset += next_offset
+
+            # give block back to kernel
+            struct.pack_into('=I', self.ring, block_offset + BLOCK_STATUS_OFFSET, TP_STATUS_KERNEL)
+            self.current_block = (self.current_block + 1) % self.block_nr
+
+
+class RingCapture():
+    '''
+    Captures frames on `interfaces` with TPACKET_V3 rings, filtered in kernel by `capture_filter` (pcap syntax, without direction).
+    Iterating yields (interface index in `interfaces`, frame, vlan_id, timestamp).
+    If `inbound`, frames sent by the host are ignored.
+    Rings are read in turn, `blocks_per_pass` blocks at a time, so that a busy interface does not starve the others.
+    '''
+
+    def __init__(self, interfaces, capture_filter=None, inbound=False, blocks_per_pass=1, **ring_kwargs):
+        if isinstance(interfaces, str):
+            interfaces = [interfaces]
+        self.interfaces = list(interfaces)
+        self.inbound = inbound
+        self.blocks_per_pass = blocks_per_pass
+
+        program = None
+        if capture_filter:
+            program = compile_filter(capture_filter)
+
+        self.rings = []
+        try:
+            for interface in self.interfaces:
+                self.rings.append(Ring(interface, program, **ring_kwargs))
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        for ring in self.rings:
+            ring.close()
+        self.rings = []
+
+    def __iter__(self):
+        poller = select.poll()
+        for ring in self.rings:
+            poller.register(ring, select.POLLIN | select.POLLERR)
+
+        while True:
+            for index, ring in enumerate(self.rings):
+                for frame, vlan_id, timestamp in ring.frames(inbound=self.inbound, max_blocks=self.blocks_per_pass):
+                    yield index, frame, vlan_id, timestamp
+            if not any(ring.ready() for ring in self.rings):
+                poller.poll()
@@ -0,0 +1,348 @@
+import asyncio
+import collections
+import json
+
+import serialized_redis
+
+from elan.neuron import Synapse
+
+
+class AsyncRedisConnection():
+    '''
+    Redis connection for asyncio.
+    Commands of all coroutines are written as they come and their replies read in order by a single reader task:
+    concurrent commands are pipelined on the connection instead of waiting for each other.
+    '''
+
+    def __init__(self, host, port, db, loop):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.loop = loop
+        self.reader = None
+        self.writer = None
+        self.reader_task = None
+        self.connecting = None
+        self.replies = collections.deque()  # futures of replies, in order of commands
+
+    async def connect(self):
+        try:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        finally:
+            # cleared by the connection itself: callers waiting for it may be cancelled
+            self.connecting = None
+        self.reader_task = asyncio.ensure_future(self.read_replies(self.reader))
+        if self.db:
+            self.send([('SELECT', self.db)])
+
+    async def execute(self, commands):
+        '''
+        Sends commands at once and returns their replies. Error replies are returned as `ResponseError`, not raised.
+        '''
+        if self.writer is None:
+            if self.connecting is None:
+                self.connecting = asyncio.ensure_future(self.connect())
+            try:
+                await asyncio.shield(self.connecting)
+            except OSError as e:
+                raise serialized_redis.redis.ConnectionError(e)
+        return await asyncio.gather(*self.send(commands))
+
+    def send(self, commands):
+        futures = [self.loop.create_future() for _ in commands]
+        self.replies.extend(futures)
+        self.writer.write(b''.join(self.encode(command) for command in commands))
+        return futures
+
+    @staticmethod
+    def encode(command):
+        args = [arg if isinstance(arg, bytes) else str(arg).encode() for arg in command]
+        return b'*%d\r\n' % len(args) + b''.join(b'$%d\r\n%s\r\n' % (len(arg), arg) for arg in args)
+
+    async def read_replies(self, reader):
+        try:
+            while True:
+                reply = await self.read_reply(reader)
+                future = self.replies.popleft()
+                if not future.done():  # caller may have been cancelled
+                    future.set_result(reply)
+        except Exception as e:
+            if reader is self.reader:
+                self.reader_task = None  # ending
+                self.close(e)
+
+    async def read_reply(self, reader):
+        line = await reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise serialized_redis.redis.ConnectionError('Connection closed by Redis')
+        kind, value = line[:1], line[1:-2]
+        if kind == b'+':
+            return value.decode()
+        if kind == b'-':
+            return serialized_redis.redis.ResponseError(value.decode())
+        if kind == b':':
+            return int(value)
+        if kind == b'$':
+            if int(value) < 0:
+                return None
+            return (await reader.readexactly(int(value) + 2))[:-2].decode()
+        if kind == b'*':
+            if int(value) < 0:
+                return None
+            return [await self.read_reply(reader) for _ in range(int(value))]
+        raise serialized_redis.redis.ConnectionError('Invalid reply from Redis: {}'.format(line))
+
+    def close(self, error=None):
+        try:
+            if self.writer is not None:
+                self.writer.close()
+            if self.reader_task is not None:
+                self.reader_task.cancel()
+        except RuntimeError:  # loop closed
+            pass
+        self.reader = self.writer = self.reader_task = None
+        if not isinstance(error, serialized_redis.redis.ConnectionError):
+            error = serialized_redis.redis.ConnectionError(error or 'Connection closed')
+        while self.replies:
+            future = self.replies.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+
+class AsyncSynapseCommands():
+    '''
+    Commands of `AsyncSynapse`, with values JSON en/decoded like `Synapse` (hash fields and keys are not).
+    Each command is passed to `_command` with the function to parse its reply.
+    '''
+    serialize = staticmethod(json.JSONEncoder(sort_keys=True).encode)
+
+    @staticmethod
+    def deserialize(value):
+        if value is None or value == '':
+            return value
+        return json.loads(value)
+
+    def _deserialize_list(self, values):
+        if values is None:
+            return None
+        return [self.deserialize(value) for value in values]
+
+    def _parse_hash(self, values):
+        return {field: self.deserialize(value) for field, value in zip(values[::2], values[1::2])}
+
+    def _parse_zrange(self, values, withscores=False):
+        if withscores:
+            return [(self.deserialize(value), float(score)) for value, score in zip(values[::2], values[1::2])]
+        return self._deserialize_list(values)
+
+    @staticmethod
+    def _parse_float(value):
+        if value is None:
+            return None
+        return float(value)
+
+    def get_unique_id(self, path='synapse:unique_id'):
+        return self.incr(path)
+
+    # Keys
+    def delete(self, *names):
+        return self._command(('DEL',) + names)
+
+    def exists(self, name):
+        return self._command(('EXISTS', name), bool)
+
+    def expire(self, name, time):
+        return self._command(('EXPIRE', name, time), bool)
+
+    # Strings
+    def get(self, name):
+        return self._command(('GET', name), self.deserialize)
+
+    def set(self, name, value, ex=None):
+        args = ('SET', name, self.serialize(value))
+        if ex is not None:
+            args += ('EX', ex)
+        return self._command(args, lambda reply: reply == 'OK')
+
+    def incr(self, name, amount=1):
+        return self._command(('INCRBY', name, amount))
+
+    # Hashes: fields are strings
+    def hget(self, name, field):
+        return self._command(('HGET', name, field), self.deserialize)
+
+    def hset(self, name, field, value):
+        return self._command(('HSET', name, field, self.serialize(value)))
+
+    def hmset(self, name, mapping):
+        args = ['HMSET', name]
+        for field, value in mapping.items():
+            args += [field, self.serialize(value)]
+        return self._command(args, lambda reply: reply == 'OK')
+
+    def hmget(self, name, fields):
+        return self._command(['HMGET', name] + list(fields), self._deserialize_list)
+
+    def hgetall(self, name):
+        return self._command(('HGETALL', name), self._parse_hash)
+
+    def hdel(self, name, *fields):
+        return self._command(('HDEL', name) + fields)
+
+    def hexists(self, name, field):
+        return self._command(('HEXISTS', name, field), bool)
+
+    # Sets
+    def sadd(self, name, *values):
+        return self._command(['SADD', name] + [self.serialize(value) for value in values])
+
+    def srem(self, name, *values):
+        return self._command(['SREM', name] + [self.serialize(value) for value in values])
+
+    def sismember(self, name, value):
+        return self._command(('SISMEMBER', name, self.serialize(value)), bool)
+
+    def smembers(self, name):
+        return self._command(('SMEMBERS', name), lambda values: set(self._deserialize_list(values)))
+
+    def smembers_as_list(self, name):
+        ''' To be used when deserialized members may not be hashable '''
+        return self._command(('SMEMBERS', name), self._deserialize_list)
+
+    # Sorted sets: same arguments order as Synapse (score before member)
+    def zadd(self, name, *args):
+        scores = list(args[::2])
+        values = [self.serialize(value) for value in args[1::2]]
+        return self._command(['ZADD', name] + [arg for pair in zip(scores, values) for arg in pair])
+
+    def zrem(self, name, *values):
+        return self._command(['ZREM', name] + [self.serialize(value) for value in values])
+
+    def zscore(self, name, value):
+        return self._command(('ZSCORE', name, self.serialize(value)), self._parse_float)
+
+    def zrange(self, name, start, end, withscores=False):
+        args = ('ZRANGE', name, start, end)
+        if withscores:
+            args += ('WITHSCORES',)
+        return self._command(args, lambda values: self._parse_zrange(values, withscores))
+
+    def zrangebyscore(self, name, min, max, withscores=False):
+        args = ('ZRANGEBYSCORE', name, min, max)
+        if withscores:
+            args += ('WITHSCORES',)
+        return self._command(args, lambda values: self._parse_zrange(values, withscores))
+
+    def zmembers(self, name):
+        return self.zrange(name, 0, -1)
+
+    # Pub/Sub
+    def publish(self, channel, message):
+        return self._command(('PUBLISH', channel, self.serialize(message)))
+
+
+class AsyncSynapse(AsyncSynapseCommands):
+    '''
+        asyncio Redis client that JSON en/decodes all values, like Synapse.
+        Commands are coroutines. Commands without helper can be sent with `execute_command`, replies are then not decoded.
+        A connection is opened per event loop.
+    '''
+
+    def __init__(self, host=None, port=None, db=None):
+        connection_kwargs = Synapse.pool.connection_kwargs
+        self.host = host or connection_kwargs.get('host', 'localhost')
+        self.port = port or connection_kwargs.get('port', 6379)
+        self.db = db if db is not None else connection_kwargs.get('db', 0)
+        self.connection = None
+
+    def _connection(self):
+        loop = asyncio.get_event_loop()
+        if self.connection is None or self.connection.loop is not loop:
+            if self.connection is not None:
+                self.connection.close()
+            self.connection = AsyncRedisConnection(self.host, self.port, self.db, loop)
+        return self.connection
+
+    def _command(self, args, parse=None):
+        return self._execute(args, parse)
+
+    async def _execute(self, args, parse=None):
+        reply, = await self._connection().execute([args])
+        if isinstance(reply, serialized_redis.redis.ResponseError):
+            raise reply
+        if parse is not None:
+            reply = parse(reply)
+        return reply
+
+    async def execute_command(self, *args):
+        return await self._execute(args)
+
+    async def run_script(self, script, keys=(), args=()):
+        '''
+        Runs a script registered with `Synapse.register_script`, loading it if Redis does not know it. Its reply is not decoded.
+        '''
+        try:
+            return await self._execute(('EVALSHA', script.sha, len(keys)) + tuple(keys) + tuple(args))
+        except serialized_redis.redis.ResponseError as e:
+            if not str(e).startswith('NOSCRIPT'):
+                raise
+        return await self._execute(('EVAL', script.script, len(keys)) + tuple(keys) + tuple(args))
+
+    def pipeline(self, transaction=True):
+        return AsyncSynapsePipeline(self, transaction)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class AsyncSynapsePipeline(AsyncSynapseCommands):
+    '''
+    Buffers commands to send them at once on `execute`, in a MULTI/EXEC transaction if `transaction`.
+    '''
+
+    def __init__(self, synapse, transaction=True):
+        self.synapse = synapse
+        self.transaction = transaction
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.reset()
+
+    def reset(self):
+        self.commands = []
+
+    def _command(self, args, parse=None):
+        self.commands.append((args, parse))
+        return self
+
+    def execute_command(self, *args):
+        return self._command(args)
+
+    async def execute(self, raise_on_error=True):
+        commands, self.commands = self.commands, []
+        if not commands:
+            return []
+        args = [command_args for command_args, parse in commands]
+        if self.transaction:
+            replies = await self.synapse._connection().execute([('MULTI',)] + args + [('EXEC',)])
+            for reply in replies[:-1]:
+                if isinstance(reply, serialized_redis.redis.ResponseError):  # command refused
+                    raise reply
+            replies = replies[-1]
+        else:
+            replies = await self.synapse._connection().execute(args)
+
+        results = []
+        for reply, (command_args, parse) in zip(replies, commands):
+            if isinstance(reply, serialized_redis.redis.ResponseError):
+                if raise_on_error:
+                    raise reply
+            elif parse is not None:
+                reply = parse(reply)
+            results.append(reply)
+        return results
@@ -65,15 +65,20 @@ class GuestAccessManager():
 
         current_mac_with_authz = self.synapse.smembers(self.MAC_AUTHS_PATH)
 
-        for mac in current_mac_with_authz - set(authz_by_mac.keys()):
+        revoked_macs = current_mac_with_authz - set(authz_by_mac.keys())
+        for mac in revoked_macs:
             nac.checkAuthz(mac, remove_source='captive-portal-guest', end_reason='revoked')
-            self.synapse.srem(self.MAC_AUTHS_PATH, mac)
 
-        for mac in authz_by_mac:
+        pipe = self.synapse.pipeline()
+        if revoked_macs:
+            pipe.srem(self.MAC_AUTHS_PATH, *revoked_macs)
+        if authz_by_mac:
             # Authz not pending any more
-            self.synapse.srem(PENDING_GUEST_REQUESTS_PATH, mac)
+            pipe.srem(PENDING_GUEST_REQUESTS_PATH, *authz_by_mac)
+            pipe.sadd(self.MAC_AUTHS_PATH, *authz_by_mac)
+        pipe.execute()
 
-            self.synapse.sadd(self.MAC_AUTHS_PATH, mac)
+        for mac in authz_by_mac:
             session.remove_authentication_sessions_by_source(mac, 'captive-portal-guest')
             for authz in authz_by_mac[mac]:
                 till_str = authz['till'][0:19]  # get rid of milliseconds if present
@@ -81,4 +86,3 @@ class GuestAccessManager():
                 till = (datetime.datetime.strptime(till_str, '%Y-%m-%dT%H:%M:%S') - datetime.datetime(1970, 1, 1)).total_seconds()
                 session.add_authentication_session(mac, source='captive-portal-guest', till=till, login=authz['sponsor_login'], authentication_provider=authz['sponsor_authentication_provider'], guest_authorization=authz['id'])
             nac.checkAuthz(mac)
-
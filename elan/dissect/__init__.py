@@ -0,0 +1,115 @@
+'''
+Lightweight dissectors of the frames device tracker learns from.
+Each protocol module has a `dissect(payload, mac)` function returning a `Record`.
+'''
+import socket
+import struct
+
+from elan.dissect import bootp, dhcpv6, mdns, netbios
+from elan.dissect.record import Record
+from elan.dissect.utils import format_mac
+
+ETH_TYPE_VLAN = 0x8100
+ETH_TYPE_ARP = 0x0806
+ETH_TYPE_IPV4 = 0x0800
+ETH_TYPE_IPV6 = 0x86dd
+
+IPV6_EXTENSION_HEADERS = (0, 43, 60)  # Hop-by-Hop, Routing, Destination Options
+
+ICMPV6_NEIGHBOR_SOLICITATION = 135
+ICMPV6_NEIGHBOR_ADVERTISEMENT = 136
+
+DISSECTORS = {
+    bootp.SOURCE: bootp.dissect,
+    dhcpv6.SOURCE: dhcpv6.dissect,
+    mdns.SOURCE: mdns.dissect,
+    netbios.SOURCE: netbios.dissect,
+}
+
+
+def udp_source(src_port, dst_port):
+    if src_port == 67 or dst_port == 67:
+        return bootp.SOURCE
+    if dst_port == 547:
+        return dhcpv6.SOURCE
+    if dst_port == 138:
+        return netbios.SOURCE
+    if src_port == 5353 and dst_port == 5353:
+        return mdns.SOURCE
+    return 'UDP'
+
+
+def locate(frame):
+    '''
+    Locates in ethernet `frame` the protocol device tracker may learn from.
+    Returns (mac, source, ip, payload), ip being set for ARP and NDP, payload being the UDP payload.
+    Returns None if frame is too short to be ethernet.
+    '''
+    if len(frame) < 14:
+        return
+
+    mac = format_mac(frame[6:12])
+    source = 'ETH'
+    ip = None
+    payload = None
+
+    try:
+        eth_type = struct.unpack_from('!H', frame, 12)[0]
+        offset = 14
+        if eth_type == ETH_TYPE_VLAN:
+            eth_type = struct.unpack_from('!H', frame, 16)[0]
+            offset = 18
+
+        if eth_type == ETH_TYPE_ARP:
+            source = 'ARP'
+            ip = socket.inet_ntop(socket.AF_INET, frame[offset + 14:offset + 18])
+
+        elif eth_type == ETH_TYPE_IPV4:
+            source = 'IP'
+            if frame[offset + 9] == socket.IPPROTO_UDP:
+                offset += (frame[offset] & 0x0f) * 4
+                src_port, dst_port = struct.unpack_from('!HH', frame, offset)
+                source = udp_source(src_port, dst_port)
+                payload = frame[offset + 8:]
+
+        elif eth_type == ETH_TYPE_IPV6:
+            source = 'IPV6'
+            next_header = frame[offset + 6]
+            src = frame[offset + 8:offset + 24]
+            offset += 40
+            while next_header in IPV6_EXTENSION_HEADERS:
+                next_header, length = frame[offset], frame[offset + 1]
+                offset += (length + 1) * 8
+
+            if next_header == socket.IPPROTO_ICMPV6:
+                source = 'ICMPV6'
+                if frame[offset] in (ICMPV6_NEIGHBOR_SOLICITATION, ICMPV6_NEIGHBOR_ADVERTISEMENT):
+                    ip = socket.inet_ntop(socket.AF_INET6, src)
+            elif next_header == socket.IPPROTO_UDP:
+                src_port, dst_port = struct.unpack_from('!HH', frame, offset)
+                source = udp_source(src_port, dst_port)
+                payload = frame[offset + 8:]
+
+    except (IndexError, struct.error, ValueError):
+        pass  # Truncated: keep what was located so far
+
+    return mac, source, ip, payload
+
+
+def dissect_frame(frame):
+    '''
+    Dissects ethernet `frame` and returns a `Record`, or None if frame is too short to be ethernet.
+    '''
+    located = locate(frame)
+    if located is None:
+        return
+
+    mac, source, ip, payload = located
+    dissector = DISSECTORS.get(source, None)
+    if dissector is not None and payload is not None:
+        try:
+            return dissector(payload, mac)
+        except (IndexError, struct.error, ValueError):
+            pass  # Truncated or malformed
+
+    return Record(mac, source, ip)
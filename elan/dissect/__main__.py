@@ -0,0 +1,87 @@
+'''
+Benchmarks dissectors against recorded pcap files (ethernet link type):
+
+    python3 -m elan.dissect [--repeat N] file.pcap...
+
+Each dissector is timed on its own, on the payloads located in the capture, as well as the whole frame dissection.
+'''
+import argparse
+import struct
+import time
+
+from elan.dissect import DISSECTORS, dissect_frame, locate
+
+PCAP_MAGICS = {
+    b'\xd4\xc3\xb2\xa1': '<',  # microseconds, little endian
+    b'\xa1\xb2\xc3\xd4': '>',  # microseconds, big endian
+    b'\x4d\x3c\xb2\xa1': '<',  # nanoseconds, little endian
+    b'\xa1\xb2\x3c\x4d': '>',  # nanoseconds, big endian
+}
+LINKTYPE_ETHERNET = 1
+
+
+def read_pcap(path):
+    ''' Yields frames of pcap file '''
+    with open(path, 'rb') as f:
+        header = f.read(24)
+        endianness = PCAP_MAGICS.get(header[:4], None)
+        if endianness is None:
+            raise ValueError('{path}: not a pcap file (pcapng is not supported)'.format(path=path))
+        if struct.unpack(endianness + '20xI', header)[0] != LINKTYPE_ETHERNET:
+            raise ValueError('{path}: not an ethernet capture'.format(path=path))
+
+        record_header = struct.Struct(endianness + '8xII')
+        while True:
+            header = f.read(record_header.size)
+            if len(header) < record_header.size:
+                return
+            caplen, _len = record_header.unpack(header)
+            yield f.read(caplen)
+
+
+def bench(fn, items, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for item in items:
+            fn(*item)
+    return time.perf_counter() - start
+
+
+def report(name, count, duration):
+    if count:
+        print('{name:<10} {count:>9} {per_item:>10.2f} us {rate:>12.0f} /s'.format(
+                name=name, count=count, per_item=duration / count * 1e6, rate=count / duration
+        ))
+    else:
+        print('{name:<10} {count:>9}'.format(name=name, count=count))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks elan.dissect dissectors against pcap files.')
+    parser.add_argument('pcaps', nargs='+', metavar='file.pcap')
+    parser.add_argument('--repeat', type=int, default=10, help='number of passes over the frames')
+    args = parser.parse_args()
+
+    frames = [(frame,) for path in args.pcaps for frame in read_pcap(path)]
+
+    payloads = {source: [] for source in DISSECTORS}
+    for frame, in frames:
+        located = locate(frame)
+        if located is not None:
+            mac, source, _ip, payload = located
+            if source in payloads and payload is not None:
+                try:
+                    DISSECTORS[source](payload, mac)
+                except Exception:
+                    continue  # malformed, dissect_frame would skip it as well
+                payloads[source].append((payload, mac))
+
+    print('{:<10} {:>9} {:>13} {:>14}'.format('dissector', 'payloads', 'per payload', 'rate'))
+    for source, dissector in sorted(DISSECTORS.items()):
+        items = payloads[source]
+        report(source, len(items) * args.repeat, bench(dissector, items, args.repeat))
+    report('frame', len(frames) * args.repeat, bench(dissect_frame, frames, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+from elan.dissect.record import Record
+from elan.dissect.utils import decode_str
+
+SOURCE = 'DHCPV4'
+
+DHCP_MAGIC_COOKIE = b'\x63\x82\x53\x63'
+DHCP_OPTIONS_OFFSET = 240
+DHCP_OPTION_PAD = 0
+DHCP_OPTION_HOSTNAME = 12
+DHCP_OPTION_REQUEST_LIST = 55
+DHCP_OPTION_VENDOR_CLASS_ID = 60
+DHCP_OPTION_END = 255
+
+
+def dissect(payload, mac=None):
+    '''
+    Dissects BOOTP/DHCPv4 `payload` (UDP payload) for hostname (option 12) and fingerprint (options 55 and 60).
+    '''
+    if len(payload) < DHCP_OPTIONS_OFFSET or payload[236:240] != DHCP_MAGIC_COOKIE:
+        return Record(mac, SOURCE)
+
+    hostname = None
+    request_list = None
+    vendor = ''
+
+    offset = DHCP_OPTIONS_OFFSET
+    end = len(payload)
+    while offset < end:
+        code = payload[offset]
+        if code == DHCP_OPTION_END:
+            break
+        if code == DHCP_OPTION_PAD:
+            offset += 1
+            continue
+        length = payload[offset + 1]
+        offset += 2
+        if code == DHCP_OPTION_HOSTNAME:
+            hostname = decode_str(payload[offset:offset + length])
+        elif code == DHCP_OPTION_REQUEST_LIST:
+            request_list = ','.join(str(option) for option in payload[offset:offset + length])
+        elif code == DHCP_OPTION_VENDOR_CLASS_ID:
+            vendor = decode_str(payload[offset:offset + length])
+        offset += length
+
+    fingerprint = None
+    if request_list is not None:
+        fingerprint = {'request_list': request_list, 'vendor': vendor}
+
+    return Record(mac, SOURCE, hostname=hostname, fingerprint=fingerprint)
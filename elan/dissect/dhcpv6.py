@@ -0,0 +1,44 @@
+import struct
+
+from elan.dissect.record import Record
+from elan.dissect.utils import decode_str, parse_dns_name
+
+SOURCE = 'DHCPV6'
+
+DHCPV6_OPTION_ORO = 6
+DHCPV6_OPTION_VENDOR_CLASS = 16
+DHCPV6_OPTION_CLIENT_FQDN = 39
+
+
+def dissect(payload, mac=None):
+    '''
+    Dissects DHCPv6 `payload` (UDP payload) for hostname (client FQDN) and fingerprint (ORO and vendor class).
+    '''
+    hostname = None
+    request_list = None
+    vendor = ''
+    enterprise = ''
+
+    offset = 4  # msg-type and transaction-id
+    end = len(payload)
+    while offset + 4 <= end:
+        code, length = struct.unpack_from('!HH', payload, offset)
+        offset += 4
+
+        if code == DHCPV6_OPTION_ORO:
+            request_list = ','.join(str(option) for option in struct.unpack_from('!{}H'.format(length // 2), payload, offset))
+        elif code == DHCPV6_OPTION_VENDOR_CLASS and length >= 6:
+            enterprise, data_length = struct.unpack_from('!IH', payload, offset)
+            enterprise = str(enterprise)
+            vendor = decode_str(payload[offset + 6:offset + 6 + data_length])
+        elif code == DHCPV6_OPTION_CLIENT_FQDN and length > 1:
+            # name may be partial, ie not terminated by root label
+            hostname, _ = parse_dns_name(payload[offset + 1:offset + length] + b'\x00', 0)
+
+        offset += length
+
+    fingerprint = None
+    if request_list is not None:
+        fingerprint = {'request_list': request_list, 'vendor': vendor, 'enterprise': enterprise}
+
+    return Record(mac, SOURCE, hostname=hostname, fingerprint=fingerprint)
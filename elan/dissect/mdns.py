@@ -0,0 +1,47 @@
+import socket
+import struct
+
+from elan.dissect.record import Record
+from elan.dissect.utils import parse_dns_name
+
+SOURCE = 'MDNS'
+
+FLAG_RESPONSE = 0x8000
+FLAG_AUTHORITATIVE = 0x0400
+
+DNS_TYPE_A = 1
+DNS_TYPE_AAAA = 28
+
+
+def dissect(payload, mac=None):
+    '''
+    Dissects mDNS `payload` (UDP payload) for `.local` A and AAAA records of authoritative responses.
+    They are returned as `mdns_answers`, a tuple of (hostname, ip).
+    '''
+    if len(payload) < 12:
+        return Record(mac, SOURCE)
+
+    flags, qdcount, ancount, nscount, arcount = struct.unpack_from('!HHHHH', payload, 2)
+    if not flags & FLAG_RESPONSE or not flags & FLAG_AUTHORITATIVE:
+        return Record(mac, SOURCE)
+
+    offset = 12
+    for _ in range(qdcount):
+        _name, offset = parse_dns_name(payload, offset)
+        offset += 4  # type and class
+
+    answers = []
+    for _ in range(ancount + nscount + arcount):
+        name, offset = parse_dns_name(payload, offset)
+        rtype, rdlength = struct.unpack_from('!H6xH', payload, offset)
+        offset += 10
+
+        if rtype == DNS_TYPE_A and rdlength == 4 or rtype == DNS_TYPE_AAAA and rdlength == 16:
+            name, *domain = name.split('.')
+            if domain == ['local']:
+                family = socket.AF_INET if rdlength == 4 else socket.AF_INET6
+                answers.append((name, socket.inet_ntop(family, payload[offset:offset + rdlength])))
+
+        offset += rdlength
+
+    return Record(mac, SOURCE, mdns_answers=tuple(answers))
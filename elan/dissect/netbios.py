@@ -0,0 +1,27 @@
+from elan.dissect.record import Record
+from elan.dissect.utils import decode_str
+
+SOURCE = 'NetBIOS'
+
+DATAGRAM_TYPES = (0x10, 0x11, 0x12)  # Direct unique, direct group and broadcast datagrams
+SOURCE_NAME_OFFSET = 14
+ENCODED_NAME_LENGTH = 32
+
+
+def dissect(payload, mac=None):
+    '''
+    Dissects NetBIOS datagram `payload` (UDP payload) for hostname (source name, without suffix).
+    '''
+    if len(payload) < SOURCE_NAME_OFFSET + 1 + ENCODED_NAME_LENGTH \
+       or payload[0] not in DATAGRAM_TYPES \
+       or payload[SOURCE_NAME_OFFSET] != ENCODED_NAME_LENGTH:
+        return Record(mac, SOURCE)
+
+    # First level encoding: each nibble is encoded as a letter from 'A'
+    offset = SOURCE_NAME_OFFSET + 1
+    name = bytes(
+        ((payload[i] - 0x41) << 4) | (payload[i + 1] - 0x41)
+        for i in range(offset, offset + ENCODED_NAME_LENGTH - 2, 2)  # last byte is suffix
+    )
+
+    return Record(mac, SOURCE, hostname=decode_str(name).rstrip())
@@ -0,0 +1,11 @@
+import collections
+
+# What is learnt about a device from one of its frames.
+# - mac: source mac of the frame
+# - source: protocol the information comes from (ARP, ICMPV6, DHCPV4, DHCPV6, NetBIOS, MDNS...)
+# - ip: IP the device claims (ARP and NDP)
+# - hostname
+# - fingerprint: as expected by device.seen_fingerprint (DHCP)
+# - mdns_answers: tuple of (hostname, ip) announced by device
+Record = collections.namedtuple('Record', ['mac', 'source', 'ip', 'hostname', 'fingerprint', 'mdns_answers'])
+Record.__new__.__defaults__ = (None, None, None, ())
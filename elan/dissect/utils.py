@@ -0,0 +1,36 @@
+import struct
+
+
+def format_mac(raw):
+    return ':'.join('{:02x}'.format(b) for b in raw)
+
+
+def decode_str(raw):
+    return raw.decode('utf-8', errors='replace')
+
+
+def parse_dns_name(data, offset, max_pointers=16):
+    '''
+    Parses a (possibly compressed) DNS name at `offset` of `data`.
+    Returns the name and the offset following it.
+    '''
+    labels = []
+    end = None
+    while True:
+        length = data[offset]
+        if length & 0xc0 == 0xc0:
+            if end is None:
+                end = offset + 2
+            if not max_pointers:
+                raise ValueError('Too many DNS compression pointers')
+            max_pointers -= 1
+            offset = struct.unpack_from('!H', data, offset)[0] & 0x3fff
+            continue
+        offset += 1
+        if not length:
+            break
+        labels.append(decode_str(data[offset:offset + length]))
+        offset += length
+    if end is None:
+        end = offset
+    return '.'.join(labels), end
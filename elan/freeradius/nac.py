@@ -1,7 +1,6 @@
 #! /usr/bin/env python3
 
 import asyncio
-import functools
 import re
 
 from elan import snmp, session, nac, neuron
@@ -35,7 +34,7 @@ async def seen(request):
     mac = extract_mac(request.get('Calling-Station-Id', None))
 
     port = await find_port(request)
-    await asyncio.get_event_loop().run_in_executor(None, functools.partial(session.seen, mac, port=port))
+    await session.seen_async(mac, port=port)
 
 
 async def end(request):
@@ -55,11 +54,11 @@ async def find_port(request):
     # first try nas_ip address in snmp cache then radius_client_ip
     # then try polling
     if nas_ip_address and nas_ip_address not in ['0.0.0.0', '::']:
-        switch = snmp_manager.get_device_by_ip(nas_ip_address)
+        switch = await snmp_manager.get_device_by_ip_async(nas_ip_address)
     if switch:
         switch_ip = nas_ip_address
     else:
-        switch = snmp_manager.get_device_by_ip(radius_client_ip)
+        switch = await snmp_manager.get_device_by_ip_async(radius_client_ip)
 
     if switch:
         switch_ip = radius_client_ip
@@ -195,24 +194,22 @@ async def get_assignments(request):
 
     port = await find_port(request)
 
-    session.seen(mac, port=port)
+    await session.seen_async(mac, port=port)
 
     auth_type = request.get('ELAN-Auth-Type', None)
 
     if auth_type == 'radius-mac':
-        authz = await asyncio.get_event_loop().run_in_executor(None, nac.checkAuthz, mac)
+        authz = await nac.checkAuthz_async(mac)
     elif auth_type == 'radius-dot1x':
         authentication_provider = request.get('ELAN-Auth-Provider')
         login = request.get('ELAN-Login', request.get('User-Name'))
-        authz = await asyncio.get_event_loop().run_in_executor(None, functools.partial(
-                                nac.newAuthz,
-                                mac,
-                                no_duplicate_source=True,
-                                source='radius-dot1x',
-                                till_disconnect=True,
-                                authentication_provider=authentication_provider,
-                                login=login
-                            )
+        authz = await nac.newAuthz_async(
+                mac,
+                no_duplicate_source=True,
+                source='radius-dot1x',
+                till_disconnect=True,
+                authentication_provider=authentication_provider,
+                login=login
         )
 
     if not authz:
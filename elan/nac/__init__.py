@@ -1,8 +1,16 @@
 import subprocess, datetime, re
+import asyncio
+import collections
+import hashlib
+import json
+import os
 import threading
+import time
 
 from elan import session
-from elan.neuron import Synapse, Dendrite
+from elan.async_synapse import AsyncSynapse
+from elan.event import ExceptionEvent
+from elan.neuron import AsyncDendrite, Synapse, Dendrite, RequestTimeout, conf_store
 
 AUTHORIZATION_CHANGE_TOPIC = 'nac/authz/change'  # notify that authz changed for mac
 
@@ -16,8 +24,16 @@ CHECK_AUTHZ_PATH = 'check-macs-authz'
 
 AUTHORIZATION_SESSION_TOPIC = 'session/authorization'
 
+# Decisions of control center are cached, see `enable_decision_cache`
+AUTHZ_DECISION_CACHE_TTL = float(os.environ.get('AUTHZ_DECISION_CACHE_TTL', 60))  # seconds
+AUTHZ_DECISION_CACHE_STALE = float(os.environ.get('AUTHZ_DECISION_CACHE_STALE', 3600))  # seconds
+AUTHZ_DECISION_CACHE_SIZE = int(os.environ.get('AUTHZ_DECISION_CACHE_SIZE', 10000))  # entries
+
 dendrite = Dendrite()
 synapse = Synapse()
+async_synapse = AsyncSynapse()  # for coroutines
+
+decision_cache = None  # see `enable_decision_cache`
 
 # Redis authorizations objects are set straight away, but opening of fw is async. (done by mac authz daemon)
 # mac authz daemon is also responsible for de authorizing mac on expiry
@@ -37,36 +53,70 @@ def newAuthz(mac, source, no_duplicate_source=False, **auth):
     return checkAuthz(mac)
 
 
-def checkAuthz(mac, remove_source=None, end_reason='overridden', **kwargs):
+async def newAuthz_async(mac, source, no_duplicate_source=False, **auth):
+    ''' Same as `newAuthz` for coroutines '''
+    if no_duplicate_source:
+        await session.remove_authentication_sessions_by_source_async(mac, source)
+
+    await session.add_authentication_session_async(mac, source=source, **auth)
+
+    return await checkAuthz_async(mac)
+
+
+def checkAuthz(mac, remove_source=None, end_reason='overridden', cached=True, **kwargs):
     '''
     Asks what Authorization should be granted to the mac, based on current authentications
     First, an authentication source can be removed using remove_source
+    If not `cached`, decision cache is bypassed.
     '''
     if remove_source is not None:
         session.remove_authentication_sessions_by_source(mac, remove_source)
 
-    assignments = get_network_assignments(mac)
+    assignments = get_network_assignments(mac, cached=cached)
+
+    if assignments:
+        authz = RedisMacAuthorization(mac=mac, **assignments)
+    else:
+        authz = None
+
+    old_authz, replaced = RedisMacAuthorization.replace(mac, authz)
+
+    return _authz_replaced(mac, authz, old_authz, replaced, end_reason, **kwargs)
+
 
-    old_authz = RedisMacAuthorization.getByMac(mac)
+async def checkAuthz_async(mac, remove_source=None, end_reason='overridden', cached=True, **kwargs):
+    '''
+    Same as `checkAuthz` for coroutines: control center and Redis are waited for without blocking the event loop.
+    '''
+    if remove_source is not None:
+        await session.remove_authentication_sessions_by_source_async(mac, remove_source)
+
+    assignments = await get_network_assignments_async(mac, cached=cached)
 
     if assignments:
         authz = RedisMacAuthorization(mac=mac, **assignments)
+    else:
+        authz = None
+
+    old_authz, replaced = await RedisMacAuthorization.replace_async(mac, authz)
+
+    return _authz_replaced(mac, authz, old_authz, replaced, end_reason, **kwargs)
+
 
-        if authz != old_authz:
-            if old_authz:
-                RedisMacAuthorization.deleteByMac(mac)
+def _authz_replaced(mac, authz, old_authz, replaced, end_reason, **kwargs):
+    ''' Notifies change of authorization if replaced, returns current one '''
+    if replaced:
+        authzChanged(mac)
+        if old_authz:
+            if authz:
                 notify_end_authorization_session(old_authz, reason=end_reason, **kwargs)
-            authz.save()
-            authzChanged(mac)
+            else:
+                notify_end_authorization_session(old_authz, reason='expired')
+        if authz:
             notify_new_authorization_session(authz)
-
         return authz
-    else:
-        if old_authz:
-            RedisMacAuthorization.deleteByMac(mac)
-            authzChanged(mac)
-            notify_end_authorization_session(old_authz, reason='expired')
-        return None
+
+    return old_authz
 
 
 def getAuthz(mac):
@@ -77,6 +127,13 @@ def getAuthz(mac):
     return checkAuthz(mac)
 
 
+def _access_control_by_vlan(vlans):
+    access_control = {}
+    for v in vlans or ():
+        access_control.setdefault((v['interface'], v['vlan_id']), v['access_control'])
+    return access_control
+
+
 def vlan_has_access_control(vlan):
     if '.' in vlan:
         interface, vlan_id = vlan.rsplit('.', 1)
@@ -85,9 +142,7 @@ def vlan_has_access_control(vlan):
         interface = vlan
         vlan_id = 0
 
-    for v in dendrite.get_conf('vlans') or []:
-        if v['interface'] == interface and v['vlan_id'] == vlan_id:
-            return v['access_control']
+    return conf_store.index('vlans', _access_control_by_vlan).get((interface, vlan_id), None)
 
 
 def authzChanged(mac):
@@ -97,16 +152,271 @@ def authzChanged(mac):
     dendrite.publish(AUTHORIZATION_CHANGE_TOPIC, mac)
 
 
-def get_network_assignments(mac, port=None, current_auth_sessions=None):
+def get_network_assignments(mac, port=None, current_auth_sessions=None, cached=True):
     if current_auth_sessions is None:
         current_auth_sessions = session.get_authentication_sessions(mac)
     if port is None:
         port = synapse.hget(session.MAC_PORT_PATH, mac)
 
-    return dendrite.call('device-authorization', {'auth_sessions': current_auth_sessions, 'mac': mac, 'port': port})
+    if decision_cache is not None:
+        return decision_cache.get_assignments(mac, port, current_auth_sessions, cached=cached)
+
+    return _get_network_assignments(mac, port, current_auth_sessions)
+
+
+async def get_network_assignments_async(mac, port=None, current_auth_sessions=None, cached=True):
+    ''' Same as `get_network_assignments` for coroutines '''
+    if current_auth_sessions is None:
+        current_auth_sessions = await session.get_authentication_sessions_async(mac)
+    if port is None:
+        port = await async_synapse.hget(session.MAC_PORT_PATH, mac)
+
+    if decision_cache is not None:
+        return await decision_cache.get_assignments_async(mac, port, current_auth_sessions, cached=cached)
+
+    return await _get_network_assignments_async(mac, port, current_auth_sessions)
+
+
+def _get_network_assignments(mac, port, auth_sessions):
+    return dendrite.call('device-authorization', {'auth_sessions': auth_sessions, 'mac': mac, 'port': port})
     # TODO: when CC unreachable or Error, retry in a few seconds (maybe use mac authz manager daemon for that)
 
 
+async def _get_network_assignments_async(mac, port, auth_sessions):
+    return await AsyncDendrite(dendrite).call('device-authorization', {'auth_sessions': auth_sessions, 'mac': mac, 'port': port})
+
+
+def enable_decision_cache(ttl=AUTHZ_DECISION_CACHE_TTL, stale=AUTHZ_DECISION_CACHE_STALE, max_size=AUTHZ_DECISION_CACHE_SIZE):
+    '''
+    Enables in-process cache of control center decisions, used by `get_network_assignments`.
+    Cache is invalidated on any configuration change, and decisions of a MAC when its authorization is changed or checked.
+    Returns the cache.
+    '''
+    global decision_cache
+
+    if decision_cache is None:
+        cache = DecisionCache(ttl=ttl, stale=stale, max_size=max_size)
+
+        def authz_changed(mac):
+            cache.invalidate_macs([mac])
+
+        # none of these may be dropped: a revoked decision would be kept
+        dendrite.subscribe(Dendrite.CONF_TOPIC_PREFIX + '#', cache.invalidate, block=True)
+        dendrite.subscribe(AUTHORIZATION_CHANGE_TOPIC, authz_changed, block=True)
+        dendrite.subscribe(CHECK_AUTHZ_PATH, cache.invalidate_macs, block=True)
+        decision_cache = cache
+
+    return decision_cache
+
+
+def disable_decision_cache():
+    global decision_cache
+
+    if decision_cache is not None:
+        for topic in (Dendrite.CONF_TOPIC_PREFIX + '#', AUTHORIZATION_CHANGE_TOPIC, CHECK_AUTHZ_PATH):
+            dendrite.unsubscribe(topic)
+        decision_cache = None
+
+
+class DecisionCache():
+    '''
+    LRU cache of network assignments decided by control center for (mac, port, authentication sessions).
+    Decisions are fresh for `ttl` seconds. After that, decisions granting access are only returned once control center confirms them.
+    Decisions denying access are returned for `stale` seconds more while being refreshed in background,
+    or later if control center does not answer in time.
+    '''
+
+    def __init__(self, ttl=AUTHZ_DECISION_CACHE_TTL, stale=AUTHZ_DECISION_CACHE_STALE, max_size=AUTHZ_DECISION_CACHE_SIZE):
+        self.ttl = ttl
+        self.stale = stale
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()  # key -> (assignments, fetch time)
+        self.refreshing = set()
+        self.generation = 0  # incremented on each invalidation: decisions fetched meanwhile are not cached
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def key(mac, port, auth_sessions):
+        sessions = sorted(json.dumps(auth_session, sort_keys=True) for auth_session in auth_sessions)
+        return mac, json.dumps(port, sort_keys=True), hashlib.sha1('\n'.join(sessions).encode()).hexdigest()
+
+    def add(self, key, assignments, fetched=None, generation=None):
+        if fetched is None:
+            fetched = time.monotonic()
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries[key] = (assignments, fetched)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get_assignments(self, mac, port, auth_sessions, cached=True):
+        key = self.key(mac, port, auth_sessions)
+        entry, usable = self._lookup(key, cached)
+        if usable == 'stale':
+            self.refresh(key, mac, port, auth_sessions)
+        if usable:
+            return entry[0]
+
+        try:
+            return self.fetch(key, mac, port, auth_sessions)
+        except RequestTimeout:
+            # a stale decision must not grant access
+            if entry is None or entry[0]:
+                raise
+            return entry[0]
+
+    async def get_assignments_async(self, mac, port, auth_sessions, cached=True):
+        ''' Same as `get_assignments` for coroutines '''
+        key = self.key(mac, port, auth_sessions)
+        entry, usable = self._lookup(key, cached)
+        if usable == 'stale':
+            self.refresh_async(key, mac, port, auth_sessions)
+        if usable:
+            return entry[0]
+
+        try:
+            return await self.fetch_async(key, mac, port, auth_sessions)
+        except RequestTimeout:
+            if entry is None or entry[0]:
+                raise
+            return entry[0]
+
+    def _lookup(self, key, cached):
+        '''
+        Returns entry of key (None if not cached) and whether it can be returned: 'fresh', 'stale' (to be refreshed) or None.
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        if entry is None or not cached:
+            return entry, None
+
+        assignments, fetched = entry
+        age = time.monotonic() - fetched
+        if age < self.ttl:
+            return entry, 'fresh'
+        if not assignments and age < self.ttl + self.stale:
+            return entry, 'stale'
+        return entry, None
+
+    def _fetching(self):
+        ''' Returns time and generation of a fetch about to start '''
+        with self.lock:
+            return time.monotonic(), self.generation
+
+    def fetch(self, key, mac, port, auth_sessions):
+        fetched, generation = self._fetching()
+        assignments = _get_network_assignments(mac, port, auth_sessions)
+        self.add(key, assignments, fetched, generation)
+        return assignments
+
+    async def fetch_async(self, key, mac, port, auth_sessions):
+        fetched, generation = self._fetching()
+        assignments = await _get_network_assignments_async(mac, port, auth_sessions)
+        self.add(key, assignments, fetched, generation)
+        return assignments
+
+    def _start_refresh(self, key):
+        ''' Returns False if key is already being refreshed '''
+        with self.lock:
+            if key in self.refreshing:
+                return False
+            self.refreshing.add(key)
+            return True
+
+    def _refreshed(self, key):
+        with self.lock:
+            self.refreshing.discard(key)
+
+    def refresh(self, key, mac, port, auth_sessions):
+        ''' Fetches decision in background, unless already being fetched '''
+        if not self._start_refresh(key):
+            return
+
+        def refresh():
+            try:
+                self.fetch(key, mac, port, auth_sessions)
+            except RequestTimeout:
+                pass
+            except Exception:
+                ExceptionEvent(source='nac').notify()
+            finally:
+                self._refreshed(key)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def refresh_async(self, key, mac, port, auth_sessions):
+        ''' Same as `refresh`, in a task of the event loop '''
+        if not self._start_refresh(key):
+            return
+
+        async def refresh():
+            try:
+                await self.fetch_async(key, mac, port, auth_sessions)
+            except RequestTimeout:
+                pass
+            except Exception:
+                ExceptionEvent(source='nac').notify()
+            finally:
+                self._refreshed(key)
+
+        asyncio.ensure_future(refresh())
+
+    def invalidate(self):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def invalidate_macs(self, macs):
+        macs = set(macs)
+        with self.lock:
+            self.generation += 1
+            for key in [key for key in self.entries if key[0] in macs]:
+                del self.entries[key]
+
+
+# Deletes authorization of a MAC only if it has expired (it may have been renewed since its expiry was scheduled).
+# KEYS: authorizations by mac, expiry. ARGV: mac, mac as expiry member (JSON encoded), now (epoch).
+# Returns deleted authorization, or '' if none has expired.
+_delete_expired_authz_script = synapse.register_script('''
+local expiry = redis.call('ZSCORE', KEYS[2], ARGV[2])
+if not expiry or tonumber(expiry) > tonumber(ARGV[3]) then
+    return ''
+end
+local authz = redis.call('HGET', KEYS[1], ARGV[1]) or ''
+redis.call('HDEL', KEYS[1], ARGV[1])
+redis.call('ZREM', KEYS[2], ARGV[2])
+return authz
+''')
+
+
+# Compare and set of authorization of a MAC.
+# KEYS: authorizations by mac, expiry.
+# ARGV: mac, expected authorization ('' if none), new authorization ('' to delete it), its expiry, mac as expiry member (JSON encoded).
+# Returns {1, ''} if replaced, or {0, current authorization ('' if none)} if it is not the expected one.
+_replace_authz_script = synapse.register_script('''
+local current = redis.call('HGET', KEYS[1], ARGV[1]) or ''
+if current ~= ARGV[2] then
+    return {0, current}
+end
+if ARGV[3] == '' then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('ZREM', KEYS[2], ARGV[5])
+else
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+    redis.call('ZADD', KEYS[2], ARGV[4], ARGV[5])
+end
+return {1, ''}
+''')
+
+
 def tzaware_datetime_to_epoch(dt):
     return (dt - datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)).total_seconds()
 
@@ -135,72 +445,211 @@ def notify_end_authorization_session(authz, reason, end=None, **kwargs):
 
 
 class RedisMacAuthorization(object):
+    '''
+    Authorization of a MAC. Apart from `local_id`, set when saved, authorizations are not meant to be modified.
+    Parameters other than the known ones are kept in `extras` and can be read as attributes.
+    '''
+    __slots__ = ('mac', 'assign_vlan', 'allow_on', 'bridge_to', 'till_disconnect', 'till', 'extras', 'fingerprint', '_hash', '_local_id', '_serialized')
 
     def __init__(self, mac, assign_vlan, allow_on, bridge_to, till_disconnect, till=None, local_id=None, **kwargs):
-        self.local_id = local_id  # local_id is mainly used for sync with CC. we find current sessions by mac
+        self._local_id = local_id  # local_id is mainly used for sync with CC. we find current sessions by mac
+        self._serialized = None
         self.mac = mac
         self.assign_vlan = assign_vlan
-        self.allow_on = set(allow_on)
-        self.bridge_to = set(bridge_to)
+        self.allow_on = frozenset(allow_on)
+        self.bridge_to = frozenset(bridge_to)
         self.till_disconnect = till_disconnect
         self.till = till
-
-        for key in kwargs:
-            setattr(self, key, kwargs[key])
+        self.extras = kwargs
+
+        # everything but mac and local_id, as we may want to compare authz of 2 macs
+        self.fingerprint = (
+                assign_vlan, tuple(sorted(self.allow_on)), tuple(sorted(self.bridge_to)), till_disconnect, till,
+                json.dumps(kwargs, sort_keys=True)
+        )
+        self._hash = hash(self.fingerprint)
+
+    def __getattr__(self, name):
+        if name != 'extras':
+            try:
+                return self.extras[name]
+            except KeyError:
+                pass
+        raise AttributeError(name)
+
+    @property
+    def local_id(self):
+        return self._local_id
+
+    @local_id.setter
+    def local_id(self, local_id):
+        self._local_id = local_id
+        self._serialized = None
 
     def __eq__(self, other):
         ''' Equality if all params match excluding mac and local_id. mac because we may want to compare authz of 2 macs'''
-        if not isinstance(other, RedisMacAuthorization) or self.__dict__.keys() != other.__dict__.keys():
+        if not isinstance(other, RedisMacAuthorization):
             return False
-
-        for key in set(self.__dict__.keys()) - {'mac', 'local_id'}:
-            if getattr(self, key) != getattr(other, key):
-                return False
-
-        return True
+        return self._hash == other._hash and self.fingerprint == other.fingerprint
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def __hash__(self):
+        return self._hash
+
     def save(self):
-        if self.local_id is None:
-            self.local_id = synapse.get_unique_id(AUTHZ_SESSIONS_SEQUENCE_PATH)
+        self.save_many([self])
 
+    @property
+    def expiry(self):
+        ''' score of authorization in expiry sorted set '''
         if self.till is None:
-            till = float('+inf')
-        else:
-            till = self.till
+            return float('+inf')
+        return self.till
 
-        pipe = synapse.pipeline()
-        pipe.zadd(AUTHZ_MAC_EXPIRY_PATH, till, self.mac)
+    def serialize(self):
+        ''' Returns authorization as a dict. Serialization is done once, a copy is returned '''
+        if self._serialized is None:
+            data = dict(self.extras)
+            data.update(
+                    local_id=self.local_id,
+                    mac=self.mac,
+                    assign_vlan=self.assign_vlan,
+                    # sets are not serialializable, serialize them as lists
+                    allow_on=list(self.fingerprint[1]),
+                    bridge_to=list(self.fingerprint[2]),
+                    till_disconnect=self.till_disconnect,
+                    till=self.till,
+            )
+            self._serialized = data
+
+        return self._serialized.copy()
 
-        pipe.hset(AUTHZ_SESSIONS_BY_MAC_PATH, self.mac, self.serialize())
+    @classmethod
+    def _add_to_pipeline(cls, pipe, authzs):
+        for authz in authzs:
+            pipe.zadd(AUTHZ_MAC_EXPIRY_PATH, authz.expiry, authz.mac)
+        pipe.hmset(AUTHZ_SESSIONS_BY_MAC_PATH, {authz.mac: authz.serialize() for authz in authzs})
+
+    @classmethod
+    def _allocate_local_ids(cls, authzs):
+        authzs = [authz for authz in authzs if authz.local_id is None]
+        if authzs:
+            last_id = synapse.incrby(AUTHZ_SESSIONS_SEQUENCE_PATH, len(authzs))
+            for local_id, authz in enumerate(authzs, last_id - len(authzs) + 1):
+                authz.local_id = local_id
+
+    @classmethod
+    def save_many(cls, authzs):
+        ''' Saves authorizations in one transaction '''
+        authzs = list(authzs)
+        if not authzs:
+            return
+
+        cls._allocate_local_ids(authzs)
+
+        pipe = synapse.pipeline()
+        cls._add_to_pipeline(pipe, authzs)
         pipe.execute()
 
-    def serialize(self):
-        data = self.__dict__.copy()
-        # sets are not serialializable, serialize them as lists
-        data['allow_on'] = list(data['allow_on'])
-        data['bridge_to'] = list(data['bridge_to'])
+    @classmethod
+    def replace(cls, mac, new):
+        '''
+        Atomically replaces current authorization of mac by `new` (None to delete it), unless they are equal.
+        Returns (current authorization, True if it has been replaced)
+        '''
+        current = None
+        # first run only reads current authorization: '?' is never stored
+        args = cls._replace_args(mac, '?', None)
+        while True:
+            replaced, stored = _replace_authz_script(keys=[AUTHZ_SESSIONS_BY_MAC_PATH, AUTHZ_MAC_EXPIRY_PATH], args=args)
+            if replaced:
+                return current, True
+
+            # changed meanwhile (or first run): compare again
+            current = cls(**synapse.deserialize(stored)) if stored else None
+            if new == current or (new is None and current is None):
+                return current, False
+
+            if new is not None and new.local_id is None:
+                cls._allocate_local_ids([new])
+
+            args = cls._replace_args(mac, stored, new)
 
-        return data
+    @classmethod
+    async def replace_async(cls, mac, new):
+        ''' Same as `replace` for coroutines '''
+        current = None
+        args = cls._replace_args(mac, '?', None)
+        while True:
+            replaced, stored = await async_synapse.run_script(_replace_authz_script, keys=[AUTHZ_SESSIONS_BY_MAC_PATH, AUTHZ_MAC_EXPIRY_PATH], args=args)
+            if replaced:
+                return current, True
+
+            current = cls(**synapse.deserialize(stored)) if stored else None
+            if new == current or (new is None and current is None):
+                return current, False
+
+            if new is not None and new.local_id is None:
+                last_id = await async_synapse.incr(AUTHZ_SESSIONS_SEQUENCE_PATH)
+                new.local_id = last_id
+
+            args = cls._replace_args(mac, stored, new)
+
+    @staticmethod
+    def _replace_args(mac, expected, new):
+        ''' Returns args of `_replace_authz_script` '''
+        if new is None:
+            return [mac, expected, '', 0, synapse.serialize(mac)]
+        return [mac, expected, synapse.serialize(new.serialize()), new.expiry, synapse.serialize(mac)]
+
+    @classmethod
+    def get_many(cls, macs):
+        ''' Returns authorizations of macs, None for macs without one '''
+        if not macs:
+            return []
+        return [cls(**authz_session) if authz_session is not None else None for authz_session in synapse.hmget(AUTHZ_SESSIONS_BY_MAC_PATH, macs)]
+
+    @classmethod
+    def iter_all(cls, count=1000):
+        ''' Iterates over all authorizations, without blocking Redis '''
+        for _mac, authz_session in synapse.hscan_iter(AUTHZ_SESSIONS_BY_MAC_PATH, count=count):
+            yield cls(**authz_session)
 
     @classmethod
     def deleteByMac(cls, mac):
+        return cls.deleteByMacs([mac])[0]
+
+    @classmethod
+    def deleteByMacs(cls, macs):
+        ''' Deletes authorizations of macs in one transaction. Returns deleted authorizations, None for macs without one '''
+        if not macs:
+            return []
+
         pipe = synapse.pipeline()
-        pipe.hget(AUTHZ_SESSIONS_BY_MAC_PATH, mac)
-        pipe.zrem(AUTHZ_MAC_EXPIRY_PATH, mac)
-        pipe.hdel(AUTHZ_SESSIONS_BY_MAC_PATH, mac)
+        for mac in macs:
+            pipe.hget(AUTHZ_SESSIONS_BY_MAC_PATH, mac)
+            pipe.zrem(AUTHZ_MAC_EXPIRY_PATH, mac)
+            pipe.hdel(AUTHZ_SESSIONS_BY_MAC_PATH, mac)
         result = pipe.execute()
-        authz_session = result[0]
 
-        if authz_session is not None:
-            return cls(**authz_session)
+        return [cls(**authz_session) if authz_session is not None else None for authz_session in result[::3]]
 
     @classmethod
-    def getByMac(cls, mac):
-        auth_session = synapse.hget(AUTHZ_SESSIONS_BY_MAC_PATH, mac)
+    def deleteIfExpired(cls, mac, now=None):
+        '''
+        Atomically deletes authorization of mac if it has expired at `now` (epoch). Returns deleted authorization, or None.
+        '''
+        if now is None:
+            now = time.time()
+        authz_session = _delete_expired_authz_script(
+                keys=[AUTHZ_SESSIONS_BY_MAC_PATH, AUTHZ_MAC_EXPIRY_PATH],
+                args=[mac, synapse.serialize(mac), now]
+        )
+        return cls(**synapse.deserialize(authz_session)) if authz_session else None
 
-        if auth_session is not None:
-            return cls(**auth_session)
+    @classmethod
+    def getByMac(cls, mac):
+        return cls.get_many([mac])[0]
 
@@ -1,42 +1,244 @@
-import datetime
-import subprocess, threading
+import collections
+import heapq
+import os
+import threading
+import time
 
+from elan.event import DebugEvent, ExceptionEvent
 from elan.neuron import Synapse, Dendrite
+from elan.nft import element_commands, get_nft, NftError
 
-from . import AUTHZ_MAC_EXPIRY_PATH
-from . import RedisMacAuthorization, notify_end_authorization_session, checkAuthz, tzaware_datetime_to_epoch
+from . import RedisMacAuthorization, notify_end_authorization_session, checkAuthz
 from .. import session
 
+# MACs whose authorization changed are processed by a pool of workers
+MAC_AUTHZ_WORKERS = int(os.environ.get('MAC_AUTHZ_WORKERS', 4))
+MAC_AUTHZ_QUEUE_SIZE = int(os.environ.get('MAC_AUTHZ_QUEUE_SIZE', 10000))  # MACs
+
+
+class CoalescingQueue():
+    '''
+    Queue of keys processed by a pool of worker threads calling `handler(key, flags)`.
+    A key put several times before being processed is processed once, with all flags it was put with.
+    A key is never processed by 2 workers at the same time.
+    `put` blocks while `max_size` keys are pending.
+    '''
+
+    def __init__(self, handler, workers=MAC_AUTHZ_WORKERS, max_size=MAC_AUTHZ_QUEUE_SIZE, source='coalescing-queue'):
+        self.handler = handler
+        self.max_size = max_size
+        self.source = source
+
+        self.pending = collections.OrderedDict()  # key -> flags
+        self.running = set()
+        self.condition = threading.Condition()
+
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def put(self, key, *flags):
+        with self.condition:
+            while key not in self.pending and len(self.pending) >= self.max_size:
+                self.condition.wait()
+            self.pending.setdefault(key, set()).update(flags)
+            self.condition.notify_all()
+
+    def get(self):
+        '''
+        Returns next (key, flags) not being processed, waiting for one if needed.
+        '''
+        with self.condition:
+            while True:
+                for key in self.pending:
+                    if key not in self.running:
+                        flags = self.pending.pop(key)
+                        self.running.add(key)
+                        self.condition.notify_all()
+                        return key, flags
+                self.condition.wait()
+
+    def done(self, key):
+        with self.condition:
+            self.running.discard(key)
+            self.condition.notify_all()
+
+    def work(self):
+        while True:
+            key, flags = self.get()
+            try:
+                self.handler(key, flags)
+            except Exception:
+                ExceptionEvent(source=self.source)\
+                     .add_data('key', key)\
+                     .notify()
+            finally:
+                self.done(key)
+
+    def wait_idle(self, timeout=None):
+        '''
+        Waits until all keys have been processed. Returns False on timeout.
+        '''
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.running, timeout)
+
+
+class ExpiryScheduler():
+    '''
+    Thread calling `on_expired(keys)` with keys whose expiry date (epoch) has been reached.
+    Keys that are due at the same time are expired together.
+    '''
+
+    def __init__(self, on_expired, source='expiry-scheduler'):
+        self.on_expired = on_expired
+        self.source = source
+
+        self.expiries = {}  # key -> expiry
+        self.heap = []  # (expiry, key), entries with another expiry than `expiries` are obsolete
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    def schedule(self, key, expiry):
+        ''' Schedules expiry of key, replacing any previous one. Expiry None or infinite unschedules key '''
+        with self.condition:
+            if expiry is None or expiry == float('inf'):
+                self.expiries.pop(key, None)
+                return
+            if self.expiries.get(key) == expiry:
+                return
+            self.expiries[key] = expiry
+            heapq.heappush(self.heap, (expiry, key))
+            self.condition.notify()
+
+    def unschedule(self, key):
+        self.schedule(key, None)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def pop_due(self):
+        '''
+        Waits for keys to be due and returns them, or None when stopped.
+        '''
+        with self.condition:
+            while not self.stopped:
+                while self.heap and self.expiries.get(self.heap[0][1]) != self.heap[0][0]:
+                    heapq.heappop(self.heap)
+
+                now = time.time()
+                if self.heap and self.heap[0][0] <= now:
+                    due = []
+                    while self.heap and self.heap[0][0] <= now:
+                        expiry, key = heapq.heappop(self.heap)
+                        if self.expiries.get(key) == expiry:
+                            del self.expiries[key]
+                            due.append(key)
+                    return due
+
+                self.condition.wait(self.heap[0][0] - now if self.heap else None)
+
+    def run(self):
+        while True:
+            due = self.pop_due()
+            if due is None:
+                return
+            if due:
+                try:
+                    self.on_expired(due)
+                except Exception:
+                    ExceptionEvent(source=self.source)\
+                         .add_data('keys', due)\
+                         .notify()
+
 
 class MacAuthorizationManager():
     ''' Class to manage FW authz of Macs
         It also provides a service to check Authz of Macs when something has changed (Tags, ...)
     '''
 
-    def __init__(self, dendrite=None):
+    def __init__(self, dendrite=None, nft=None):
         if dendrite is None:
             self.dendrite = Dendrite()
+        if nft is None:
+            nft = get_nft()
+        self.nft = nft
 
         self.fw_mac_allowed_vlans = {}
         self.fw_mac_bridged_vlans = {}
+        self.fw_lock = threading.Lock()
 
         self.dendrite = dendrite
         self.synapse = Synapse()
 
-        self.next_check = None
-        self.check_authz_sema = threading.BoundedSemaphore()
-
-        self.check_expired_authz()
+        self.queue = CoalescingQueue(self.process_mac, source='mac-authz-manager')
 
+        self.expiry = ExpiryScheduler(self.expire_authz, source='mac-authz-manager')
         self.init_macs()
+        self.expiry.start()
 
     def init_macs(self):
-        # on startup, initialize sets
-        # TODO: this should get vlans from network conf to flush nft sets and it should use fw_allow mac for each. Even if it is not in a transaction and not very efficient, it is OK as this should not restart often (TODO when flush sets works...)
-        for mac in self.synapse.zmembers(AUTHZ_MAC_EXPIRY_PATH):
-            authz = RedisMacAuthorization.getByMac(mac)
-            if authz:
-                self.fw_allow_mac(mac, on=authz.allow_on, to=authz.bridge_to)
+        '''
+        On startup, reconciles nft sets with current authorizations: authorizations and set elements are read in bulk
+        and differences are applied in a single nft batch.
+        Expiry of authorizations is scheduled, expired ones are not allowed.
+        '''
+        start = time.monotonic()
+        now = time.time()
+
+        allow_on = {}
+        bridge_to = {}
+        for authz in RedisMacAuthorization.iter_all():
+            mac = authz.mac
+            self.expiry.schedule(mac, authz.till)
+            if authz.till is not None and authz.till <= now:
+                continue
+            if authz.allow_on:
+                allow_on[mac] = authz.allow_on
+            if authz.bridge_to:
+                bridge_to[mac] = authz.bridge_to
+
+        wanted_on = {(mac, vlan) for mac, vlans in allow_on.items() for vlan in vlans}
+        wanted_to = {(mac, vlan) for mac, vlans in bridge_to.items() for vlan in vlans}
+        with self.fw_lock:
+            try:
+                current_on = self.nft.list_elements('mac_on_vlan')
+                current_to = self.nft.list_elements('mac_to_vlan')
+            except NftError:
+                # Can not know what is in sets: just add authorized ones
+                ExceptionEvent(source='mac-authz-manager').notify()
+                current_on = set()
+                current_to = set()
+
+            del_on = current_on - wanted_on
+            add_on = wanted_on - current_on
+            del_to = current_to - wanted_to
+            add_to = wanted_to - current_to
+
+            self.nft.run(
+                    element_commands('delete', 'mac_on_vlan', sorted(del_on))
+                    + element_commands('add', 'mac_on_vlan', sorted(add_on))
+                    + element_commands('delete', 'mac_to_vlan', sorted(del_to))
+                    + element_commands('add', 'mac_to_vlan', sorted(add_to))
+            )
+
+            self.fw_mac_allowed_vlans = allow_on
+            self.fw_mac_bridged_vlans = bridge_to
+
+        DebugEvent(source='mac-authz-manager', event_type='fw-reconciled')\
+             .add_data('authorizations', len(set(allow_on) | set(bridge_to)))\
+             .add_data('added', len(add_on) + len(add_to))\
+             .add_data('deleted', len(del_on) + len(del_to))\
+             .add_data('duration', time.monotonic() - start)\
+             .notify()
 
     def removeAuthz(self, mac, reason, authz=None):
         if authz is None:
@@ -49,73 +251,50 @@ class MacAuthorizationManager():
         return authz
 
     def fw_allowed_vlans(self, mac):
-        return self.fw_mac_allowed_vlans.get(mac, set())
-
-    def _fw_cache_allow_on_del(self, mac, vlan):
-        vlans = self.fw_mac_allowed_vlans.get(mac, None)
-        if vlans:
-            vlans.remove(vlan)
-            if not vlans:
-                del self.fw_mac_allowed_vlans[mac]
-
-    def _fw_cache_allow_on_add(self, mac, vlan):
-        vlans = self.fw_mac_allowed_vlans.get(mac, None)
-        if vlans:
-            vlans.add(vlan)
-        else:
-            self.fw_mac_allowed_vlans[mac] = {vlan}
+        return self.fw_mac_allowed_vlans.get(mac, frozenset())
 
     def fw_bridged_vlans(self, mac):
-        return self.fw_mac_bridged_vlans.get(mac, set())
+        return self.fw_mac_bridged_vlans.get(mac, frozenset())
 
-    def _fw_cache_bridge_to_del(self, mac, vlan):
-        vlans = self.fw_mac_bridged_vlans.get(mac, None)
+    @staticmethod
+    def _fw_cache_set(cache, mac, vlans):
         if vlans:
-            vlans.remove(vlan)
-            if not vlans:
-                del self.fw_mac_bridged_vlans[mac]
-
-    def _fw_cache_bridge_to_add(self, mac, vlan):
-        vlans = self.fw_mac_bridged_vlans.get(mac, None)
-        if vlans:
-            vlans.add(vlan)
+            cache[mac] = vlans
         else:
-            self.fw_mac_bridged_vlans[mac] = {vlan}
+            cache.pop(mac, None)
 
     def fw_allow_mac(self, mac, on=None, to=None):
         "Opens access on the vlan ids specified an closes all the others, if any"
-        if on is None:
-            on = set()
-        if to is None:
-            to = set()
-
-        # TODO: use nft from pyroute2 when ready
-        with subprocess.Popen(['nft', '-i'], stdin=subprocess.PIPE, universal_newlines=True, stdout=subprocess.DEVNULL) as nft_process:
-
-            def nft(cmd):
-                print(cmd, file=nft_process.stdin, flush=True)
-
-                if cmd == 'quit':
-                    try:
-                        nft_process.wait(2)
-                    except subprocess.TimeoutExpired:
-                        pass
-
-            for vlan in self.fw_allowed_vlans(mac) - set(on):
-                self._fw_cache_allow_on_del(mac, vlan)
-                nft('delete element bridge elan mac_on_vlan {{ {mac} . {vlan} }}'.format(vlan=vlan, mac=mac))
-            for vlan in set(on) - self.fw_allowed_vlans(mac):
-                self._fw_cache_allow_on_add(mac, vlan)
-                nft('add element bridge elan mac_on_vlan {{ {mac} . {vlan} }}'.format(vlan=vlan, mac=mac))
-
-            for vlan in self.fw_bridged_vlans(mac) - set(to):
-                self._fw_cache_bridge_to_del(mac, vlan)
-                nft('delete element bridge elan mac_to_vlan {{ {mac} . {vlan} }}'.format(vlan=vlan, mac=mac))
-            for vlan in set(to) - self.fw_bridged_vlans(mac):
-                self._fw_cache_bridge_to_add(mac, vlan)
-                nft('add element bridge elan mac_to_vlan {{ {mac} . {vlan} }}'.format(vlan=vlan, mac=mac))
-
-            nft('quit')
+        self.fw_allow_macs([(mac, on, to)])
+
+    def fw_allow_macs(self, authorizations):
+        '''
+        Same as fw_allow_mac for (mac, on, to) of `authorizations`, applied in a single nft batch.
+        '''
+        with self.fw_lock:
+            allowed = []
+            add_on, del_on, add_to, del_to = [], [], [], []
+            for mac, on, to in authorizations:
+                # frozensets of authorizations are kept as is
+                on = frozenset() if on is None else frozenset(on)
+                to = frozenset() if to is None else frozenset(to)
+                allowed.append((mac, on, to))
+
+                del_on.extend((mac, vlan) for vlan in self.fw_allowed_vlans(mac) - on)
+                add_on.extend((mac, vlan) for vlan in on - self.fw_allowed_vlans(mac))
+                del_to.extend((mac, vlan) for vlan in self.fw_bridged_vlans(mac) - to)
+                add_to.extend((mac, vlan) for vlan in to - self.fw_bridged_vlans(mac))
+
+            self.nft.run(
+                    element_commands('delete', 'mac_on_vlan', del_on)
+                    + element_commands('add', 'mac_on_vlan', add_on)
+                    + element_commands('delete', 'mac_to_vlan', del_to)
+                    + element_commands('add', 'mac_to_vlan', add_to)
+            )
+
+            for mac, on, to in allowed:
+                self._fw_cache_set(self.fw_mac_allowed_vlans, mac, on)
+                self._fw_cache_set(self.fw_mac_bridged_vlans, mac, to)
 
     def fw_disallow_mac(self, mac):
         '''
@@ -127,52 +306,49 @@ class MacAuthorizationManager():
     def authzChanged(self, mac):
         authz = RedisMacAuthorization.getByMac(mac)
         if authz:
+            self.expiry.schedule(mac, authz.till)
             self.fw_allow_mac(mac, on=authz.allow_on, to=authz.bridge_to)
         else:
+            self.expiry.unschedule(mac)
             self.fw_disallow_mac(mac)
 
     def handle_authz_changed(self, mac):
-        self.authzChanged(mac)
-        # Check if authz have expired and set correct timeout
-        self.check_expired_authz()
+        self.queue.put(mac, 'changed')
 
     def handle_disconnection(self, mac):
-        authz = RedisMacAuthorization.getByMac(mac)
-        if authz and authz.till_disconnect:
-            self.removeAuthz(mac, reason='disconnected', authz=authz)
-            self.authzChanged(mac)
-
-        # Check if authz have expired and set correct timeout
-        self.check_expired_authz()
-
-    def check_expired_authz(self):
-        if self.next_check:
-            self.next_check.cancel()
+        self.queue.put(mac, 'disconnected')
 
-        with self.check_authz_sema:
-            now = tzaware_datetime_to_epoch(datetime.datetime.now(datetime.timezone.utc))
-            for mac in self.synapse.zrangebyscore(AUTHZ_MAC_EXPIRY_PATH, float('-inf'), now):
-                self.removeAuthz(mac, reason='expired')
-                self.check_authz([mac])
+    def check_authz(self, macs):
+        for mac in macs:
+            self.queue.put(mac, 'check')
 
-            self.schedule_next_expiry_check()
+    def process_mac(self, mac, events):
+        '''
+        Processes events (expired, changed, disconnected, check) received for mac since it was last processed.
+        '''
+        if 'expired' in events:
+            # it may have been renewed since its expiry was scheduled: only the expired one is deleted
+            authz = RedisMacAuthorization.deleteIfExpired(mac)
+            if authz:
+                notify_end_authorization_session(authz, reason='expired')
+                events.add('check')  # Maybe it should get a new authorization
+            events.add('changed')  # firewall and expiry follow what is stored
 
-    def schedule_next_expiry_check(self):
-        # get next mac to expire
-        next_expiry_date = float('inf')
-        for _mac, epoch_expire in self.synapse.zrange(AUTHZ_MAC_EXPIRY_PATH, 0, 0, withscores=True):  # returns first mac to expire: will iterate at most once
-            if next_expiry_date > epoch_expire:
-                next_expiry_date = epoch_expire
+        if 'check' in events and session.is_online(mac):
+            checkAuthz(mac, cached=False)  # will notify if authz changed
 
-        # set timeout for next check
-        if next_expiry_date != float('inf'):
-            now = tzaware_datetime_to_epoch(datetime.datetime.now(datetime.timezone.utc))
-            self.next_check = threading.Timer(next_expiry_date - now, self.check_expired_authz)
-            self.next_check.start()
+        if 'disconnected' in events:
+            authz = RedisMacAuthorization.getByMac(mac)
+            if authz and authz.till_disconnect:
+                self.removeAuthz(mac, reason='disconnected', authz=authz)
+                events.add('changed')
 
-    def check_authz(self, macs):
-            for mac in macs:
-                if session.is_online(mac):
-                    thread = threading.Thread(target=checkAuthz, args=(mac,))
-                    thread.run()
+        if 'changed' in events:
+            self.authzChanged(mac)
 
+    def expire_authz(self, macs):
+        '''
+        Queues expiry of macs: it is processed with other events of the mac, see `process_mac`.
+        '''
+        for mac in macs:
+            self.queue.put(mac, 'expired')
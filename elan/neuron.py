@@ -1,10 +1,15 @@
 from paho.mqtt import publish
+import asyncio
+import collections
 import concurrent.futures
 import inspect
 import json
+import os
+import queue
 import re
 import threading
 import time
+import types
 import uuid
 
 import serialized_redis
@@ -20,6 +25,10 @@ AXON_CALLS = 'axon:calls:{name}'
 CALL_TIMEOUT = 60  # seconds
 SYNC_CALL_TIMEOUT = 40  # seconds
 
+# Subscription callbacks are run by a pool of threads per subscription, fed by a bounded queue.
+DENDRITE_WORKERS = int(os.environ.get('DENDRITE_WORKERS', 4))  # threads per subscription
+DENDRITE_QUEUE_SIZE = int(os.environ.get('DENDRITE_QUEUE_SIZE', 10000))  # messages waiting per subscription
+
 
 def wait_for_synapse_ready(synapse=None, verbose=False):
     if synapse is None:
@@ -98,6 +107,101 @@ class RequestError(Exception):
         return self.args[1] or str(self.args[0])
 
 
+class Dispatcher():
+    '''
+    Runs `run(data, topic)` for messages of a subscription in a pool of `workers` threads, started on first message.
+    Messages wait in a queue of at most `max_size` messages: when full, the caller waits for room
+    (backpressure on the MQTT network loop, no answer of `call` or `get` can be received meanwhile),
+    or, if not `block`, new messages are dropped (and counted): only for topics where losing a message is harmless (telemetry...).
+    If `key` is given, `key(data)` is computed for each message: messages with same key are run one at a time, in order.
+    '''
+
+    def __init__(self, run, workers=DENDRITE_WORKERS, max_size=DENDRITE_QUEUE_SIZE, key=None, block=True):
+        self.run = run
+        self.workers = workers
+        self.key = key
+        self.block = block
+        if key is None:
+            self.queues = [queue.Queue(max_size)]
+        else:
+            # one queue per worker, a key always goes to same queue
+            self.queues = [queue.Queue(max(1, max_size // workers)) for _ in range(workers)]
+
+        self.lock = threading.Lock()
+        self.threads = []
+        self.processed = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for index in range(self.workers):
+                thread = threading.Thread(target=self.work, args=(self.queues[index % len(self.queues)],), daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        '''
+        Stops workers once messages already queued are processed.
+        '''
+        with self.lock:
+            threads = self.threads
+            self.threads = []
+        for index in range(len(threads)):
+            self.queues[index % len(self.queues)].put(None)
+
+    def dispatch(self, data, topic):
+        '''
+        Queues message for workers. Returns False if it has been dropped.
+        '''
+        if not self.threads:
+            self.start()
+
+        q = self.queues[0]
+        if self.key is not None:
+            try:
+                key = self.key(data)
+            except Exception:
+                key = None
+            q = self.queues[hash(key) % len(self.queues)]
+
+        try:
+            q.put((data, topic), block=self.block)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+
+        depth = self.depth()
+        if depth > self.max_depth:
+            self.max_depth = depth
+        return True
+
+    def work(self, q):
+        while True:
+            message = q.get()
+            if message is None:
+                return
+            self.run(*message)
+            with self.lock:
+                self.processed += 1
+
+    def depth(self):
+        ''' number of messages waiting to be processed '''
+        return sum(q.qsize() for q in self.queues)
+
+    def stats(self):
+        return {
+                'depth': self.depth(),
+                'max_depth': self.max_depth,
+                'processed': self.processed,
+                'dropped': self.dropped,
+                'workers': len(self.threads),
+        }
+
+
 class  Dendrite(mqtt.Client):
     '''
         Dendrite is used to retrieve configuration (and configuration updates), declare what RPC are processed by the calling module and make RPC calls
@@ -106,7 +210,7 @@ class  Dendrite(mqtt.Client):
         Use class method publish_single for a single publish. This will connect, publish and disconnect and will be blocking.
 
         When using instance:
-        - all callbacks are executed in an other thread.
+        - all callbacks are executed in an other thread, by a pool of threads per subscription (see `Dispatcher`).
         - calls are non blocking (publish will happen in another thread)
 
     '''
@@ -124,6 +228,14 @@ class  Dendrite(mqtt.Client):
 
     def __init__(self):
         self.topics = set()
+        self.dispatchers = {}
+
+        # RPC answers are received on one subscription per service: service/answers/{service}/{answers_id}/+
+        self.answers_id = uuid.uuid4().hex
+        self.answers_lock = threading.Lock()
+        self.answers_subscribed = {}  # futures resolved when subscription to answers of service is acknowledged, by service
+        self.suback_waiters = {}  # futures to resolve, by subscribe message id
+        self.pending_calls = {}  # futures of answers, by request id
         super().__init__()
 
         self.connect_async(self.MQTT_HOST, self.MQTT_PORT)
@@ -144,8 +256,19 @@ class  Dendrite(mqtt.Client):
         self.loop_stop()
 
     def on_connect(self, mqttc, obj, flags, rc):
-        if self.topics:
-            self._subscribe([ (topic, 1) for topic in self.topics ])
+        with self.answers_lock:
+            if self.topics:
+                result, mid = self._subscribe([ (topic, 1) for topic in self.topics ])
+                waiters = [subscribed for subscribed in self.answers_subscribed.values() if not subscribed.done()]
+                if mid is not None and waiters:
+                    self.suback_waiters[mid] = waiters
+
+    def on_subscribe(self, mqttc, obj, mid, granted_qos):
+        with self.answers_lock:
+            waiters = self.suback_waiters.pop(mid, [])
+        for subscribed in waiters:
+            if not subscribed.done():
+                subscribed.set_result(True)
 
     def _call_fn_with_good_arg_nb(self, fn, *args):
         nb_args = len(inspect.signature(fn).parameters)
@@ -160,21 +283,26 @@ class  Dendrite(mqtt.Client):
         except:
             event.ExceptionEvent(source=source).notify()
 
-    def _subscribe_cb_wrapper(self, fn):
+    def _subscribe_cb_wrapper(self, dispatch):
 
         def wrapper(mqttc, userdata, message):
             if message.payload:
                 data = json.loads(message.payload.decode())
             else:
                 data = None
-            # start in a Thread so we can call again some function like call and get from callbacks
-            # (or else they are all run in same thread (paho mqtt impementation),
-            # so any other callback is not called until cb finished)
-            task = threading.Thread(target=self._run_and_notifify_exceptions, args=(fn, data, message.topic), kwargs={'source': 'dendrite-subscribe-cb'})
-            task.start()
+            dispatch(data, message.topic)
 
         return wrapper
 
+    def _dispatcher(self, fn, **kwargs):
+        # run by worker threads so we can call again some function like call and get from callbacks
+        # (or else they are all run in same thread (paho mqtt impementation),
+        # so any other callback is not called until cb finished)
+        def run(data, topic):
+            self._run_and_notifify_exceptions(fn, data, topic, source='dendrite-subscribe-cb')
+
+        return Dispatcher(run, **kwargs)
+
     def _subscribe_conf_cb_wrapper(self, fn):
 
         def wrapper(data, topic):
@@ -199,21 +327,53 @@ class  Dendrite(mqtt.Client):
 
         return wrapper
 
-    def subscribe(self, topic, cb):
-        self.topics.add(topic)
-        self.message_callback_add(topic, self._subscribe_cb_wrapper(cb))
+    def subscribe(self, topic, cb, workers=DENDRITE_WORKERS, max_queue=DENDRITE_QUEUE_SIZE, key=None, block=True):
+        '''
+        Subscribes to topic: callback is run for each message, by a pool of `workers` threads.
+        At most `max_queue` messages wait for a worker, see `Dispatcher` for `key` (per key ordering) and `block`.
+        '''
+        dispatcher = self._dispatcher(cb, workers=workers, max_size=max_queue, key=key, block=block)
+        self._add_callback(topic, dispatcher.dispatch)
+        previous = self.dispatchers.pop(topic, None)
+        if previous is not None:
+            previous.stop()
+        self.dispatchers[topic] = dispatcher
         return self._subscribe(topic)
 
+    def _subscribe_inline(self, topic, cb):
+        '''
+        Subscribes with a callback run in the network loop thread: it must be quick and not wait for other messages.
+        Used for answers of `call` and `get`, so they can be received even if workers of the subscription of the caller are all busy.
+        '''
+        def run(data, topic):
+            self._run_and_notifify_exceptions(cb, data, topic, source='dendrite-subscribe-cb')
+
+        self._add_callback(topic, run)
+        return self._subscribe(topic)
+
+    def _add_callback(self, topic, dispatch):
+        self.topics.add(topic)
+        self.message_callback_add(topic, self._subscribe_cb_wrapper(dispatch))
+
     def _subscribe(self, topic):
         return super().subscribe(topic, qos=1)
 
     def unsubscribe(self, topic):
         self.topics.discard(topic)
         self.message_callback_remove(topic)
+        dispatcher = self.dispatchers.pop(topic, None)
+        if dispatcher is not None:
+            dispatcher.stop()
         return super().unsubscribe(topic)
 
-    def subscribe_conf(self, topic, cb):
-        return self.subscribe(self.CONF_TOPIC_PREFIX + topic, self._subscribe_conf_cb_wrapper(cb))
+    def dispatch_stats(self):
+        '''
+        Returns queue depth, processed and dropped messages... of subscriptions, by topic.
+        '''
+        return {topic: dispatcher.stats() for topic, dispatcher in list(self.dispatchers.items())}
+
+    def subscribe_conf(self, topic, cb, **kwargs):
+        return self.subscribe(self.CONF_TOPIC_PREFIX + topic, self._subscribe_conf_cb_wrapper(cb), **kwargs)
 
     def publish(self, topic, data=None, retain=False):
         '''
@@ -228,12 +388,13 @@ class  Dendrite(mqtt.Client):
     def publish_conf(self, path, message, retain=True):
         return self.publish(self.CONF_TOPIC_PREFIX + path, message, retain=retain)
 
-    def provide(self, service, cb):
+    def provide(self, service, cb, **kwargs):
         '''
         provides a service RPC style by running callback cb on call.
         callback may raise RequestError to indicate an error that will be sent back to caller. error must be json serializable.
+        kwargs are passed to `subscribe`.
         '''
-        return self.subscribe(self.SERVICE_REQUESTS_TOPIC_PATTERN.format(service=service), self._provide_cb_wrapper(cb))
+        return self.subscribe(self.SERVICE_REQUESTS_TOPIC_PATTERN.format(service=service), self._provide_cb_wrapper(cb), **kwargs)
 
     def unprovide(self, service):
         return self.unsubscribe(self.SERVICE_REQUESTS_TOPIC_PATTERN.format(service=service))
@@ -245,16 +406,18 @@ class  Dendrite(mqtt.Client):
         future = concurrent.futures.Future()
 
         def cb(result):
-            future.set_result(result)
+            if not future.done():
+                future.set_result(result)
 
-        self.subscribe(topic, cb)
+        subscribed = topic in self.topics
+        self._subscribe_inline(topic, cb)
 
         try:
             return future.result(timeout)
         except concurrent.futures.TimeoutError:
             raise RequestTimeout('Could not retrieve first value of "{topic}" within {timeout} seconds'.format(topic=topic, timeout=timeout))
         finally:
-            if topic not in self.topics:
+            if not subscribed:
                 self.unsubscribe(topic)
 
     def get_conf(self, topic, timeout=1):
@@ -265,29 +428,59 @@ class  Dendrite(mqtt.Client):
         except serialized_redis.redis.ConnectionError as e:
             raise ConnectionFailed(e)
 
+    def _subscribe_answers(self, service):
+        '''
+        Subscribes once to answers of service for this Dendrite, returns a future resolved when subscription is acknowledged.
+        '''
+        with self.answers_lock:
+            subscribed = self.answers_subscribed.get(service, None)
+            if subscribed is None:
+                subscribed = concurrent.futures.Future()
+                self.answers_subscribed[service] = subscribed
+                topic = self.SERVICE_ANSWERS_TOPIC_PATTERN.format(service=service, request_id=self.answers_id + '/+')
+                self._add_callback(topic, self._on_answer)
+                result, mid = self._subscribe(topic)
+                if mid is not None:  # else not connected: on_connect will subscribe
+                    self.suback_waiters[mid] = [subscribed]
+        return subscribed
+
+    def _on_answer(self, data, topic):
+        future = self.pending_calls.pop(self.answers_id + '/' + topic.rsplit('/', 1)[-1], None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
     def call(self, service, data=None, timeout=30):
         '''
         RPC request to service, returns result or raises RequestError or RequestTimeout.
         This should not be called in async function as it will block the event loop.
         However it can be safely called from Thread Executor or when not event loop is running (will run it for a short while)
+        Answers of all calls to a service are received on the same subscription, matched to calls by request id:
+        only first call to a service waits for the subscription to be acknowledged.
         '''
-        request_id = str(uuid.uuid4())
-        future = concurrent.futures.Future()
-
-        def cb(result):
-            future.set_result(result)
-
-        self.subscribe(self.SERVICE_ANSWERS_TOPIC_PATTERN.format(service=service, request_id=request_id), cb)
-        # normally, we should wait for on_subscribe callback to make sure we have subscribed before sending request,
-        #  but let's assume that if mosquitto receives the publish, it has already received the subscribe...
-        self.publish(self.SERVICE_REQUESTS_TOPIC_PATTERN.format(service=service), {'request': data, 'id': request_id})
+        deadline = time.monotonic() + timeout
+        request_id, future = self._new_request()
         try:
-            answer = future.result(timeout)
+            self._subscribe_answers(service).result(timeout)
+            self._publish_request(service, data, request_id)
+            answer = future.result(max(0, deadline - time.monotonic()))
         except concurrent.futures.TimeoutError:
             raise RequestTimeout('Call to "{service}" timed out after {timeout} seconds'.format(service=service, timeout=timeout))
         finally:
-            self.unsubscribe(self.SERVICE_ANSWERS_TOPIC_PATTERN.format(service=service, request_id=request_id))
+            self.pending_calls.pop(request_id, None)
+
+        return self._answer_result(answer)
+
+    def _new_request(self):
+        request_id = self.answers_id + '/' + uuid.uuid4().hex
+        future = concurrent.futures.Future()
+        self.pending_calls[request_id] = future
+        return request_id, future
 
+    def _publish_request(self, service, data, request_id):
+        return self.publish(self.SERVICE_REQUESTS_TOPIC_PATTERN.format(service=service), {'request': data, 'id': request_id})
+
+    @staticmethod
+    def _answer_result(answer):
         if 'errors' in answer or 'error_str' in answer:
             raise RequestError(answer.get('errors', None), answer.get('error_str', ''))
 
@@ -308,12 +501,265 @@ class  Dendrite(mqtt.Client):
         def cache_conf(data, path):
             synapse.set(self.CACHE_PREFIX + path, data)
 
-        self.subscribe(Dendrite.CONF_TOPIC_PREFIX + '#', cache_conf)
+        # an update dropped would leave the cache stale until next change of the topic
+        self.subscribe(Dendrite.CONF_TOPIC_PREFIX + '#', cache_conf, block=True)
         self.wait_complete()
 
 
+class AsyncSubscription():
+    '''
+    Async iterator over (data, topic) of messages received on a subscription of `AsyncDendrite`.
+    At most `max_size` messages wait to be consumed: when full, the MQTT network loop waits for room,
+    or, if not `block`, newer messages are dropped (and counted) meanwhile.
+    '''
+
+    def __init__(self, dendrite, topic, loop, max_size=DENDRITE_QUEUE_SIZE, block=True):
+        self.dendrite = dendrite
+        self.topic = topic
+        self.loop = loop
+        self.queue = asyncio.Queue(max_size)
+        self.block = block
+        self.lock = threading.Lock()
+        self.closed = False
+        self.pending_put = None
+        self.dropped = 0
+
+        dendrite._subscribe_inline(topic, self._on_message)
+
+    def _on_message(self, data, topic):
+        # run in MQTT network loop thread
+        if not self.block:
+            self.loop.call_soon_threadsafe(self._put, (data, topic))
+            return
+
+        with self.lock:
+            if self.closed:
+                return
+            self.pending_put = asyncio.run_coroutine_threadsafe(self.queue.put((data, topic)), self.loop)
+        try:
+            self.pending_put.result()
+        except concurrent.futures.CancelledError:
+            pass  # closed
+
+    def _put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.queue.get()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.pending_put is not None:
+                # release network loop if it waits for room
+                self.pending_put.cancel()
+        self.dendrite.unsubscribe(self.topic)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+class AsyncDendrite():
+    '''
+    asyncio interface to Dendrite: coroutines wait for RPC answers and messages without holding a thread.
+    MQTT network loop still runs in the thread of the underlying `Dendrite`, that hands results over to the event loop.
+    '''
+    CONF_TOPIC_PREFIX = Dendrite.CONF_TOPIC_PREFIX
+
+    def __init__(self, dendrite=None, loop=None):
+        if dendrite is None:
+            dendrite = Dendrite()
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.dendrite = dendrite
+        self.loop = loop
+
+    async def publish(self, topic, data=None, retain=False):
+        ''' publish is queued by the network loop, it does not wait for the broker '''
+        self.dendrite.publish(topic, data, retain=retain)
+
+    async def publish_conf(self, path, message, retain=True):
+        return await self.publish(self.CONF_TOPIC_PREFIX + path, message, retain=retain)
+
+    def subscribe(self, topic, max_queue=DENDRITE_QUEUE_SIZE, block=True):
+        '''
+        Returns an async iterator of (data, topic) of messages of topic, that can also be used as async context manager to unsubscribe:
+
+            async with dendrite.subscribe('session/mac') as messages:
+                async for data, topic in messages:
+                    ...
+        '''
+        return AsyncSubscription(self.dendrite, topic, self.loop, max_size=max_queue, block=block)
+
+    def subscribe_conf(self, topic, max_queue=DENDRITE_QUEUE_SIZE):
+        return self.subscribe(self.CONF_TOPIC_PREFIX + topic, max_queue=max_queue)
+
+    async def call(self, service, data=None, timeout=30):
+        '''
+        RPC request to service, returns result or raises RequestError or RequestTimeout.
+        '''
+        deadline = self.loop.time() + timeout
+        request_id, future = self.dendrite._new_request()
+        try:
+            # subscription is shared by all calls to service: do not let a timeout cancel it
+            subscribed = asyncio.shield(asyncio.wrap_future(self.dendrite._subscribe_answers(service), loop=self.loop))
+            await asyncio.wait_for(subscribed, timeout)
+            self.dendrite._publish_request(service, data, request_id)
+            answer = await asyncio.wait_for(asyncio.wrap_future(future, loop=self.loop), max(0, deadline - self.loop.time()))
+        except asyncio.TimeoutError:
+            raise RequestTimeout('Call to "{service}" timed out after {timeout} seconds'.format(service=service, timeout=timeout))
+        finally:
+            self.dendrite.pending_calls.pop(request_id, None)
+
+        return self.dendrite._answer_result(answer)
+
+    async def get(self, topic, timeout=1):
+        '''
+        Get first message from topic
+        '''
+        subscribed = topic in self.dendrite.topics
+        # only first message is consumed: do not hold the network loop for the next ones
+        subscription = AsyncSubscription(self.dendrite, topic, self.loop, max_size=1, block=False)
+        try:
+            data, _topic = await asyncio.wait_for(subscription.__anext__(), timeout)
+            return data
+        except asyncio.TimeoutError:
+            raise RequestTimeout('Could not retrieve first value of "{topic}" within {timeout} seconds'.format(topic=topic, timeout=timeout))
+        finally:
+            if not subscribed:
+                subscription.close()
+
+    async def get_conf(self, topic):
+        'get configuration value. This relies on `run_conf_cacher` to be executed'
+        return await self.loop.run_in_executor(None, self.dendrite.get_conf, topic)
+
+
+ConfView = collections.namedtuple('ConfView', ['topic', 'version', 'value'])
+
+
+def freeze(value):
+    '''
+    Returns a read-only copy of a JSON value: dicts as MappingProxyType and lists as tuples.
+    '''
+    if isinstance(value, dict):
+        return types.MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def thaw(value):
+    '''
+    Returns a mutable copy of a frozen value, as decoded from JSON.
+    '''
+    if isinstance(value, types.MappingProxyType):
+        return {key: thaw(item) for key, item in value.items()}
+    if isinstance(value, tuple):
+        return [thaw(item) for item in value]
+    return value
+
+
+class ConfStore():
+    '''
+    Process local configuration.
+    Each topic is read once from Redis cache of configuration (see `Dendrite.run_conf_cacher`), then kept up to date from conf/# messages.
+    Values are read-only (see `freeze`), with a version per topic incremented when it changes:
+    indexes built from a topic are rebuilt only when its version changes.
+    '''
+
+    def __init__(self, dendrite=None):
+        # conf/# subscription needs its own Dendrite: a topic has only one callback per Dendrite
+        self.dendrite = dendrite
+        self.lock = threading.Lock()
+        self.started = False
+        self.views = {}  # ConfView by topic
+        self.indexes = {}  # (version, index) by (topic, build function)
+        self.listeners = []
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            if self.dendrite is None:
+                self.dendrite = Dendrite()
+        # single worker: updates are applied in order, none is dropped (topic would stay stale)
+        self.dendrite.subscribe(Dendrite.CONF_TOPIC_PREFIX + '#', self.update, workers=1, block=True)
+
+    def update(self, data, topic):
+        with self.lock:
+            view = self._set(topic[len(Dendrite.CONF_TOPIC_PREFIX):], data)
+            listeners = list(self.listeners) if view is not None else []
+        for listener in listeners:
+            listener(view)
+
+    def _set(self, topic, data):
+        ''' returns new view of topic, or None if unchanged '''
+        value = freeze(data)
+        previous = self.views.get(topic, None)
+        if previous is None:
+            version = 1
+        elif previous.value == value:
+            return
+        else:
+            version = previous.version + 1
+        view = ConfView(topic, version, value)
+        self.views[topic] = view
+        return view
+
+    def get_view(self, topic):
+        view = self.views.get(topic, None)
+        if view is None:
+            self.start()
+            data = self.dendrite.get_conf(topic)
+            with self.lock:
+                # an update may have been received meanwhile: it is more recent
+                if topic not in self.views:
+                    self._set(topic, data)
+                view = self.views[topic]
+        return view
+
+    def get(self, topic):
+        ''' Returns read-only value of topic '''
+        return self.get_view(topic).value
+
+    def index(self, topic, build):
+        '''
+        Returns `build(value)` of topic, built once per version of the topic.
+        '''
+        view = self.get_view(topic)
+        version, index = self.indexes.get((topic, build), (None, None))
+        if version != view.version:
+            index = build(view.value)
+            self.indexes[(topic, build)] = (view.version, index)
+        return index
+
+    def add_listener(self, cb):
+        '''
+        cb will be called with the new ConfView of a topic each time it changes.
+        '''
+        with self.lock:
+            self.listeners.append(cb)
+
+    def remove_listener(self, cb):
+        with self.lock:
+            self.listeners.remove(cb)
+
+
+conf_store = ConfStore()
+
+
 class ConfObject:
-    _dendrite = Dendrite()
+    _conf_store = conf_store
 
     @classmethod
     def count(cls):
@@ -321,7 +767,7 @@ class ConfObject:
         Count the number of objects the configuration has.
         Assumes the configuration is a list.
         '''
-        return len(cls._dendrite.get_conf(cls.TOPIC) or [])
+        return len(cls._conf_store.get(cls.TOPIC) or ())
 
     @classmethod
     def get_all(cls, **filters):
@@ -332,14 +778,14 @@ class ConfObject:
         Assumes the configuration is a list.
         '''
         objects = []
-        conf = cls._dendrite.get_conf(cls.TOPIC) or []
+        conf = cls._conf_store.get(cls.TOPIC) or ()
         for obj in conf:
             for key, value in filters.items():
                 if obj.get(key, None) != value:
                     break
             else:
                 # matches all filters
-                objects.append(cls(**obj))
+                objects.append(cls(**thaw(obj)))
         return objects
 
     @classmethod
@@ -350,14 +796,14 @@ class ConfObject:
         :returns: an instance if found or None.
         Assumes the configuration is a list.
         '''
-        conf = cls._dendrite.get_conf(cls.TOPIC) or []
+        conf = cls._conf_store.get(cls.TOPIC) or ()
         for obj in conf:
             for key, value in filters.items():
                 if obj.get(key, None) != value:
                     break
             else:
                 # matches all filters
-                return cls(**obj)
+                return cls(**thaw(obj))
 
     def __init__(self, **kwargs):
         for key in kwargs:
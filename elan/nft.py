@@ -0,0 +1,172 @@
+import ctypes
+import ctypes.util
+import json
+import re
+import subprocess
+import threading
+
+NFT_CTX_OUTPUT_JSON = 1 << 4
+
+
+class NftError(Exception):
+    pass
+
+
+def element_commands(action, nft_set, elements, family='bridge', table='elan'):
+    '''
+    Returns nft commands to add or delete `elements` of set.
+    Elements are tuples of values concatenated in the set key, or single values.
+    Deletes are preceded by an add of the element so that a missing element does not abort the whole batch.
+    '''
+    commands = []
+    for element in elements:
+        if isinstance(element, tuple):
+            element = ' . '.join(str(value) for value in element)
+        command = 'element {family} {table} {nft_set} {{ {element} }}'.format(family=family, table=table, nft_set=nft_set, element=element)
+        if action == 'delete':
+            commands.append('add ' + command)
+        commands.append('{action} {command}'.format(action=action, command=command))
+    return commands
+
+
+def parse_elements(output):
+    '''
+    Returns elements of a set listed by nft in JSON format, as a set of tuples (concatenations) or values.
+    '''
+    elements = set()
+    for item in json.loads(output)['nftables']:
+        for element in item.get('set', {}).get('elem', []):
+            if isinstance(element, dict) and 'elem' in element:  # element with options (timeout, ...)
+                element = element['elem']['val']
+            if isinstance(element, dict) and 'concat' in element:
+                element = tuple(element['concat'])
+            elements.add(element)
+    return elements
+
+
+def list_command(nft_set, family='bridge', table='elan'):
+    return 'list set {family} {table} {nft_set}'.format(family=family, table=table, nft_set=nft_set)
+
+
+class LibNftables():
+    '''
+    Runs nft commands through libnftables, keeping a single nft context.
+    Each batch is sent as one netlink transaction: it is applied atomically.
+    '''
+
+    def __init__(self, library=None):
+        if library is None:
+            library = ctypes.util.find_library('nftables')
+            if library is None:
+                raise NftError('libnftables not found')
+        self.lib = ctypes.CDLL(library)
+        self.lib.nft_ctx_new.restype = ctypes.c_void_p
+        self.lib.nft_ctx_new.argtypes = [ctypes.c_uint32]
+        self.lib.nft_ctx_buffer_output.argtypes = [ctypes.c_void_p]
+        self.lib.nft_ctx_buffer_error.argtypes = [ctypes.c_void_p]
+        self.lib.nft_ctx_get_error_buffer.restype = ctypes.c_char_p
+        self.lib.nft_ctx_get_error_buffer.argtypes = [ctypes.c_void_p]
+        self.lib.nft_ctx_get_output_buffer.restype = ctypes.c_char_p
+        self.lib.nft_ctx_get_output_buffer.argtypes = [ctypes.c_void_p]
+        self.lib.nft_ctx_output_get_flags.restype = ctypes.c_uint
+        self.lib.nft_ctx_output_get_flags.argtypes = [ctypes.c_void_p]
+        self.lib.nft_ctx_output_set_flags.argtypes = [ctypes.c_void_p, ctypes.c_uint]
+        self.lib.nft_ctx_free.argtypes = [ctypes.c_void_p]
+        # no argtypes for nft_run_cmd_from_buffer: buffer length is only expected by libnftables < 0.9.1, and ignored by later ones.
+
+        self.lock = threading.Lock()
+        self.ctx = self.lib.nft_ctx_new(0)
+        self.lib.nft_ctx_buffer_output(self.ctx)
+        self.lib.nft_ctx_buffer_error(self.ctx)
+
+    def run(self, commands):
+        if not commands:
+            return
+        with self.lock:
+            self._run('\n'.join(commands))
+
+    def _run(self, commands):
+        buf = commands.encode()
+        if self.lib.nft_run_cmd_from_buffer(ctypes.c_void_p(self.ctx), ctypes.c_char_p(buf), ctypes.c_size_t(len(buf))) != 0:
+            raise NftError(self.lib.nft_ctx_get_error_buffer(self.ctx).decode())
+        return self.lib.nft_ctx_get_output_buffer(self.ctx).decode()
+
+    def list_elements(self, nft_set, **kwargs):
+        with self.lock:
+            flags = self.lib.nft_ctx_output_get_flags(self.ctx)
+            self.lib.nft_ctx_output_set_flags(self.ctx, flags | NFT_CTX_OUTPUT_JSON)
+            try:
+                return parse_elements(self._run(list_command(nft_set, **kwargs)))
+            finally:
+                self.lib.nft_ctx_output_set_flags(self.ctx, flags)
+
+    def close(self):
+        with self.lock:
+            if self.ctx is not None:
+                self.lib.nft_ctx_free(self.ctx)
+                self.ctx = None
+
+
+class NftProcess():
+    '''
+    Runs each batch of nft commands with a `nft -f -` process, for systems without libnftables.
+    The batch is still applied atomically, but a process is forked per batch.
+    '''
+
+    def run(self, commands):
+        if not commands:
+            return
+        process = subprocess.run(['nft', '-f', '-'], input='\n'.join(commands), universal_newlines=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise NftError(process.stderr)
+
+    def list_elements(self, nft_set, **kwargs):
+        process = subprocess.run(['nft', '-j'] + list_command(nft_set, **kwargs).split(), universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise NftError(process.stderr)
+        return parse_elements(process.stdout)
+
+    def close(self):
+        pass
+
+
+class FakeNft():
+    '''
+    Records batches of commands instead of running them, for tests.
+    Element commands are applied to `sets`, a dict of set elements by (family, table, set).
+    '''
+    ELEMENT_COMMAND = re.compile(r'(add|delete) element (\S+) (\S+) (\S+) {(.*)}$')
+
+    def __init__(self, sets=None):
+        self.batches = []
+        self.sets = sets or {}
+
+    def run(self, commands):
+        if commands:
+            self.batches.append(list(commands))
+        for command in commands:
+            match = self.ELEMENT_COMMAND.match(command)
+            if match:
+                action, family, table, nft_set, element = match.groups()
+                element = tuple(value.strip() for value in element.split(' . '))
+                if len(element) == 1:
+                    element = element[0]
+                elements = self.sets.setdefault((family, table, nft_set), set())
+                if action == 'add':
+                    elements.add(element)
+                else:
+                    elements.discard(element)
+
+    def list_elements(self, nft_set, family='bridge', table='elan'):
+        return set(self.sets.get((family, table, nft_set), set()))
+
+    def close(self):
+        pass
+
+
+def get_nft():
+    ''' Returns the libnftables backend if available, `nft` command backend otherwise '''
+    try:
+        return LibNftables()
+    except (NftError, OSError):
+        return NftProcess()
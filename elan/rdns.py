@@ -1,33 +1,98 @@
+import collections
+import json
+import os
+import threading
+import time
+
 from elan import neuron
-RDNS_PATH = 'rdns:{mac}:{source}'
+RDNS_PATH = 'rdns:{mac}:{source}'  # also hardcoded in _resolve_rdns_script
+RDNS_CHANNEL = 'rdns:entries'  # new entries are published there to feed in-process caches
+
+RDNS_CACHE_SIZE = int(os.environ.get('RDNS_CACHE_SIZE', 100000))  # entries
+
+MAX_CNAME_HOPS = 16  # Protects against CNAME loops
 
 synapse = neuron.Synapse()
 
+cache = None  # in-process cache, see `enable_cache`
+
 
 def get_cached_rdns(source, mac=None):
     '''
     Return cached rdns for that `mac`. If not found for that mac will return latest match for any mac
     If no `mac` provided, will return latest match for any mac.
     '''
-    if mac is None:
-        return _get_cached_rdns(source, '*')
-    rdns = _get_cached_rdns(source, mac)
-    if rdns is None:
-        return _get_cached_rdns(source, '*')
-    return rdns
+    if cache is not None:
+        rdns = cache.get_rdns(source, mac)
+        if rdns is not None:
+            return rdns
+
+    return _get_cached_rdns_many([(source, mac)])[0]
+
+
+def get_cached_rdns_many(lookups):
+    '''
+    Same as `get_cached_rdns` for many lookups at once.
+    `lookups` is a list of (source, mac) tuples, mac being optional (None).
+    Returns a list of rdns (or None if not found) in the same order as `lookups`.
+    CNAME chains are resolved by Redis for all lookups together, in one round trip.
+    '''
+    if cache is None:
+        return _get_cached_rdns_many(lookups)
+
+    results = [cache.get_rdns(source, mac) for source, mac in lookups]
+    misses = [i for i, rdns in enumerate(results) if rdns is None]
+    if misses:
+        for i, rdns in zip(misses, _get_cached_rdns_many([lookups[i] for i in misses])):
+            results[i] = rdns
+    return results
 
 
-def _get_cached_rdns(source, mac):
-    rdns = synapse.get(RDNS_PATH.format(source=source, mac=mac))
-    if rdns is None:
-        return
-    # recurse to get last level of rdns:
-    last_level_rdns = _get_cached_rdns(rdns, mac)
+def _get_cached_rdns_many(lookups):
+    if not lookups:
+        return []
 
-    if last_level_rdns:
-        return last_level_rdns
+    args = [MAX_CNAME_HOPS]
+    for source, mac in lookups:
+        args.extend((source, '' if mac is None else mac))
 
+    return [json.loads(rdns) if rdns else None for rdns in _resolve_rdns_script(args=args)]
+
+
+# Resolves CNAME chains of (source, mac) pairs server side, in one round trip.
+# ARGV: hop limit, then source and mac ('' for any mac) of each pair.
+# Returns, for each pair, the last level of the chain as stored (JSON encoded) or '' if not found.
+_resolve_rdns_script = synapse.register_script('''
+local max_hops = tonumber(ARGV[1])
+local results = {}
+
+local function resolve(source, mac)
+    local rdns = false
+    for hop = 1, max_hops do
+        local name = redis.call('GET', 'rdns:' .. mac .. ':' .. source)
+        if not name then
+            break
+        end
+        rdns = name
+        source = cjson.decode(name)
+    end
     return rdns
+end
+
+for i = 2, #ARGV, 2 do
+    local source, mac = ARGV[i], ARGV[i + 1]
+    local rdns = false
+    if mac ~= '' then
+        rdns = resolve(source, mac)
+    end
+    if not rdns then
+        rdns = resolve(source, '*')
+    end
+    results[#results + 1] = rdns or ''
+end
+
+return results
+''')
 
 
 def add_entries(*entries):
@@ -44,4 +109,183 @@ def add_entries(*entries):
         expiry = int(entry['ttl']) + 60  # Keep it a little longer, just in case
         pipe.set(RDNS_PATH.format(mac=entry['mac'], source=entry['source']), entry['rdns'], ex=expiry)
         pipe.set(RDNS_PATH.format(mac='*', source=entry['source']), entry['rdns'], ex=expiry)
+    if entries:
+        pipe.publish(RDNS_CHANNEL, entries)
     pipe.execute()
+
+
+def enable_cache(max_size=RDNS_CACHE_SIZE, warm_up=True):
+    '''
+    Enables in-process cache of rdns entries, consulted before Redis by `get_cached_rdns` and `get_cached_rdns_many`.
+    Cache is fed by entries published by `add_entries` (from any process) and, if `warm_up`, with entries already in Redis.
+    Returns the cache.
+    '''
+    global cache
+
+    if cache is None:
+        cache = RdnsCache(max_size=max_size)
+        cache.listen()
+        if warm_up:
+            cache.warm_up()
+
+    return cache
+
+
+def disable_cache():
+    global cache
+
+    if cache is not None:
+        cache.stop()
+        cache = None
+
+
+class RdnsCache():
+    '''
+    Bounded LRU cache of rdns entries, indexed by their Redis path.
+    Entries expire like their Redis counterparts.
+    Cache only answers when it knows it holds all entries needed for the answer, like after `warm_up` (`complete`):
+    if an entry needed has been evicted, `get_rdns` returns None so that caller asks Redis.
+    '''
+
+    def __init__(self, max_size=RDNS_CACHE_SIZE, complete=False):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()  # path -> (rdns, expiry)
+        self.evicted = collections.OrderedDict()  # path -> expiry, of entries evicted but still in Redis
+        self.complete = complete  # whether all entries in Redis have been added to cache
+        self.lost = False  # evicted entries could not all be tracked
+        self.lock = threading.Lock()
+
+        self.pubsub = None
+        self.listener = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, path, rdns, ttl):
+        expiry = time.monotonic() + ttl
+        with self.lock:
+            self.entries[path] = (rdns, expiry)
+            self.entries.move_to_end(path)
+            self.evicted.pop(path, None)
+            while len(self.entries) > self.max_size:
+                evicted_path, (_rdns, evicted_expiry) = self.entries.popitem(last=False)
+                self._evicted(evicted_path, evicted_expiry)
+
+    def _evicted(self, path, expiry):
+        self.evicted[path] = expiry
+        if len(self.evicted) > self.max_size:
+            now = time.monotonic()
+            for evicted_path, evicted_expiry in list(self.evicted.items()):
+                if evicted_expiry <= now:
+                    del self.evicted[evicted_path]
+            if len(self.evicted) > self.max_size:
+                # too many to keep track of: any miss may be an evicted entry
+                self.complete = False
+                self.lost = True
+                self.evicted.clear()
+
+    def add_entries(self, *entries):
+        ''' Adds entries in the same format as `add_entries` '''
+        for entry in entries:
+            ttl = int(entry['ttl']) + 60  # same expiry as in Redis
+            self.add(RDNS_PATH.format(mac=entry['mac'], source=entry['source']), entry['rdns'], ttl)
+            self.add(RDNS_PATH.format(mac='*', source=entry['source']), entry['rdns'], ttl)
+
+    def get(self, path):
+        with self.lock:
+            entry = self.entries.get(path, None)
+            if entry is None:
+                return
+            rdns, expiry = entry
+            if expiry <= time.monotonic():
+                del self.entries[path]
+                return
+            self.entries.move_to_end(path)
+            return rdns
+
+    def is_missing(self, path):
+        ''' Returns True if entry is known not to be in Redis '''
+        with self.lock:
+            if not self.complete:
+                return False
+            expiry = self.evicted.get(path, None)
+            if expiry is None:
+                return True
+            if expiry <= time.monotonic():
+                del self.evicted[path]
+                return True
+            return False
+
+    def get_rdns(self, source, mac=None):
+        '''
+        Same as `get_cached_rdns` but only from cache.
+        Returns None if not found or if cache can not tell (an entry needed is not in cache but may be in Redis).
+        '''
+        if mac is not None:
+            rdns, known = self._get_rdns(source, mac)
+            if not known:
+                return
+            if rdns is not None:
+                return rdns
+        rdns, known = self._get_rdns(source, '*')
+        if not known:
+            return
+        return rdns
+
+    def _get_rdns(self, source, mac):
+        ''' Returns last level of CNAME chain (or None), and whether it is known to be the same as in Redis '''
+        rdns = None
+        for _hop in range(MAX_CNAME_HOPS):
+            path = RDNS_PATH.format(source=source, mac=mac)
+            name = self.get(path)
+            if name is None:
+                return rdns, self.is_missing(path)
+            rdns = source = name
+        return rdns, True
+
+    def listen(self):
+        ''' Starts a thread that adds to cache the entries published by `add_entries` '''
+        self.pubsub = synapse.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(**{RDNS_CHANNEL: self._on_entries})
+        self.pubsub.get_message(timeout=1)  # Wait for subscription, so that no entry is missed after warm up
+        self.listener = self.pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def _on_entries(self, message):
+        self.add_entries(*message['data'])
+
+    def warm_up(self, batch_size=1000):
+        '''
+        Loads entries currently in Redis. Cache should be listening already, so that it then holds all entries.
+        '''
+        with self.lock:
+            self.evicted.clear()
+            self.lost = False
+        paths = []
+        for path in synapse.scan_iter(match=RDNS_PATH.format(mac='*', source='*'), count=batch_size):
+            paths.append(path)
+            if len(paths) >= batch_size:
+                self._load(paths)
+                paths = []
+        if paths:
+            self._load(paths)
+        with self.lock:
+            self.complete = not self.lost
+
+    def _load(self, paths):
+        pipe = synapse.pipeline(transaction=False)
+        for path in paths:
+            pipe.get(path)
+            pipe.pttl(path)
+        results = pipe.execute()
+        for path, rdns, pttl in zip(paths, results[::2], results[1::2]):
+            if rdns is not None and pttl is not None and pttl > 0:
+                self.add(path, rdns, pttl / 1000)
+
+    def stop(self):
+        if self.listener is not None:
+            # listener closes pubsub connection once unsubscribed.
+            # Not `listener.stop()`: its PUNSUBSCRIBE may be sent after the close, on a connection then released to the pool with its reply pending.
+            self.pubsub.unsubscribe()
+            self.listener.join()
+            self.listener = None
+            self.pubsub = None
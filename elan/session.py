@@ -1,13 +1,20 @@
+import asyncio
 import datetime
+import functools
+import json
 import re
+import threading
+from time import monotonic
 
+from elan.async_synapse import AsyncSynapse
 from elan.neuron import Synapse, Dendrite
 
 MAC_SESSION_TOPIC = 'session/mac'
 VLAN_SESSION_TOPIC = 'session/vlan'
 IP_SESSION_TOPIC = 'session/ip'
 
-LAST_SEEN_PATH = 'device:macs:last_seen'
+LAST_SEEN_PATH = 'device:macs:last_seen'  # sorted set of last seen members (see `last_seen_member`) scored by last seen time
+LAST_SEEN_MIGRATED_PATH = 'device:macs:last_seen:migrated'  # set once last seen members have been converted to `last_seen_member` format
 
 SESSION_IDS_PATH = 'device:mac:session-ids'
 SESSION_IDS_SEQUENCE_PATH = 'device:mac:session-ids:sequence'
@@ -21,6 +28,7 @@ MAC_VLAN_IPS_PATH = 'device:mac:{mac}:vlan:{vlan}:ips'
 MAC_AUTH_SESSION_PATH = 'device:mac:{mac}:authentication'
 
 synapse = Synapse()
+async_synapse = AsyncSynapse()  # for coroutines
 dendrite = Dendrite()
 
 
@@ -34,13 +42,7 @@ def format_date(date):
 def is_online(mac, vlan=None, ip=None):
     ''' returns True if Mac (optionnaly, on VLAN, with IP) is connected '''
 
-    data = dict(mac=mac)
-    if vlan is not None:
-        data['vlan'] = vlan
-    if ip is not None:
-        data['ip'] = ip
-
-    return bool(synapse.zscore(LAST_SEEN_PATH, data))
+    return synapse.zscore(LAST_SEEN_PATH, last_seen_member(mac, vlan, ip)) is not None
 
 
 def get_current_session_ids():
@@ -99,6 +101,17 @@ def mac_has_ip_on_vlan(mac, ip, vlan):
     return synapse.sismember(MAC_VLAN_IPS_PATH.format(mac=mac, vlan=vlan), ip)
 
 
+def macs_have_ips_on_vlans(lookups):
+    '''
+    Same as `mac_has_ip_on_vlan` for many lookups in one round trip.
+    `lookups` is an iterable of (mac, ip, vlan) tuples, returns a list of booleans in the same order.
+    '''
+    pipe = synapse.pipeline(transaction=False)
+    for mac, ip, vlan in lookups:
+        pipe.sismember(MAC_VLAN_IPS_PATH.format(mac=mac, vlan=vlan), ip)
+    return [bool(result) for result in pipe.execute()]
+
+
 def mac_port(mac):
     return synapse.hget(MAC_PORT_PATH, mac)
 
@@ -109,6 +122,13 @@ def port_macs(port):
     return set()
 
 
+async def port_macs_async(port):
+    ''' Same as `port_macs` for coroutines '''
+    if 'interface' in port:
+        return await async_synapse.smembers(PORT_MACS_PATH.format(**port))
+    return set()
+
+
 def seen(mac, vlan=None, port=None, ip=None, time=None):
     '''
     marks mac as seen on VLAN 'vlan', on Port 'port' with IP 'ip' at Time 'time' and notifies CC if new session.
@@ -116,105 +136,477 @@ def seen(mac, vlan=None, port=None, ip=None, time=None):
     ip ignored if vlan not specified
     returns 3 booleans whether MAC, VLAN and IP were new
     '''
-    if time is None:
-        time = (datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)).total_seconds()  # Epoch
+    return seen_many([(mac, vlan, port, ip, time)])[0]
 
-    # if port has changed, end previous session
-    if port is not None:
-        old_port = mac_port(mac)
-        if(
-            old_port is not None
-            and
-            (
-                port['local_id'] != old_port['local_id']
-                or
-                (
-                    # Interface may be unknown in new or old port, assume it did not change
-                    port['interface'] is not None
-                    and
-                    old_port['interface'] is not None
-                    and
-                    port['interface'] != old_port['interface']
-                )
-                or
-                (
-                    # SSID may be unknown in new or old port, assume it did not change
-                    port.get('ssid', None) is not None
-                    and
-                    old_port.get('ssid', None) is not None
-                    and
-                    port.get('ssid', None) != old_port.get('ssid', None)
-                )
-            )
-        ):
-            end(mac)
+
+def seen_many(records):
+    '''
+    Same as `seen` for many sightings at once, in a few round trips whatever their number.
+    `records` is an iterable of (mac, vlan, port, ip, time) tuples, vlan, port, ip and time being optional (None).
+    returns a list of 3 booleans whether MAC, VLAN and IP were new, in the same order as `records`
+    '''
+    records = _seen_records(records)
+    if not records:
+        return []
+
+    port_macs = _port_macs(records)
+    old_ports = dict(zip(port_macs, synapse.hmget(MAC_PORT_PATH, port_macs))) if port_macs else {}
+    ended_macs, port_updates = _port_updates(records, old_ports)
+    for mac in ended_macs:
+        end(mac)
+
+    marks = mark_seen_many((mac, vlan, ip, time) for mac, vlan, _port, ip, time in records)
+
+    pipe = synapse.pipeline()
+    port_notifications = _save_ports(pipe, port_updates)
+    if port_notifications:
+        pipe.execute()
+
+    return _notify_seen(records, marks, port_notifications)
+
+
+async def seen_async(mac, vlan=None, port=None, ip=None, time=None):
+    '''
+    Same as `seen` for coroutines: Redis is accessed with `AsyncSynapse`, without blocking the event loop.
+    '''
+    return (await seen_many_async([(mac, vlan, port, ip, time)]))[0]
+
+
+async def seen_many_async(records):
+    '''
+    Same as `seen_many` for coroutines.
+    '''
+    records = _seen_records(records)
+    if not records:
+        return []
+
+    port_macs = _port_macs(records)
+    old_ports = dict(zip(port_macs, await async_synapse.hmget(MAC_PORT_PATH, port_macs))) if port_macs else {}
+    ended_macs, port_updates = _port_updates(records, old_ports)
+    for mac in ended_macs:
+        await end_async(mac)
+
+    marks = await mark_seen_many_async((mac, vlan, ip, time) for mac, vlan, _port, ip, time in records)
+
+    with async_synapse.pipeline() as pipe:
+        port_notifications = _save_ports(pipe, port_updates)
+        if port_notifications:
+            await pipe.execute()
+
+    return _notify_seen(records, marks, port_notifications)
+
+
+def _seen_records(records):
+    now = (datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)).total_seconds()  # Epoch
+    return [(mac, vlan, port, ip, now if time is None else time) for mac, vlan, port, ip, time in records]
+
+
+def _port_macs(records):
+    return list({mac for mac, _vlan, port, _ip, _time in records if port is not None})
+
+
+def _port_updates(records, old_ports):
+    '''
+    Returns macs whose session should be ended because their port has changed, and (mac, port, old port) of records with a port.
+    '''
+    ended_macs = []
+    port_updates = []
+    for mac, _vlan, port, _ip, _time in records:
+        if port is None:
+            continue
+        old_port = old_ports[mac]
+        if old_port is not None and port_has_changed(port, old_port):
+            ended_macs.append(mac)
         elif old_port is not None:
             # make sure we do not set to None SSID or Interface if the info we receive does not contain that information
             if old_port['interface'] is not None:
                 port['interface'] = old_port['interface']
             if old_port.get('ssid', None) is not None:
                 port['ssid'] = old_port['ssid']
+        port_updates.append((mac, port, old_port))
+        old_ports[mac] = port
+    return ended_macs, port_updates
+
+
+def _save_ports(pipe, port_updates):
+    ''' Adds changed ports to pipe, returns macs whose port changed '''
+    port_notifications = []
+    for mac, port, old_port in port_updates:
+        if port != old_port:
+            pipe.hset(MAC_PORT_PATH, mac, port)
+            pipe.hset(MAC_LAST_PORT_PATH, mac, port)  # Keep track of last port when port is deleted
+            if 'interface' in port:
+                pipe.sadd(PORT_MACS_PATH.format(**port), mac)
+            port_notifications.append(mac)
+    return port_notifications
+
+
+def _notify_seen(records, marks, port_notifications):
+    results = []
+    notifications = []
+    for (mac, vlan, port, ip, time), (mac_added, vlan_added, ip_added, (mac_local_id, vlan_local_id, ip_local_id)) in zip(records, marks):
+        if port is not None and mac in port_notifications and not mac_added:
+            # TODO check if can write 'and not vlan_added and not ip_added': in CC will port be updated if mac already present and new vlan or ip session ?
+            notifications.append(functools.partial(notify_MAC_port, mac=mac, mac_local_id=mac_local_id, port=port))
+
+        if ip_added:
+            notifications.append(functools.partial(notify_new_IP_session, mac=mac, vlan=vlan, ip=ip, port=port, start=time, mac_local_id=mac_local_id, vlan_local_id=vlan_local_id, ip_local_id=ip_local_id))
+        elif vlan_added:
+            notifications.append(functools.partial(notify_new_VLAN_session, mac=mac, vlan=vlan, port=port, start=time, mac_local_id=mac_local_id, vlan_local_id=vlan_local_id))
+        elif mac_added:
+            notifications.append(functools.partial(notify_new_MAC_session, mac=mac, port=port, start=time, mac_local_id=mac_local_id))
+
+        results.append((mac_added, vlan_added, ip_added))
+
+    for notify in notifications:
+        notify()
+
+    return results
+
+
+def port_has_changed(port, old_port):
+    return (
+        port['local_id'] != old_port['local_id']
+        or
+        (
+            # Interface may be unknown in new or old port, assume it did not change
+            port['interface'] is not None
+            and
+            old_port['interface'] is not None
+            and
+            port['interface'] != old_port['interface']
+        )
+        or
+        (
+            # SSID may be unknown in new or old port, assume it did not change
+            port.get('ssid', None) is not None
+            and
+            old_port.get('ssid', None) is not None
+            and
+            port.get('ssid', None) != old_port.get('ssid', None)
+        )
+    )
 
-    pipe = synapse.pipeline()
 
-    pipe.zadd(LAST_SEEN_PATH, time, dict(mac=mac))
-    if vlan is not None:
-        pipe.zadd(LAST_SEEN_PATH, time, dict(mac=mac, vlan=vlan))
-        pipe.sadd(MAC_VLANS_PATH.format(mac=mac), vlan)
-        if ip is not None:
-            pipe.zadd(LAST_SEEN_PATH, time, dict(mac=mac, vlan=vlan, ip=ip))
-            pipe.sadd(MAC_VLAN_IPS_PATH.format(mac=mac, vlan=vlan), ip)
-    results = pipe.execute()
+# Marks sessions as seen and allocates ids of new ones, atomically.
+# KEYS: last seen, session ids, session ids sequence, then vlans of mac and ips of mac on vlan of each sighting
+# ARGV: for each sighting: time, number of sessions (1 to 3), then for mac, vlan and ip sessions (vlan and ip being optional):
+#       last seen member, session ids field, value to add to vlans or ips set (ignored for mac)
+# Returns, for each sighting, added flag (1 or 0) of its sessions followed by their ids (JSON encoded).
+# New sessions of a sighting share the same id; ids of all sightings are allocated with one INCRBY.
+_mark_seen_script = synapse.register_script('''
+local sightings = {}
+local i = 1
+while i <= #ARGV do
+    local sighting = {time = ARGV[i], levels = tonumber(ARGV[i + 1]), args = i + 2, keys = 4 + #sightings * 2}
+    sightings[#sightings + 1] = sighting
+    i = i + 2 + sighting.levels * 3
+end
+
+local new_sightings = 0
+for _, sighting in ipairs(sightings) do
+    local sets = {false, KEYS[sighting.keys], KEYS[sighting.keys + 1]}
+    sighting.added = {}
+    for level = 1, sighting.levels do
+        local arg = sighting.args + (level - 1) * 3
+        sighting.added[level] = redis.call('ZADD', KEYS[1], sighting.time, ARGV[arg])
+        if sighting.added[level] == 1 then
+            sighting.any_added = true
+        end
+        if sets[level] then
+            redis.call('SADD', sets[level], ARGV[arg + 2])
+        end
+    end
+    if sighting.any_added then
+        new_sightings = new_sightings + 1
+    end
+end
+
+local next_id
+if new_sightings > 0 then
+    next_id = redis.call('INCRBY', KEYS[3], new_sightings) - new_sightings + 1
+end
+
+local result = {}
+for _, sighting in ipairs(sightings) do
+    local local_id
+    if sighting.any_added then
+        local_id = tostring(next_id)
+        next_id = next_id + 1
+    end
+    local ids = {}
+    for level = 1, sighting.levels do
+        local field = ARGV[sighting.args + (level - 1) * 3 + 1]
+        result[#result + 1] = sighting.added[level]
+        if sighting.added[level] == 1 then
+            redis.call('HSET', KEYS[2], field, local_id)
+            ids[level] = local_id
+        else
+            ids[level] = redis.call('HGET', KEYS[2], field) or ''
+        end
+    end
+    for level = 1, sighting.levels do
+        result[#result + 1] = ids[level]
+    end
+end
+
+return result
+''')
+
+
+def mark_seen(mac, vlan=None, ip=None, time=None):
+    '''
+    Marks mac (on VLAN 'vlan' with IP 'ip') as seen at Time 'time' (epoch), in one atomic call.
+    New sessions share a newly allocated local id.
+    ip ignored if vlan not specified.
+    returns 3 booleans whether MAC, VLAN and IP were new and the tuple of their local ids (None if not applicable).
+    '''
+    return mark_seen_many([(mac, vlan, ip, time)])[0]
 
-    mac_added = bool(results[0])
-    vlan_added = False
-    if len(results) > 1:
-        vlan_added = bool(results[1])
-    ip_added = False
-    if len(results) > 3:
-        ip_added = bool(results[3])
 
-    if mac_added or vlan_added or ip_added:
-        local_id = synapse.get_unique_id(SESSION_IDS_SEQUENCE_PATH)
+def mark_seen_many(sightings):
+    '''
+    Same as `mark_seen` for many sightings, in one atomic call.
+    `sightings` is an iterable of (mac, vlan, ip, time) tuples.
+    returns a list of `mark_seen` results in the same order.
+    '''
+    ensure_last_seen_migrated()
 
-    if mac_added:
-        pipe.hset(SESSION_IDS_PATH, session_ids_field(mac=mac), local_id)
-        mac_local_id = local_id
-    else:
-        pipe.hget(SESSION_IDS_PATH, session_ids_field(mac=mac))
+    keys, args, levels = _mark_seen_args(sightings)
+    if not levels:
+        return []
 
-    if vlan_added:
-        pipe.hset(SESSION_IDS_PATH, session_ids_field(mac=mac, vlan=vlan), local_id)
-        vlan_local_id = local_id
-    else:
-        pipe.hget(SESSION_IDS_PATH, session_ids_field(mac=mac, vlan=vlan))
+    return _parse_marks(_mark_seen_script(keys=keys, args=args), levels)
 
-    if ip_added:
-        pipe.hset(SESSION_IDS_PATH, session_ids_field(mac=mac, vlan=vlan, ip=ip), local_id)
 
-    results = pipe.execute()
-    if not mac_added:
-        mac_local_id = results[0]
-    if not vlan_added:
-        vlan_local_id = results[1]
+async def mark_seen_many_async(sightings):
+    '''
+    Same as `mark_seen_many` for coroutines.
+    '''
+    if not _last_seen_migrated:
+        await asyncio.get_event_loop().run_in_executor(None, ensure_last_seen_migrated)
 
-    if port is not None and port != old_port:
-        pipe.hset(MAC_PORT_PATH, mac, port)
-        pipe.hset(MAC_LAST_PORT_PATH, mac, port)  # Keep track of last port when port is deleted
-        if 'interface' in port:
-            pipe.sadd(PORT_MACS_PATH.format(**port), mac)
-        pipe.execute()
-        if not mac_added:  # TODO check if can write 'and not vlan_added and not ip_added': in CC will port be updated if mac already present and new vlan or ip session ?
-            notify_MAC_port(mac=mac, mac_local_id=mac_local_id, port=port)
+    keys, args, levels = _mark_seen_args(sightings)
+    if not levels:
+        return []
+
+    return _parse_marks(await async_synapse.run_script(_mark_seen_script, keys=keys, args=args), levels)
+
+
+def _mark_seen_args(sightings):
+    ''' Returns keys and args of `_mark_seen_script`, and number of sessions of each sighting '''
+    now = (datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)).total_seconds()  # Epoch
+
+    keys = [LAST_SEEN_PATH, SESSION_IDS_PATH, SESSION_IDS_SEQUENCE_PATH]
+    args = []
+    levels = []
+    for mac, vlan, ip, time in sightings:
+        sighting_args = [synapse.serialize(last_seen_member(mac)), session_ids_field(mac=mac), '']
+        if vlan is not None:
+            sighting_args += [synapse.serialize(last_seen_member(mac, vlan)), session_ids_field(mac=mac, vlan=vlan), synapse.serialize(vlan)]
+            if ip is not None:
+                sighting_args += [synapse.serialize(last_seen_member(mac, vlan, ip)), session_ids_field(mac=mac, vlan=vlan, ip=ip), synapse.serialize(ip)]
+        levels.append(len(sighting_args) // 3)
+        args += [now if time is None else time, levels[-1], *sighting_args]
+        keys += [MAC_VLANS_PATH.format(mac=mac), MAC_VLAN_IPS_PATH.format(mac=mac, vlan=vlan)]
+
+    return keys, args, levels
+
+
+def _parse_marks(results, levels):
+    results = iter(results)
+
+    marks = []
+    for level_count in levels:
+        added = [bool(next(results)) for _ in range(level_count)] + [False] * (3 - level_count)
+        ids = [json.loads(local_id) if local_id else None for local_id in (next(results) for _ in range(level_count))] + [None] * (3 - level_count)
+        marks.append((added[0], added[1], added[2], tuple(ids)))
+
+    return marks
+
+
+class LastSeenAggregator():
+    '''
+    Write-behind buffer for `seen`: sightings of already known (mac, vlan, ip) are kept in memory and only their
+    latest time is written to Redis, every `flush_interval` seconds, in one pipeline.
+    Sightings of new tuples, or with a port, go straight to `seen`.
+
+    If a buffered session has been ended meanwhile (by another process), sighting is replayed with `seen` at flush,
+    and `on_added(mac, vlan, ip, mac_added, vlan_added, ip_added)` is called if provided.
+    Tuples not seen for `forget_after` seconds are forgotten, so that they go through `seen` again.
+    '''
+
+    def __init__(self, flush_interval=5, forget_after=300, on_added=None):
+        self.flush_interval = flush_interval
+        self.forget_after = forget_after
+        self.on_added = on_added
+
+        self.known = {}  # (mac, vlan, ip) -> monotonic time of last sighting
+        self.pending = {}  # (mac, vlan, ip) -> latest time seen (epoch)
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.flusher = None
+        self.stopped = threading.Event()
+
+    def seen(self, mac, vlan=None, port=None, ip=None, time=None):
+        '''
+        Same as `seen`, but returns 3 False if tuple is already known.
+        '''
+        if vlan is None:
+            ip = None
+        key = (mac, vlan, ip)
+
+        if port is None:
+            with self.lock:
+                if key in self.known:
+                    if time is None:
+                        time = (datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)).total_seconds()  # Epoch
+                    self.known[key] = monotonic()
+                    if time > self.pending.get(key, 0):
+                        self.pending[key] = time
+                    return False, False, False
+
+        result = seen(mac, vlan=vlan, port=port, ip=ip, time=time)
+        with self.lock:
+            self.known[key] = monotonic()
+        return result
+
+    def start(self):
+        ''' Starts a thread flushing pending sightings every `flush_interval` seconds. '''
+        if self.flusher is None:
+            self.stopped.clear()
+            self.flusher = threading.Thread(target=self._run, name='last-seen-flusher', daemon=True)
+            self.flusher.start()
+
+    def stop(self):
+        if self.flusher is not None:
+            self.stopped.set()
+            self.flusher.join()
+            self.flusher = None
+        self.flush()
+
+    def _run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes pending sightings to Redis. Returns number of sightings written.
+        '''
+        with self.flush_lock:
+            with self.lock:
+                pending = self.pending
+                self.pending = {}
+                forget_before = monotonic() - self.forget_after
+                for key in [key for key, last in self.known.items() if last < forget_before and key not in pending]:
+                    del self.known[key]
+
+            if not pending:
+                return 0
+
+            # latest time of each last seen member, including mac and vlan of IPs
+            members = {}
+            for (mac, vlan, ip), time in pending.items():
+                for member in {(mac, None, None), (mac, vlan, None), (mac, vlan, ip)}:
+                    if time > members.get(member, 0):
+                        members[member] = time
+
+            ensure_last_seen_migrated()
+            pipe = synapse.pipeline(transaction=False)
+            for member, time in members.items():
+                last_seen = last_seen_member(*member)
+                # Only update existing sessions: XX is not supported by zadd of redis-py
+                pipe.execute_command('ZADD', LAST_SEEN_PATH, 'XX', time, synapse.serialize(last_seen))
+                pipe.zscore(LAST_SEEN_PATH, last_seen)
+            results = pipe.execute()
+
+            ended = {member for member, score in zip(members, results[1::2]) if score is None}
+            if ended:
+                for key, time in pending.items():
+                    mac, vlan, ip = key
+                    if (mac, None, None) in ended or (mac, vlan, None) in ended or key in ended:
+                        with self.lock:
+                            self.known.pop(key, None)
+                        added = seen(mac, vlan=vlan, ip=ip, time=time)
+                        if self.on_added is not None and any(added):
+                            self.on_added(mac, vlan, ip, *added)
+
+            return len(pending)
+
+
+def last_seen_member(mac, vlan=None, ip=None):
+    '''
+    returns member of last seen sorted set for mac (optionally on vlan with ip): 'mac', 'mac|vlan' or 'mac|vlan|ip'.
+    ip ignored if vlan not specified
+    '''
+    if vlan is None:
+        return mac
+    if ip is None:
+        return mac + '|' + vlan
+    return mac + '|' + vlan + '|' + ip
+
+
+def parse_last_seen_member(member):
+    'returns tuple of mac, vlan and ip (vlan and ip may be None) of last seen member'
+    mac, vlan, ip = (member.split('|') + [None, None])[:3]
+    return mac, vlan, ip
+
+
+# Converts last seen members from former format (JSON dicts) to `last_seen_member` format, atomically.
+# A member already in new format (written meanwhile) keeps the latest of both times.
+# KEYS: last seen, migrated marker (set once done). Returns number of members converted.
+_migrate_last_seen_script = synapse.register_script('''
+local members = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+local converted = 0
+for i = 1, #members, 2 do
+    local member, last_seen = members[i], tonumber(members[i + 1])
+    if string.sub(member, 1, 1) == '{' then
+        local old = cjson.decode(member)
+        local new = old['mac']
+        if old['vlan'] then
+            new = new .. '|' .. old['vlan']
+            if old['ip'] then
+                new = new .. '|' .. old['ip']
+            end
+        end
+        new = '"' .. new .. '"'  -- JSON encoded, as Synapse does
+        local current = redis.call('ZSCORE', KEYS[1], new)
+        if not current or tonumber(current) < last_seen then
+            redis.call('ZADD', KEYS[1], last_seen, new)
+        end
+        redis.call('ZREM', KEYS[1], member)
+        converted = converted + 1
+    end
+end
+redis.call('SET', KEYS[2], 1)
+return converted
+''')
+
+_last_seen_migrated = False
+_last_seen_migration_lock = threading.Lock()
+
+
+def migrate_last_seen():
+    '''
+    Converts last seen members from former format (dicts) to `last_seen_member` format, keeping their last seen time.
+    Idempotent. Returns number of members converted.
+    '''
+    return _migrate_last_seen_script(keys=[LAST_SEEN_PATH, LAST_SEEN_MIGRATED_PATH])
 
-    if ip_added:
-        notify_new_IP_session(mac=mac, vlan=vlan, ip=ip, port=port, start=time, mac_local_id=mac_local_id, vlan_local_id=vlan_local_id, ip_local_id=local_id)
-    elif vlan_added:
-        notify_new_VLAN_session(mac=mac, vlan=vlan, port=port, start=time, mac_local_id=mac_local_id, vlan_local_id=local_id)
-    elif mac_added:
-        notify_new_MAC_session(mac=mac, port=port, start=time, mac_local_id=local_id)
 
-    return mac_added, vlan_added, ip_added
+def ensure_last_seen_migrated():
+    '''
+    Runs `migrate_last_seen` before the process first writes last seen members, unless already done (by any process):
+    sessions in former format would otherwise be considered new.
+    '''
+    global _last_seen_migrated
+
+    if not _last_seen_migrated:
+        with _last_seen_migration_lock:
+            if not _last_seen_migrated:
+                if not synapse.exists(LAST_SEEN_MIGRATED_PATH):
+                    migrate_last_seen()
+                _last_seen_migrated = True
 
 
 def session_ids_field(mac, vlan=None, ip=None):
@@ -241,6 +633,8 @@ def end(mac, vlan=None, ip=None, time=None):
     if time is None:
         time = (datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)).total_seconds()  # Epoch
 
+    ensure_last_seen_migrated()
+
     pipe = synapse.pipeline()
 
     if ip is not None and vlan is None:
@@ -252,7 +646,7 @@ def end(mac, vlan=None, ip=None, time=None):
     # find all Objects to end (if mac, end also vlans and IPs, if vlan, end also IPs)
     if vlan is None:
         pipe.hdel(SESSION_IDS_PATH, session_ids_field(**data))
-        pipe.zrem(LAST_SEEN_PATH, data)
+        pipe.zrem(LAST_SEEN_PATH, last_seen_member(**data))
         vlans = synapse.smembers(MAC_VLANS_PATH.format(mac=mac))
         pipe.delete(MAC_VLANS_PATH.format(mac=mac))
     else:
@@ -263,7 +657,7 @@ def end(mac, vlan=None, ip=None, time=None):
         data = dict(mac=mac, vlan=v)
         if ip is None:
             pipe.hdel(SESSION_IDS_PATH, session_ids_field(**data))
-            pipe.zrem(LAST_SEEN_PATH, data)
+            pipe.zrem(LAST_SEEN_PATH, last_seen_member(**data))
             pipe.srem(MAC_VLANS_PATH.format(mac=mac), v)
             ips = synapse.smembers(MAC_VLAN_IPS_PATH.format(mac=mac, vlan=v))
             pipe.delete(MAC_VLAN_IPS_PATH.format(mac=mac, vlan=v))
@@ -274,7 +668,7 @@ def end(mac, vlan=None, ip=None, time=None):
         for i in ips:
             data = dict(mac=mac, vlan=v, ip=i)
             pipe.hdel(SESSION_IDS_PATH, session_ids_field(**data))
-            pipe.zrem(LAST_SEEN_PATH, data)
+            pipe.zrem(LAST_SEEN_PATH, last_seen_member(**data))
 
     results = pipe.execute()
 
@@ -300,6 +694,75 @@ def end(mac, vlan=None, ip=None, time=None):
         notify_end_MAC_session(mac=mac, mac_local_id=mac_local_id, end=time)
 
 
+async def end_async(mac, vlan=None, ip=None, time=None):
+    '''
+    Same as `end` for coroutines.
+    '''
+    if time is None:
+        time = (datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)).total_seconds()  # Epoch
+
+    if not _last_seen_migrated:
+        await asyncio.get_event_loop().run_in_executor(None, ensure_last_seen_migrated)
+
+    pipe = async_synapse.pipeline()
+
+    if ip is not None and vlan is None:
+        raise Exception('Error: when ending IP, VLAN should be specified...')
+
+    data = dict(mac=mac)
+    pipe.hget(SESSION_IDS_PATH, session_ids_field(**data))
+
+    # find all Objects to end (if mac, end also vlans and IPs, if vlan, end also IPs)
+    if vlan is None:
+        pipe.hdel(SESSION_IDS_PATH, session_ids_field(**data))
+        pipe.zrem(LAST_SEEN_PATH, last_seen_member(**data))
+        vlans = await async_synapse.smembers(MAC_VLANS_PATH.format(mac=mac))
+        pipe.delete(MAC_VLANS_PATH.format(mac=mac))
+    else:
+        data = dict(mac=mac, vlan=vlan)
+        pipe.hget(SESSION_IDS_PATH, session_ids_field(**data))
+        vlans = [vlan]
+    for v in vlans:
+        data = dict(mac=mac, vlan=v)
+        if ip is None:
+            pipe.hdel(SESSION_IDS_PATH, session_ids_field(**data))
+            pipe.zrem(LAST_SEEN_PATH, last_seen_member(**data))
+            pipe.srem(MAC_VLANS_PATH.format(mac=mac), v)
+            ips = await async_synapse.smembers(MAC_VLAN_IPS_PATH.format(mac=mac, vlan=v))
+            pipe.delete(MAC_VLAN_IPS_PATH.format(mac=mac, vlan=v))
+        else:
+            data = dict(mac=mac, vlan=v, ip=ip)
+            pipe.hget(SESSION_IDS_PATH, session_ids_field(**data))
+            ips = [ip]
+        for i in ips:
+            data = dict(mac=mac, vlan=v, ip=i)
+            pipe.hdel(SESSION_IDS_PATH, session_ids_field(**data))
+            pipe.zrem(LAST_SEEN_PATH, last_seen_member(**data))
+
+    results = await pipe.execute()
+
+    mac_local_id = results[0]
+    if vlan is not None:
+        vlan_local_id = results[1]
+        if ip is not None:
+            ip_local_id = results[2]
+
+    if ip is not None:
+        if ip_local_id:
+            notify_end_IP_session(mac=mac, mac_local_id=mac_local_id, vlan=vlan, vlan_local_id=vlan_local_id, ip=ip, ip_local_id=ip_local_id, end=time)
+    elif vlan is not None:
+        if vlan_local_id:
+            notify_end_VLAN_session(mac=mac, mac_local_id=mac_local_id, vlan=vlan, vlan_local_id=vlan_local_id, end=time)
+    elif mac_local_id:
+        port = await async_synapse.hget(MAC_PORT_PATH, mac)
+        pipe.hdel(MAC_PORT_PATH, mac)
+        if port and 'interface' in port:
+            pipe.srem(PORT_MACS_PATH.format(**port), mac)
+        await pipe.execute()
+        await remove_till_disconnect_authentication_session_async(mac)
+        notify_end_MAC_session(mac=mac, mac_local_id=mac_local_id, end=time)
+
+
 def add_authentication_session(mac, **session):
     '''
     add authentication session to device
@@ -322,10 +785,34 @@ def add_authentication_session(mac, **session):
     synapse.sadd(MAC_AUTH_SESSION_PATH.format(mac=mac), session)
 
 
+async def add_authentication_session_async(mac, **session):
+    ''' Same as `add_authentication_session` for coroutines '''
+    if 'source' not in session:
+        raise ValueError('source mandatory')
+
+    await remove_expired_authentication_session_async(mac)
+
+    if 'till_disconnect' not in session:
+        session['till_disconnect'] = 'till' not in session
+
+    await async_synapse.sadd(MAC_AUTH_SESSION_PATH.format(mac=mac), session)
+
+
 def get_authentication_sessions(mac, **filters):
     # cleanup
     remove_expired_authentication_session(mac)
     authentications = synapse.smembers_as_list(MAC_AUTH_SESSION_PATH.format(mac=mac))
+    return _filter_authentication_sessions(authentications, filters)
+
+
+async def get_authentication_sessions_async(mac, **filters):
+    ''' Same as `get_authentication_sessions` for coroutines '''
+    await remove_expired_authentication_session_async(mac)
+    authentications = await async_synapse.smembers_as_list(MAC_AUTH_SESSION_PATH.format(mac=mac))
+    return _filter_authentication_sessions(authentications, filters)
+
+
+def _filter_authentication_sessions(authentications, filters):
     filtered = []
     for auth in authentications:
         for key in filters:
@@ -351,6 +838,14 @@ def remove_authentication_sessions_by_source(mac, source):
             synapse.srem(MAC_AUTH_SESSION_PATH.format(mac=mac), session)
 
 
+async def remove_authentication_sessions_by_source_async(mac, source):
+    ''' Same as `remove_authentication_sessions_by_source` for coroutines '''
+    current_sessions = await async_synapse.smembers_as_list(MAC_AUTH_SESSION_PATH.format(mac=mac))
+    sessions = [session for session in current_sessions if session['source'] == source]
+    if sessions:
+        await async_synapse.srem(MAC_AUTH_SESSION_PATH.format(mac=mac), *sessions)
+
+
 def remove_till_disconnect_authentication_session(mac):
 
     # TODO: redis transaction
@@ -360,6 +855,14 @@ def remove_till_disconnect_authentication_session(mac):
             synapse.srem(MAC_AUTH_SESSION_PATH.format(mac=mac), session)
 
 
+async def remove_till_disconnect_authentication_session_async(mac):
+    ''' Same as `remove_till_disconnect_authentication_session` for coroutines '''
+    current_sessions = await async_synapse.smembers_as_list(MAC_AUTH_SESSION_PATH.format(mac=mac))
+    sessions = [session for session in current_sessions if session.get('till_disconnect')]
+    if sessions:
+        await async_synapse.srem(MAC_AUTH_SESSION_PATH.format(mac=mac), *sessions)
+
+
 def remove_expired_authentication_session(mac, date=None):
     '''
     remove all sessions that have expired, or all sessions that have/will expire at date (epoch)
@@ -374,6 +877,17 @@ def remove_expired_authentication_session(mac, date=None):
         if 'till' in session and session['till'] <= date:
             synapse.srem(MAC_AUTH_SESSION_PATH.format(mac=mac), session)
 
+
+async def remove_expired_authentication_session_async(mac, date=None):
+    ''' Same as `remove_expired_authentication_session` for coroutines '''
+    if date is None:
+        date = (datetime.datetime.utcnow() - datetime.datetime(1970, 1, 1)).total_seconds()  # now as EPOCH
+
+    current_sessions = await async_synapse.smembers_as_list(MAC_AUTH_SESSION_PATH.format(mac=mac)) or []
+    expired = [session for session in current_sessions if 'till' in session and session['till'] <= date]
+    if expired:
+        await async_synapse.srem(MAC_AUTH_SESSION_PATH.format(mac=mac), *expired)
+
 # Control Center Notifications
 
 
@@ -3,6 +3,7 @@ import datetime
 import json
 
 from elan import session
+from elan.async_synapse import AsyncSynapse
 from elan.event import Event, DebugEvent
 from elan.neuron import Synapse, Dendrite
 
@@ -35,6 +36,7 @@ class DeviceSnmpManager():
 
     def __init__(self):
         self.synapse = Synapse()
+        self.async_synapse = AsyncSynapse()  # for coroutines, so that they do not block the event loop
 
         now = datetime.datetime.now()
         if DeviceSnmpManager.DEVICE_PORTS_WITH_NEW_MAC_TIMESTAMPS is None:
@@ -76,6 +78,12 @@ class DeviceSnmpManager():
             return
         return self.get_device_by_id(device_id)
 
+    async def get_device_by_ip_async(self, ip):
+        device_id = await self.async_synapse.hget(self.DEVICE_IP_SNMP_CACHE_PATH, ip)
+        if device_id is None:
+            return
+        return await self.async_synapse.hget(self.DEVICE_SNMP_CACHE_PATH, device_id)
+
     def switch_has_changed(self, device1, device2):
 
         def almost_equal_dicts(a, b, ignore_keys):
@@ -120,19 +128,18 @@ class DeviceSnmpManager():
             return
 
         # Try to find a cached device
-        device_id = self.get_id_by_ip(ip)
+        device_id = await self.async_synapse.hget(self.DEVICE_IP_SNMP_CACHE_PATH, ip)
 
         if not device_id and 'ports' in device_snmp:
             # Try to find cached device by mac
-            for port in device_snmp['ports']:
-                device_id = self.get_id_by_mac(port['mac'])
-                if device_id:
-                    break
+            port_macs = [port['mac'] for port in device_snmp['ports']]
+            if port_macs:
+                device_id = next(filter(None, await self.async_synapse.hmget(self.DEVICE_MAC_SNMP_CACHE_PATH, port_macs)), None)
 
         if device_id:
-            cached_device = self.get_device_by_id(device_id)
+            cached_device = await self.async_synapse.hget(self.DEVICE_SNMP_CACHE_PATH, device_id)
         else:
-            device_id = self.get_new_device_id()
+            device_id = await self.async_synapse.incr(self.DEVICE_SNMP_ID_COUNTER)
             cached_device = None
 
         device_snmp['local_id'] = device_id
@@ -143,7 +150,7 @@ class DeviceSnmpManager():
                 # notify if has changed. Only send relevant keys
                 Dendrite.publish_single('snmp', { k:v for k, v in device_snmp.items() if k not in IGNORE_SWITCH_KEYS })
             # cache the device, including dynamic fields like fw_mac
-            with self.synapse.pipeline() as pipe:
+            with self.async_synapse.pipeline() as pipe:
                 pipe.hset(self.DEVICE_SNMP_CACHE_PATH, device_id, device_snmp)
                 pipe.hset(self.DEVICE_IP_SNMP_CACHE_PATH, ip, device_id)
                 cached_macs = set()
@@ -159,7 +166,7 @@ class DeviceSnmpManager():
                     pipe.hdel(self.DEVICE_MAC_SNMP_CACHE_PATH, mac)
                 for mac in device_macs - cached_macs:  # new macs
                     pipe.hset(self.DEVICE_MAC_SNMP_CACHE_PATH, mac, device_id)
-                pipe.execute()
+                await pipe.execute()
         return device_snmp
 
     async def _parse_trap_str(self, ip, trap_str, read_params):
@@ -168,10 +175,10 @@ class DeviceSnmpManager():
 
     async def get_read_params(self, device_ip):
         # Grab SNMP read credentials of device
-        read_params = self.synapse.hget(SNMP_READ_PARAMS_CACHE_PATH, device_ip)
+        read_params = await self.async_synapse.hget(SNMP_READ_PARAMS_CACHE_PATH, device_ip)
         if not read_params:
             if await self.poll(device_ip, timeout=600):  # No Cached params, may take time to test them all
-                read_params = self.synapse.hget(SNMP_READ_PARAMS_CACHE_PATH, device_ip)
+                read_params = await self.async_synapse.hget(SNMP_READ_PARAMS_CACHE_PATH, device_ip)
             # TOTO: send alert to CC ON if not read_params here
         return read_params
 
@@ -240,7 +247,7 @@ class DeviceSnmpManager():
                   (trap['trapType'] == ['mac'] and trap['trapOperation'] == 'learnt'):
                     port = await self.getPortFromIndex(device_ip, trap.get('trapIfIndex', None))
                     vlan = trap.get('vlan', None)
-                    session.seen(trap['trapMac'], vlan=vlan, port=port, time=trap_time)
+                    await session.seen_async(trap['trapMac'], vlan=vlan, port=port, time=trap_time)
                     if port is None:
                         DebugEvent(source='snmp-notification')\
                             .add_data('details', 'Port not found')\
@@ -249,21 +256,21 @@ class DeviceSnmpManager():
                             .notify()
                 elif trap['trapType'] == 'dot11Deauthentication'or \
                     (trap['trapType'] == ['mac'] and trap['trapOperation'] == 'removed'):
-                    session.end(mac=trap['trapMac'], time=trap_time)
+                    await session.end_async(mac=trap['trapMac'], time=trap_time)
             elif trap['trapType'] in ['up', 'down']:
                 port = await self.getPortFromIndex(device_ip, trap['trapIfIndex'])
                 if port:
                     port['device_ip'] = device_ip
                     if trap['trapType'] == 'up':
                         # remember this port could have new ip.
-                        self.port_has_new_macs(port)
+                        await self.port_has_new_macs_async(port)
                     else:
-                        self.port_has_no_new_macs(port)
+                        await self.port_has_no_new_macs_async(port)
                         # remove macs that are no longer on port
                         mac_ports = await self.get_macs_on_device(device_ip)
-                        for mac in session.port_macs(port):
+                        for mac in await session.port_macs_async(port):
                             if mac not in mac_ports:
-                                session.end(mac)
+                                await session.end_async(mac)
 
             # TODO: Mark Port as potentially containing a new  mac -> macksuck when new mac?
         else:
@@ -296,24 +303,39 @@ class DeviceSnmpManager():
         self.DEVICE_PORTS_WITH_NEW_MAC_TIMESTAMPS[frozenset(port.items())] = datetime.datetime.now()
         self.expire_ports_with_new_macs()
 
+    async def port_has_new_macs_async(self, port):
+        ''' Same as `port_has_new_macs` for coroutines '''
+        await self.async_synapse.sadd(self.DEVICE_PORTS_WITH_NEW_MAC_PATH, port)
+        self.DEVICE_PORTS_WITH_NEW_MAC_TIMESTAMPS[frozenset(port.items())] = datetime.datetime.now()
+        for expired_port in self.expired_ports_with_new_macs():
+            await self.port_has_no_new_macs_async(expired_port)
+
     def port_has_no_new_macs(self, port):
         self.synapse.srem(self.DEVICE_PORTS_WITH_NEW_MAC_PATH, port)
         self.DEVICE_PORTS_WITH_NEW_MAC_TIMESTAMPS.pop(frozenset(port.items()), None)
 
+    async def port_has_no_new_macs_async(self, port):
+        ''' Same as `port_has_no_new_macs` for coroutines '''
+        await self.async_synapse.srem(self.DEVICE_PORTS_WITH_NEW_MAC_PATH, port)
+        self.DEVICE_PORTS_WITH_NEW_MAC_TIMESTAMPS.pop(frozenset(port.items()), None)
+
     def get_ports_with_new_macs(self):
         self.expire_ports_with_new_macs()
         return self.synapse.smembers_as_list(self.DEVICE_PORTS_WITH_NEW_MAC_PATH)
 
     def expire_ports_with_new_macs(self):
+        for port in self.expired_ports_with_new_macs():
+            self.port_has_no_new_macs(port)
+
+    def expired_ports_with_new_macs(self):
         if DeviceSnmpManager.DEVICE_PORTS_WITH_NEW_MAC_TIMESTAMPS is None:
-            return
+            return []
         now = datetime.datetime.now()
         to_delete = []
         for f_port, timestamp in self.DEVICE_PORTS_WITH_NEW_MAC_TIMESTAMPS.items():
             if now - timestamp > self.DEVICE_PORTS_WITH_NEW_MAC_TIMEOUT:
                 to_delete.append({k:v for k, v in f_port})
-        for port in to_delete:
-            self.port_has_no_new_macs(port)
+        return to_delete
 
     async def get_macs_on_device(self, device_ip):
         '''
@@ -360,7 +382,7 @@ class DeviceSnmpManager():
                 device = await self.poll(device_ip)
                 device_polled = True
             else:
-                device = self.get_device_by_ip(device_ip)
+                device = await self.get_device_by_ip_async(device_ip)
                 if not device and not no_poll:
                     device = await self.poll(device_ip)
                     device_polled = True
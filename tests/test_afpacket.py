@@ -0,0 +1,91 @@
+import itertools
+import socket
+import struct
+import unittest
+from unittest import mock
+
+from elan import afpacket
+
+
+BLOCK_SIZE = 256
+
+
+def make_ring(blocks):
+    '''
+    Returns a `Ring` reading from memory instead of a socket ring.
+    `blocks` is a list of lists of frames, each list being the frames of a ready block.
+    '''
+    ring = afpacket.Ring.__new__(afpacket.Ring)
+    ring.block_size = BLOCK_SIZE
+    ring.block_nr = max(len(blocks), 1) + 1
+    ring.current_block = 0
+    ring.ring = bytearray(BLOCK_SIZE * ring.block_nr)
+    for block_index, frames in enumerate(blocks):
+        block_offset = block_index * BLOCK_SIZE
+        offset = 32
+        afpacket.BLOCK_HEADER.pack_into(ring.ring, block_offset + afpacket.BLOCK_STATUS_OFFSET, afpacket.TP_STATUS_USER, len(frames), offset)
+        for frame in frames:
+            mac = afpacket.PACKET_HEADER_LEN + 32
+            next_offset = mac + len(frame)
+            afpacket.PACKET_HEADER.pack_into(ring.ring, block_offset + offset, next_offset, 1, 0, len(frame), len(frame), 0, mac, mac, 0, 0)
+            ring.ring[block_offset + offset + mac:block_offset + offset + next_offset] = frame
+            offset += next_offset
+    return ring
+
+
+class BusyRing():
+    ''' Ring that always has a ready block of one frame '''
+
+    def __init__(self):
+        self.socket, self.peer = socket.socketpair()
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        self.socket.close()
+        self.peer.close()
+
+    def ready(self):
+        return True
+
+    def frames(self, inbound=False, max_blocks=None):
+        for _ in itertools.islice(itertools.count(), max_blocks):
+            yield b'busy', 0, 1.0
+
+
+class RingTest(unittest.TestCase):
+
+    def test_frames(self):
+        ring = make_ring([[b'frame1', b'frame2'], [b'frame3']])
+
+        self.assertTrue(ring.ready())
+        self.assertEqual([frame for frame, vlan_id, timestamp in ring.frames()], [b'frame1', b'frame2', b'frame3'])
+        self.assertFalse(ring.ready())
+        self.assertEqual(list(ring.frames()), [])
+
+    def test_frames_max_blocks(self):
+        ring = make_ring([[b'frame1', b'frame2'], [b'frame3']])
+
+        self.assertEqual([frame for frame, vlan_id, timestamp in ring.frames(max_blocks=1)], [b'frame1', b'frame2'])
+        self.assertTrue(ring.ready())
+        self.assertEqual(struct.unpack_from('=I', ring.ring, afpacket.BLOCK_STATUS_OFFSET)[0], afpacket.TP_STATUS_KERNEL)  # first block given back
+        self.assertEqual([frame for frame, vlan_id, timestamp in ring.frames(max_blocks=1)], [b'frame3'])
+        self.assertFalse(ring.ready())
+
+
+class RingCaptureTest(unittest.TestCase):
+
+    def test_busy_ring_does_not_starve_others(self):
+        busy_ring = BusyRing()
+        quiet_ring = make_ring([[b'quiet1'], [b'quiet2']])
+        quiet_ring.fileno = busy_ring.fileno
+        try:
+            with mock.patch('elan.afpacket.Ring', side_effect=[busy_ring, quiet_ring]):
+                capture = afpacket.RingCapture(['eth0', 'eth1'])
+
+            frames = [(index, frame) for index, frame, vlan_id, timestamp in itertools.islice(capture, 6)]
+        finally:
+            busy_ring.close()
+
+        self.assertEqual(frames, [(0, b'busy'), (1, b'quiet1'), (0, b'busy'), (1, b'quiet2'), (0, b'busy'), (0, b'busy')])
@@ -1,3 +1,4 @@
+from unittest import mock
 import sys
 import unittest
 
@@ -27,3 +28,111 @@ class IgnorePacket(unittest.TestCase):
         assert(connection_trackerd.ignorePacket({'src' : { 'mac': '02:00:5e:05:06:07' }, 'dst' : { 'mac': '02:00:5e:05:06:07'}}) == True)
         assert(connection_trackerd.ignorePacket({'src' : { 'mac': '33:33:ff:ff:ff:01' }, 'dst' : { 'mac': '01:02:03:04:05:06'}}) == True)
         assert(connection_trackerd.ignorePacket({'src' : { 'mac': 'ff:ff:ff:ff:ff:01' }, 'dst' : { 'mac': '33:33:03:04:05:06'}}) == True)
+
+
+class DecodePacket(unittest.TestCase):
+    hwhdr = bytes.fromhex('010203040506' '0a0b0c0d0e0f' '0800')
+
+    def test_decode_ipv4_tcp(self):
+        packet = bytes.fromhex(
+            '4500003c00004000400600000a000001' '0a000002'  # IPv4 10.0.0.1 -> 10.0.0.2, TCP
+            '04d20050000000000000000050020000' '00000000'  # TCP 1234 -> 80
+        )
+        pkt_params = connection_trackerd.decode_packet(packet, self.hwhdr)
+
+        self.assertEqual(pkt_params['src'], {'mac': '0a:0b:0c:0d:0e:0f', 'ip': '10.0.0.1', 'port': '1234'})
+        self.assertEqual(pkt_params['dst'], {'mac': '01:02:03:04:05:06', 'ip': '10.0.0.2', 'port': '80'})
+        self.assertEqual(pkt_params['transport'], 'tcp')
+        self.assertEqual(pkt_params['protocol'], 'tcp')
+
+    def test_decode_ipv6_udp(self):
+        packet = bytes.fromhex(
+            '6000000000081140' '20010db8000000000000000000000001' '20010db8000000000000000000000002'  # IPv6, UDP
+            'c0000035' '00080000'  # UDP 49152 -> 53
+        )
+        pkt_params = connection_trackerd.decode_packet(packet, self.hwhdr)
+
+        self.assertEqual(pkt_params['src'], {'mac': '0a:0b:0c:0d:0e:0f', 'ip': '2001:db8::1', 'port': '49152'})
+        self.assertEqual(pkt_params['dst'], {'mac': '01:02:03:04:05:06', 'ip': '2001:db8::2', 'port': '53'})
+        self.assertEqual(pkt_params['transport'], 'udp')
+        self.assertEqual(pkt_params['protocol'], 'dns')
+
+    def test_decode_icmp(self):
+        packet = bytes.fromhex('450000540000400040010000c0a80001c0a80002' '0800000000000000')
+        pkt_params = connection_trackerd.decode_packet(packet, self.hwhdr)
+
+        self.assertNotIn('transport', pkt_params)
+        self.assertNotIn('port', pkt_params['src'])
+        self.assertEqual(pkt_params['protocol'], 'icmp')
+
+    def test_decode_truncated(self):
+        self.assertIsNone(connection_trackerd.decode_packet(b'\x45\x00', self.hwhdr))
+        self.assertIsNone(connection_trackerd.decode_packet(b'', self.hwhdr))
+
+
+class IfIndexToVlan(unittest.TestCase):
+
+    def setUp(self):
+        connection_trackerd._if_index_vlans.clear()
+
+    def tearDown(self):
+        connection_trackerd._if_index_vlans.clear()
+
+    @mock.patch('connection_trackerd.time.monotonic', return_value=1000)
+    @mock.patch('connection_trackerd.if_indextoname', side_effect=['eth0', 'eth1.10'])
+    def test_names_cached_for_ttl(self, if_indextoname, monotonic):
+        self.assertEqual(connection_trackerd.if_index_to_vlan(3), 'eth0.0')
+        self.assertEqual(connection_trackerd.if_index_to_vlan(3), 'eth0.0')
+        self.assertEqual(if_indextoname.call_count, 1)
+
+        # index reused by another interface
+        monotonic.return_value += connection_trackerd.IF_INDEX_CACHE_TTL
+        self.assertEqual(connection_trackerd.if_index_to_vlan(3), 'eth1.10')
+        self.assertEqual(if_indextoname.call_count, 2)
+
+    @mock.patch('connection_trackerd.if_indextoname', side_effect=[None, 'eth0'])
+    def test_unknown_not_cached(self, if_indextoname):
+        self.assertIsNone(connection_trackerd.if_index_to_vlan(3))
+        self.assertEqual(connection_trackerd.if_index_to_vlan(3), 'eth0.0')
+
+
+class PublishRecorder():
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, data):
+        self.published.append((topic, data))
+
+
+class BatchProcessing(unittest.TestCase):
+    hwhdr = DecodePacket.hwhdr
+    packet = bytes.fromhex('450000540000400040010000c0a80001c0a80002' '0800000000000000')
+
+    def test_batch_flushed_when_full(self):
+        dendrite = PublishRecorder()
+        ct = connection_trackerd.ConnectionTracker(dendrite=dendrite, batch_size=3)
+
+        ct.process_packet(self.packet, self.hwhdr, ts=0)
+        ct.process_packet(self.packet, self.hwhdr, ts=0)
+        self.assertEqual(dendrite.published, [])
+
+        ct.process_packet(self.packet, self.hwhdr, ts=0)
+        self.assertEqual(len(dendrite.published), 3)
+        self.assertEqual(ct.batch, [])
+
+        topic, pkt_params = dendrite.published[0]
+        self.assertEqual(topic, 'connection')
+        self.assertEqual(pkt_params['start'], '1970-01-01T00:00:00Z')
+        self.assertFalse(pkt_params['src']['is_mac_ip'])
+        self.assertFalse(pkt_params['dst']['is_mac_ip'])
+
+    def test_flush(self):
+        dendrite = PublishRecorder()
+        ct = connection_trackerd.ConnectionTracker(dendrite=dendrite, batch_size=100)
+
+        ct.process_packet(self.packet, self.hwhdr, ts=0)
+        self.assertIsNotNone(ct.batch_deadline)
+        ct.flush()
+
+        self.assertEqual(len(dendrite.published), 1)
+        self.assertIsNone(ct.batch_deadline)
@@ -1,13 +1,15 @@
 from unittest.mock import patch, Mock
 from uuid import uuid4
+import asyncio
 import concurrent.futures
 import json
+import threading
 import time
 import unittest
 
 from paho.mqtt import client
 
-from elan.neuron import Dendrite, RequestTimeout, RequestError
+from elan.neuron import AsyncDendrite, ConfObject, ConfStore, Dendrite, Dispatcher, RequestTimeout, RequestError, Synapse
 
 
 class DendriteTest(unittest.TestCase):
@@ -194,6 +196,41 @@ class DendriteTest(unittest.TestCase):
 
         Dendrite.publish_single('test/get', retain=True)
 
+    def test_concurrent_calls(self):
+
+        def cb(data):
+            time.sleep(0.01 * (data % 5))
+            return data * 2
+
+        self.dendrite.provide('test/double', cb, workers=10)
+
+        with concurrent.futures.ThreadPoolExecutor(20) as executor:
+            results = list(executor.map(lambda data: self.dendrite.call('test/double', data, timeout=5), range(100)))
+
+        self.assertEqual(results, [data * 2 for data in range(100)])
+        answer_topics = [topic for topic in self.dendrite.topics if topic.startswith('service/answers/test/double/')]
+        self.assertEqual(answer_topics, ['service/answers/test/double/{}/+'.format(self.dendrite.answers_id)])
+        self.assertEqual(self.dendrite.pending_calls, {})
+
+    def test_call_timeout(self):
+        with self.assertRaises(RequestTimeout):
+            self.dendrite.call('test/nobody', timeout=0.5)
+        self.assertEqual(self.dendrite.pending_calls, {})
+
+    def test_call_from_single_worker_provider(self):
+
+        def inner(data):
+            return data + 1
+
+        def outer(data):
+            return self.dendrite.call('test/inner', data, timeout=5) * 2
+
+        self.dendrite.provide('test/inner', inner, workers=1)
+        self.dendrite.provide('test/outer', outer, workers=1)
+
+        self.assertEqual(self.dendrite.call('test/outer', 1, timeout=5), 4)
+        self.assertEqual(self.dendrite.dispatch_stats()['service/requests/test/outer']['dropped'], 0)
+
     def test_subscribe_cb_exception_catch(self):
         event_instance = Mock()
         with patch('elan.event.ExceptionEvent', return_value=event_instance) as ExceptionEventMock:
@@ -219,3 +256,288 @@ class DendriteTest(unittest.TestCase):
 
         event_instance.notify.assert_called_once_with()
 
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def test_drops_when_full(self):
+        release = threading.Event()
+        started = threading.Event()
+
+        def run(data, topic):
+            started.set()
+            release.wait(2)
+
+        dispatcher = Dispatcher(run, workers=1, max_size=2, block=False)
+        self.assertTrue(dispatcher.dispatch(1, 'test'))
+        started.wait(2)
+        self.assertTrue(dispatcher.dispatch(2, 'test'))
+        self.assertTrue(dispatcher.dispatch(3, 'test'))
+        self.assertFalse(dispatcher.dispatch(4, 'test'))
+
+        stats = dispatcher.stats()
+        self.assertEqual(stats['depth'], 2)
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['workers'], 1)
+
+        release.set()
+        dispatcher.stop()
+
+    def test_blocks_when_full(self):
+        release = threading.Event()
+        started = threading.Event()
+        processed = []
+
+        def run(data, topic):
+            started.set()
+            release.wait(2)
+            processed.append(data)
+
+        dispatcher = Dispatcher(run, workers=1, max_size=1)
+        self.assertTrue(dispatcher.dispatch(1, 'test'))
+        started.wait(2)
+        self.assertTrue(dispatcher.dispatch(2, 'test'))
+
+        dispatched = threading.Thread(target=dispatcher.dispatch, args=(3, 'test'))
+        dispatched.start()
+        dispatched.join(0.2)
+        self.assertTrue(dispatched.is_alive())
+
+        release.set()
+        dispatched.join(2)
+        self.assertFalse(dispatched.is_alive())
+        dispatcher.stop()
+
+        for _ in range(20):
+            if len(processed) == 3:
+                break
+            time.sleep(0.1)
+        self.assertEqual(processed, [1, 2, 3])
+        self.assertEqual(dispatcher.stats()['dropped'], 0)
+
+    def test_key_ordering(self):
+        results = {}
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def run(data, topic):
+            mac, index = data
+            time.sleep(0.001 * (index % 3))
+            with lock:
+                results.setdefault(mac, []).append(index)
+                if sum(len(indexes) for indexes in results.values()) == 200:
+                    done.set()
+
+        dispatcher = Dispatcher(run, workers=4, key=lambda data: data[0])
+        for index in range(50):
+            for mac in ('00:00:00:00:00:01', '00:00:00:00:00:02', '00:00:00:00:00:03', '00:00:00:00:00:04'):
+                dispatcher.dispatch((mac, index), 'test')
+
+        self.assertTrue(done.wait(5))
+        for indexes in results.values():
+            self.assertEqual(indexes, list(range(50)))
+        self.assertEqual(dispatcher.stats()['processed'], 200)
+        dispatcher.stop()
+
+    def test_bounded_threads(self):
+        done = threading.Event()
+        count = []
+
+        def run(data, topic):
+            count.append(data)
+            if len(count) == 1000:
+                done.set()
+
+        threads = threading.active_count()
+        dispatcher = Dispatcher(run, workers=3)
+        for index in range(1000):
+            dispatcher.dispatch(index, 'test')
+        self.assertLessEqual(threading.active_count(), threads + 3)
+
+        self.assertTrue(done.wait(5))
+        dispatcher.stop()
+
+
+class AsyncDendriteTest(unittest.TestCase):
+    'These tests require a MQTT broker'
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.dendrite = Dendrite()
+        self.async_dendrite = AsyncDendrite(self.dendrite, loop=self.loop)
+
+    def tearDown(self):
+        self.dendrite.finish()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_call(self):
+
+        def cb(data):
+            if data is None:
+                raise RequestError('no data')
+            return data * 2
+
+        self.dendrite.provide('test/async-double', cb, workers=10)
+
+        async def calls():
+            return await asyncio.gather(*[self.async_dendrite.call('test/async-double', data, timeout=5) for data in range(100)])
+
+        self.assertEqual(self.loop.run_until_complete(calls()), [data * 2 for data in range(100)])
+
+        with self.assertRaises(RequestError):
+            self.loop.run_until_complete(self.async_dendrite.call('test/async-double', timeout=5))
+
+        with self.assertRaises(RequestTimeout):
+            self.loop.run_until_complete(self.async_dendrite.call('test/nobody', timeout=0.5))
+        self.assertEqual(self.dendrite.pending_calls, {})
+
+    def test_subscribe(self):
+
+        async def receive():
+            messages = []
+            async with self.async_dendrite.subscribe('test/async/#') as subscription:
+                await asyncio.sleep(0.5)
+                for index in range(3):
+                    await self.async_dendrite.publish('test/async/{}'.format(index), {'index': index})
+                async for data, topic in subscription:
+                    messages.append((data, topic))
+                    if len(messages) == 3:
+                        break
+            return messages
+
+        messages = self.loop.run_until_complete(asyncio.wait_for(receive(), 5))
+
+        self.assertEqual(messages, [({'index': index}, 'test/async/{}'.format(index)) for index in range(3)])
+        self.assertNotIn('test/async/#', self.dendrite.topics)
+
+    def test_subscribe_full_queue(self):
+
+        async def receive():
+            messages = []
+            async with self.async_dendrite.subscribe('test/async-full/#', max_queue=1) as subscription:
+                await asyncio.sleep(0.5)
+                for index in range(5):
+                    await self.async_dendrite.publish('test/async-full/{}'.format(index), index)
+                await asyncio.sleep(0.5)  # queue full, network loop waits
+                async for data, topic in subscription:
+                    messages.append(data)
+                    if len(messages) == 5:
+                        break
+                return messages, subscription.dropped
+
+        messages, dropped = self.loop.run_until_complete(asyncio.wait_for(receive(), 5))
+
+        self.assertEqual(messages, list(range(5)))
+        self.assertEqual(dropped, 0)
+
+        async def close_when_full():
+            async with self.async_dendrite.subscribe('test/async-full/#', max_queue=1):
+                await asyncio.sleep(0.5)
+                for index in range(3):
+                    await self.async_dendrite.publish('test/async-full/{}'.format(index), index)
+                await asyncio.sleep(0.5)
+            # network loop released by close
+            async with self.async_dendrite.subscribe('test/async-other') as subscription:
+                await asyncio.sleep(0.5)
+                await self.async_dendrite.publish('test/async-other', 'other')
+                async for data, topic in subscription:
+                    return data
+
+        self.assertEqual(self.loop.run_until_complete(asyncio.wait_for(close_when_full(), 5)), 'other')
+
+    def test_get(self):
+        dummy = str(uuid4())
+        self.dendrite.publish('test/async-get', dummy, retain=True)
+
+        self.assertEqual(self.loop.run_until_complete(self.async_dendrite.get('test/async-get')), dummy)
+
+        Dendrite.publish_single('test/async-get', retain=True)
+        time.sleep(1)
+
+        with self.assertRaises(RequestTimeout):
+            self.loop.run_until_complete(self.async_dendrite.get('test/async-get'))
+
+
+class ConfStoreTest(unittest.TestCase):
+    'These tests require a MQTT broker and Redis'
+
+    TOPIC = 'test/conf-store'
+
+    def setUp(self):
+        self.synapse = Synapse()
+        self.synapse.set(Dendrite.CACHE_PREFIX + Dendrite.CONF_TOPIC_PREFIX + self.TOPIC, [{'id': 1, 'name': 'one'}])
+        self.dendrite = Dendrite()
+        self.store = ConfStore(self.dendrite)
+
+    def tearDown(self):
+        self.dendrite.finish()
+        self.synapse.delete(Dendrite.CACHE_PREFIX + Dendrite.CONF_TOPIC_PREFIX + self.TOPIC)
+        Dendrite.publish_conf_single(self.TOPIC)
+
+    def test_get_and_update(self):
+        updated = concurrent.futures.Future()
+
+        def on_update(view):
+            if view.topic == self.TOPIC:
+                updated.set_result(view)
+
+        self.store.add_listener(on_update)
+
+        view = self.store.get_view(self.TOPIC)
+        self.assertEqual(view.version, 1)
+        self.assertEqual(view.value, ({'id': 1, 'name': 'one'},))
+        with self.assertRaises(TypeError):
+            view.value[0]['name'] = 'changed'
+
+        builds = []
+
+        def build(value):
+            builds.append(value)
+            return {obj['id']: obj['name'] for obj in value}
+
+        self.assertEqual(self.store.index(self.TOPIC, build), {1: 'one'})
+        self.assertEqual(self.store.index(self.TOPIC, build), {1: 'one'})
+        self.assertEqual(len(builds), 1)
+
+        time.sleep(0.5)
+        self.dendrite.publish_conf(self.TOPIC, [{'id': 1, 'name': 'one'}, {'id': 2, 'name': 'two'}])
+
+        view = updated.result(2)
+        self.assertEqual(view.version, 2)
+        self.assertEqual(self.store.get(self.TOPIC), view.value)
+        self.assertEqual(self.store.index(self.TOPIC, build), {1: 'one', 2: 'two'})
+        self.assertEqual(len(builds), 2)
+
+    def test_updates_not_dropped(self):
+        self.store.get_view(self.TOPIC)
+        time.sleep(0.5)
+
+        for index in range(50):
+            self.dendrite.publish_conf(self.TOPIC, [{'id': index}])
+
+        for _ in range(20):
+            if self.store.get(self.TOPIC) == ({'id': 49},):
+                break
+            time.sleep(0.1)
+        self.assertEqual(self.store.get(self.TOPIC), ({'id': 49},))
+
+        dispatcher = self.dendrite.dispatchers[Dendrite.CONF_TOPIC_PREFIX + '#']
+        self.assertTrue(dispatcher.block)
+        self.assertEqual(dispatcher.stats()['dropped'], 0)
+
+    def test_conf_object(self):
+
+        class Dummy(ConfObject):
+            TOPIC = self.TOPIC
+            _conf_store = self.store
+
+        self.assertEqual(Dummy.count(), 1)
+        dummy = Dummy.get(id=1)
+        self.assertEqual(dummy.name, 'one')
+        self.assertIsNone(Dummy.get(id=2))
+
+        # instances are copies: they can be modified
+        dummy.name = 'changed'
+        self.assertEqual([obj.name for obj in Dummy.get_all()], ['one'])
@@ -0,0 +1,113 @@
+import struct
+import unittest
+
+from elan import dissect
+from elan.dissect import bootp, dhcpv6, mdns, netbios
+
+
+SRC_MAC = bytes.fromhex('0a0b0c0d0e0f')
+
+
+def ether(eth_type, payload, dst=b'\xff' * 6):
+    return dst + SRC_MAC + struct.pack('!H', eth_type) + payload
+
+
+def ipv4_udp(src_port, dst_port, payload):
+    udp = struct.pack('!HHHH', src_port, dst_port, 8 + len(payload), 0) + payload
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(udp), 0, 0, 64, 17, 0, bytes([10, 0, 0, 1]), bytes([10, 0, 0, 255]))
+    return ether(0x0800, ip + udp)
+
+
+def ipv6(next_header, payload, src=bytes.fromhex('fe800000000000000000000000000001')):
+    ip = struct.pack('!IHBB16s16s', 0x60000000, len(payload), next_header, 255, src, bytes.fromhex('ff020000000000000000000000010002'))
+    return ether(0x86dd, ip + payload)
+
+
+def dns_name(name):
+    return b''.join(bytes([len(label)]) + label.encode() for label in name.split('.')) + b'\x00'
+
+
+class DissectFrame(unittest.TestCase):
+
+    def test_arp(self):
+        arp = struct.pack('!HHBBH6s4s6s4s', 1, 0x0800, 6, 4, 1, SRC_MAC, bytes([192, 168, 1, 2]), b'\x00' * 6, bytes([192, 168, 1, 1]))
+        record = dissect.dissect_frame(ether(0x0806, arp))
+
+        self.assertEqual(record, dissect.Record('0a:0b:0c:0d:0e:0f', 'ARP', '192.168.1.2'))
+
+    def test_neighbor_solicitation(self):
+        record = dissect.dissect_frame(ipv6(58, bytes([135, 0, 0, 0]) + b'\x00' * 20))
+
+        self.assertEqual(record.source, 'ICMPV6')
+        self.assertEqual(record.ip, 'fe80::1')
+
+    def test_dhcpv4(self):
+        options = bytes([53, 1, 1, 12, 4]) + b'host' + bytes([55, 3, 1, 3, 6, 60, 4]) + b'MSFT' + bytes([255])
+        payload = bytes([1, 1, 6, 0]) + b'\x00' * 24 + SRC_MAC + b'\x00' * 202 + bootp.DHCP_MAGIC_COOKIE + options
+        record = dissect.dissect_frame(ipv4_udp(68, 67, payload))
+
+        self.assertEqual(record.source, 'DHCPV4')
+        self.assertEqual(record.hostname, 'host')
+        self.assertEqual(record.fingerprint, {'request_list': '1,3,6', 'vendor': 'MSFT'})
+
+    def test_dhcpv6(self):
+        fqdn = bytes([0]) + dns_name('host.example.com')
+        vendor_class = struct.pack('!IH', 311, 8) + b'MSFT 5.0'
+        options = struct.pack('!HHHHH', 6, 4, 23, 24, 39) + struct.pack('!H', len(fqdn)) + fqdn \
+            + struct.pack('!HH', 16, len(vendor_class)) + vendor_class
+        dhcpv6 = bytes([1, 0, 0, 1]) + options
+        udp = struct.pack('!HHHH', 546, 547, 8 + len(dhcpv6), 0) + dhcpv6
+        record = dissect.dissect_frame(ipv6(17, udp))
+
+        self.assertEqual(record.source, 'DHCPV6')
+        self.assertEqual(record.hostname, 'host.example.com')
+        self.assertEqual(record.fingerprint, {'request_list': '23,24', 'vendor': 'MSFT 5.0', 'enterprise': '311'})
+
+    def test_netbios(self):
+        name = b'HOST'.ljust(15) + b'\x00'
+        encoded = bytes([0x20]) + b''.join(bytes([0x41 + (c >> 4), 0x41 + (c & 0x0f)]) for c in name) + b'\x00'
+        nbdgm = bytes([0x11, 0x02, 0, 1, 10, 0, 0, 1, 0, 138, 0, 0, 0, 0]) + encoded
+        record = dissect.dissect_frame(ipv4_udp(138, 138, nbdgm))
+
+        self.assertEqual(record.source, 'NetBIOS')
+        self.assertEqual(record.hostname, 'HOST')
+
+    def test_mdns(self):
+        answers = dns_name('host.local') + struct.pack('!HHIH', 1, 0x8001, 120, 4) + bytes([10, 0, 0, 1]) \
+            + b'\xc0\x0c' + struct.pack('!HHIH', 28, 0x8001, 120, 16) + bytes.fromhex('fe800000000000000000000000000001') \
+            + dns_name('other.example') + struct.pack('!HHIH', 1, 1, 120, 4) + bytes([10, 0, 0, 2])
+        mdns = struct.pack('!HHHHHH', 0, 0x8400, 0, 3, 0, 0) + answers
+        record = dissect.dissect_frame(ipv4_udp(5353, 5353, mdns))
+
+        self.assertEqual(record.source, 'MDNS')
+        self.assertEqual(record.mdns_answers, (('host', '10.0.0.1'), ('host', 'fe80::1')))
+
+    def test_mdns_query(self):
+        mdns = struct.pack('!HHHHHH', 0, 0, 1, 0, 0, 0) + dns_name('host.local') + struct.pack('!HH', 1, 1)
+        record = dissect.dissect_frame(ipv4_udp(5353, 5353, mdns))
+
+        self.assertEqual(record.mdns_answers, ())
+
+    def test_truncated(self):
+        self.assertIsNone(dissect.dissect_frame(b'\x00' * 10))
+
+        record = dissect.dissect_frame(ether(0x0806, b'\x00\x01'))
+        self.assertEqual(record.source, 'ARP')
+        self.assertIsNone(record.ip)
+
+
+class Dissectors(unittest.TestCase):
+
+    def test_sources(self):
+        self.assertEqual(dissect.udp_source(68, 67), bootp.SOURCE)
+        self.assertEqual(dissect.udp_source(546, 547), dhcpv6.SOURCE)
+        self.assertEqual(dissect.udp_source(138, 138), netbios.SOURCE)
+        self.assertEqual(dissect.udp_source(5353, 5353), mdns.SOURCE)
+        self.assertEqual(dissect.udp_source(1234, 5353), 'UDP')
+
+    def test_malformed(self):
+        self.assertEqual(bootp.dissect(b'\x00' * 10, 'mac'), dissect.Record('mac', bootp.SOURCE))
+        self.assertEqual(netbios.dissect(b'\x11' * 10, 'mac'), dissect.Record('mac', netbios.SOURCE))
+
+        frame = ipv4_udp(5353, 5353, struct.pack('!HHHHHH', 0, 0x8400, 0, 1, 0, 0) + b'\xc0\x0c')  # pointer loop
+        self.assertEqual(dissect.dissect_frame(frame), dissect.Record('0a:0b:0c:0d:0e:0f', mdns.SOURCE))
@@ -0,0 +1,403 @@
+from unittest import mock
+import asyncio
+import threading
+import time
+import unittest
+
+from elan import nac, session
+from elan.neuron import Dendrite, RequestTimeout
+
+
+class DecisionCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = nac.DecisionCache(ttl=60, stale=60)
+        self.sessions = [{'source': 'radius-mac', 'till_disconnect': True}, {'source': 'captive-portal', 'login': 'john'}]
+
+    def age(self, seconds):
+        ''' make all entries older '''
+        for key, (assignments, fetched) in list(self.cache.entries.items()):
+            self.cache.entries[key] = (assignments, fetched - seconds)
+
+    @mock.patch('elan.nac._get_network_assignments', return_value={'assign_vlan': 'eth0.1'})
+    def test_fresh(self, call):
+        self.assertEqual(self.cache.get_assignments('aa:bb:cc:dd:ee:01', 'port', self.sessions), {'assign_vlan': 'eth0.1'})
+        # order of sessions does not matter
+        self.assertEqual(self.cache.get_assignments('aa:bb:cc:dd:ee:01', 'port', list(reversed(self.sessions))), {'assign_vlan': 'eth0.1'})
+        self.assertEqual(call.call_count, 1)
+
+        # No assignments is a decision too
+        call.return_value = None
+        self.assertIsNone(self.cache.get_assignments('aa:bb:cc:dd:ee:01', 'port', self.sessions[:1]))
+        self.assertIsNone(self.cache.get_assignments('aa:bb:cc:dd:ee:01', 'port', self.sessions[:1]))
+        self.assertEqual(call.call_count, 2)
+
+        # Bypass
+        self.cache.get_assignments('aa:bb:cc:dd:ee:01', 'port', self.sessions[:1], cached=False)
+        self.assertEqual(call.call_count, 3)
+
+    @mock.patch('elan.nac._get_network_assignments', return_value=None)
+    def test_stale_while_revalidate(self, call):
+        self.cache.get_assignments('aa:bb:cc:dd:ee:01', None, self.sessions)
+        self.age(90)
+
+        refreshed = threading.Event()
+        release = threading.Event()
+
+        def slow_call(*args):
+            release.wait(2)
+            refreshed.set()
+            return {'assign_vlan': 'eth0.2'}
+        call.side_effect = slow_call
+
+        # stale denial returned straight away, only one refresh
+        self.assertIsNone(self.cache.get_assignments('aa:bb:cc:dd:ee:01', None, self.sessions))
+        self.assertIsNone(self.cache.get_assignments('aa:bb:cc:dd:ee:01', None, self.sessions))
+        release.set()
+        self.assertTrue(refreshed.wait(2))
+        time.sleep(0.1)
+        self.assertEqual(call.call_count, 2)
+        self.assertEqual(self.cache.get_assignments('aa:bb:cc:dd:ee:01', None, self.sessions), {'assign_vlan': 'eth0.2'})
+
+    @mock.patch('elan.nac._get_network_assignments', return_value={'assign_vlan': 'eth0.1'})
+    def test_stale_grant_not_served(self, call):
+        self.cache.get_assignments('aa:bb:cc:dd:ee:01', None, self.sessions)
+        self.age(90)
+
+        call.return_value = None
+        self.assertIsNone(self.cache.get_assignments('aa:bb:cc:dd:ee:01', None, self.sessions))
+        self.assertEqual(call.call_count, 2)
+
+    @mock.patch('elan.nac._get_network_assignments', return_value={'assign_vlan': 'eth0.1'})
+    def test_expired_on_timeout(self, call):
+        self.cache.get_assignments('aa:bb:cc:dd:ee:01', None, self.sessions)
+        call.return_value = None
+        self.cache.get_assignments('aa:bb:cc:dd:ee:02', None, self.sessions)
+        self.age(300)
+
+        call.side_effect = RequestTimeout('timeout')
+        # denial may be served, not access
+        self.assertIsNone(self.cache.get_assignments('aa:bb:cc:dd:ee:02', None, self.sessions))
+        with self.assertRaises(RequestTimeout):
+            self.cache.get_assignments('aa:bb:cc:dd:ee:01', None, self.sessions)
+
+        with self.assertRaises(RequestTimeout):
+            self.cache.get_assignments('aa:bb:cc:dd:ee:03', None, self.sessions)
+
+    @mock.patch('elan.nac._get_network_assignments', return_value={'assign_vlan': 'eth0.1'})
+    def test_revocation_while_cached(self, call):
+        self.cache.get_assignments('aa:bb:cc:dd:ee:01', None, self.sessions)
+        self.cache.get_assignments('aa:bb:cc:dd:ee:02', None, self.sessions)
+
+        call.return_value = None  # revoked by control center
+        self.cache.invalidate_macs(['aa:bb:cc:dd:ee:01'])
+
+        self.assertIsNone(self.cache.get_assignments('aa:bb:cc:dd:ee:01', None, self.sessions))
+        self.assertEqual(self.cache.get_assignments('aa:bb:cc:dd:ee:02', None, self.sessions), {'assign_vlan': 'eth0.1'})
+        self.assertEqual(call.call_count, 3)
+
+    @mock.patch('elan.nac._get_network_assignments')
+    def test_revocation_while_fetching(self, call):
+        fetching = threading.Event()
+        release = threading.Event()
+
+        def slow_call(*args):
+            fetching.set()
+            release.wait(2)
+            return {'assign_vlan': 'eth0.1'}
+        call.side_effect = slow_call
+
+        thread = threading.Thread(target=self.cache.get_assignments, args=('aa:bb:cc:dd:ee:01', None, self.sessions))
+        thread.start()
+        fetching.wait(2)
+        self.cache.invalidate_macs(['aa:bb:cc:dd:ee:01'])
+        release.set()
+        thread.join(2)
+
+        # decision fetched before revocation is not kept
+        self.assertEqual(len(self.cache), 0)
+
+    @mock.patch('elan.nac._get_network_assignments', return_value={'assign_vlan': 'eth0.1'})
+    def test_invalidate_and_size(self, call):
+        cache = nac.DecisionCache(max_size=2)
+        for index in range(3):
+            cache.get_assignments('aa:bb:cc:dd:ee:0{}'.format(index), None, self.sessions)
+        self.assertEqual(len(cache), 2)
+
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+
+class DecisionCacheAsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = nac.DecisionCache(ttl=60, stale=60)
+        self.sessions = [{'source': 'radius-mac', 'till_disconnect': True}]
+        self.loop = asyncio.new_event_loop()
+        self.calls = []
+        self.answer = {'assign_vlan': 'eth0.1'}
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def get_network_assignments(self, mac, port, auth_sessions):
+        self.calls.append(mac)
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return self.answer
+
+    def get_assignments(self, mac):
+        return self.loop.run_until_complete(self.cache.get_assignments_async(mac, None, self.sessions))
+
+    def test_get_assignments(self):
+        with mock.patch('elan.nac._get_network_assignments_async', self.get_network_assignments):
+            self.assertEqual(self.get_assignments('aa:bb:cc:dd:ee:01'), {'assign_vlan': 'eth0.1'})
+            self.assertEqual(self.get_assignments('aa:bb:cc:dd:ee:01'), {'assign_vlan': 'eth0.1'})
+            self.assertEqual(len(self.calls), 1)
+
+            # stale denial served while refreshed in a task
+            self.answer = None
+            self.get_assignments('aa:bb:cc:dd:ee:02')
+            for key, (assignments, fetched) in list(self.cache.entries.items()):
+                self.cache.entries[key] = (assignments, fetched - 90)
+            self.answer = {'assign_vlan': 'eth0.2'}
+            self.assertIsNone(self.get_assignments('aa:bb:cc:dd:ee:02'))
+            self.loop.run_until_complete(asyncio.sleep(0.01))
+            self.assertEqual(self.get_assignments('aa:bb:cc:dd:ee:02'), {'assign_vlan': 'eth0.2'})
+
+            # stale grant is not served on timeout
+            self.cache.entries[self.cache.key('aa:bb:cc:dd:ee:01', None, self.sessions)] = ({'assign_vlan': 'eth0.1'}, time.monotonic() - 300)
+            self.answer = RequestTimeout('timeout')
+            with self.assertRaises(RequestTimeout):
+                self.get_assignments('aa:bb:cc:dd:ee:01')
+
+
+class DecisionCacheInvalidationTest(unittest.TestCase):
+    'These tests require a MQTT broker'
+
+    def setUp(self):
+        self.cache = nac.enable_decision_cache()
+        self.sessions = [{'source': 'radius-mac', 'till_disconnect': True}]
+        time.sleep(0.5)  # subscriptions done
+
+    def tearDown(self):
+        nac.disable_decision_cache()
+
+    def wait_invalidated(self, mac):
+        for _ in range(20):
+            if not any(key[0] == mac for key in list(self.cache.entries)):
+                return True
+            time.sleep(0.1)
+        return False
+
+    @mock.patch('elan.nac._get_network_assignments', return_value={'assign_vlan': 'eth0.1'})
+    def test_revoked_by_topics(self, call):
+        for mac, topic, data in (
+                ('aa:bb:cc:dd:ee:01', nac.CHECK_AUTHZ_PATH, ['aa:bb:cc:dd:ee:01']),
+                ('aa:bb:cc:dd:ee:02', nac.AUTHORIZATION_CHANGE_TOPIC, 'aa:bb:cc:dd:ee:02')):
+            call.return_value = {'assign_vlan': 'eth0.1'}
+            self.assertEqual(nac.get_network_assignments(mac, 'port', self.sessions), {'assign_vlan': 'eth0.1'})
+
+            call.return_value = None  # revoked by control center
+            nac.dendrite.publish(topic, data)
+            self.assertTrue(self.wait_invalidated(mac))
+
+            self.assertIsNone(nac.get_network_assignments(mac, 'port', self.sessions))
+
+
+class RedisMacAuthorizationTest(unittest.TestCase):
+
+    def setUp(self):
+        nac.synapse.delete(nac.AUTHZ_MAC_EXPIRY_PATH, nac.AUTHZ_SESSIONS_BY_MAC_PATH)
+
+    def authz(self, mac, **kwargs):
+        params = dict(mac=mac, assign_vlan='eth0.1', allow_on=['eth0.1', 'eth0.2'], bridge_to=[], till_disconnect=False)
+        params.update(kwargs)
+        return nac.RedisMacAuthorization(**params)
+
+    def test_save_and_get_many(self):
+        authzs = [self.authz('aa:bb:cc:dd:ee:0{}'.format(index), till=1000 + index) for index in range(3)]
+        nac.RedisMacAuthorization.save_many(authzs)
+
+        # unique consecutive ids
+        local_ids = [authz.local_id for authz in authzs]
+        self.assertEqual(local_ids, list(range(local_ids[0], local_ids[0] + 3)))
+
+        self.assertEqual(
+                nac.RedisMacAuthorization.get_many(['aa:bb:cc:dd:ee:01', 'aa:bb:cc:dd:ee:09', 'aa:bb:cc:dd:ee:00']),
+                [authzs[1], None, authzs[0]]
+        )
+        self.assertEqual(nac.synapse.zscore(nac.AUTHZ_MAC_EXPIRY_PATH, 'aa:bb:cc:dd:ee:02'), 1002)
+        self.assertCountEqual([authz.mac for authz in nac.RedisMacAuthorization.iter_all(count=1)], [authz.mac for authz in authzs])
+
+    def test_equality(self):
+        authz = self.authz('aa:bb:cc:dd:ee:01', local_id=1, login='john')
+        same = self.authz('aa:bb:cc:dd:ee:02', local_id=2, login='john', allow_on=['eth0.2', 'eth0.1'])
+
+        self.assertEqual(authz, same)
+        self.assertEqual(hash(authz), hash(same))
+        self.assertNotEqual(authz, self.authz('aa:bb:cc:dd:ee:01', local_id=1, login='jane'))
+        self.assertNotEqual(authz, self.authz('aa:bb:cc:dd:ee:01', local_id=1))
+        self.assertNotEqual(authz, self.authz('aa:bb:cc:dd:ee:01', local_id=1, login='john', till=1000))
+        self.assertNotEqual(authz, None)
+
+        self.assertEqual(authz.login, 'john')
+        with self.assertRaises(AttributeError):
+            authz.password
+
+    def test_serialize(self):
+        authz = self.authz('aa:bb:cc:dd:ee:01', allow_on=['eth0.2', 'eth0.1'], login='john')
+        data = authz.serialize()
+        self.assertEqual(data, {
+            'mac': 'aa:bb:cc:dd:ee:01', 'local_id': None, 'assign_vlan': 'eth0.1', 'allow_on': ['eth0.1', 'eth0.2'], 'bridge_to': [],
+            'till_disconnect': False, 'till': None, 'login': 'john'
+        })
+        self.assertEqual(nac.RedisMacAuthorization(**data), authz)
+
+        # copies are returned
+        data['till'] = 'formatted'
+        self.assertIsNone(authz.serialize()['till'])
+
+        authz.local_id = 12
+        self.assertEqual(authz.serialize()['local_id'], 12)
+
+    def test_replace(self):
+        mac = 'aa:bb:cc:dd:ee:01'
+        self.assertEqual(nac.RedisMacAuthorization.replace(mac, None), (None, False))
+
+        first = self.authz(mac)
+        self.assertEqual(nac.RedisMacAuthorization.replace(mac, first), (None, True))
+        self.assertIsNotNone(first.local_id)
+        self.assertEqual(nac.synapse.zscore(nac.AUTHZ_MAC_EXPIRY_PATH, mac), float('inf'))
+
+        # Same authorization: nothing changes
+        current, replaced = nac.RedisMacAuthorization.replace(mac, self.authz(mac, allow_on=['eth0.2', 'eth0.1']))
+        self.assertFalse(replaced)
+        self.assertEqual(current.local_id, first.local_id)
+
+        second = self.authz(mac, till=2000)
+        self.assertEqual(nac.RedisMacAuthorization.replace(mac, second), (first, True))
+        self.assertEqual(nac.synapse.zscore(nac.AUTHZ_MAC_EXPIRY_PATH, mac), 2000)
+
+        self.assertEqual(nac.RedisMacAuthorization.replace(mac, None), (second, True))
+        self.assertIsNone(nac.RedisMacAuthorization.getByMac(mac))
+        self.assertIsNone(nac.synapse.zscore(nac.AUTHZ_MAC_EXPIRY_PATH, mac))
+
+    def test_replace_changed_meanwhile(self):
+        mac = 'aa:bb:cc:dd:ee:01'
+        other = self.authz(mac, till=3000)
+        allocate_local_ids = nac.RedisMacAuthorization._allocate_local_ids
+
+        def concurrent_save(authzs):
+            # another process saves an authorization between read and write of replace
+            if other.local_id is None:
+                allocate_local_ids([other])
+                other.save()
+            allocate_local_ids(authzs)
+
+        new = self.authz(mac, till=2000)
+        with mock.patch('elan.nac.RedisMacAuthorization._allocate_local_ids', side_effect=concurrent_save):
+            self.assertEqual(nac.RedisMacAuthorization.replace(mac, new), (other, True))
+        self.assertEqual(nac.RedisMacAuthorization.getByMac(mac).local_id, new.local_id)
+        self.assertEqual(nac.synapse.zscore(nac.AUTHZ_MAC_EXPIRY_PATH, mac), 2000)
+
+        # changed to the same authorization meanwhile: nothing to do
+        same = self.authz(mac, till=1000)
+        concurrent = self.authz(mac, till=1000)
+
+        def concurrent_replace(authzs):
+            if concurrent.local_id is None:
+                allocate_local_ids([concurrent])
+                nac.RedisMacAuthorization.replace(mac, concurrent)
+            allocate_local_ids(authzs)
+
+        with mock.patch('elan.nac.RedisMacAuthorization._allocate_local_ids', side_effect=concurrent_replace):
+            current, replaced = nac.RedisMacAuthorization.replace(mac, same)
+        self.assertFalse(replaced)
+        self.assertEqual(current.local_id, concurrent.local_id)
+
+    @mock.patch('elan.nac.notify_new_authorization_session')
+    @mock.patch('elan.nac.notify_end_authorization_session')
+    @mock.patch('elan.nac.authzChanged')
+    @mock.patch('elan.nac.get_network_assignments')
+    def test_checkAuthz(self, get_network_assignments, authzChanged, notify_end, notify_new):
+        mac = 'aa:bb:cc:dd:ee:01'
+        get_network_assignments.return_value = dict(assign_vlan='eth0.1', allow_on=['eth0.1'], bridge_to=[], till_disconnect=True)
+
+        authz = nac.checkAuthz(mac)
+        self.assertEqual(authz, nac.RedisMacAuthorization.getByMac(mac))
+        authzChanged.assert_called_once_with(mac)
+        notify_new.assert_called_once_with(authz)
+
+        # No change
+        self.assertEqual(nac.checkAuthz(mac).local_id, authz.local_id)
+        self.assertEqual(authzChanged.call_count, 1)
+
+        get_network_assignments.return_value = None
+        self.assertIsNone(nac.checkAuthz(mac))
+        self.assertEqual(authzChanged.call_count, 2)
+        notify_end.assert_called_once_with(authz, reason='expired')
+
+
+class AsyncAuthorizationTest(unittest.TestCase):
+    'These tests require Redis and a MQTT broker'
+
+    MAC = 'aa:bb:cc:dd:ee:01'
+
+    def setUp(self):
+        nac.synapse.delete(nac.AUTHZ_MAC_EXPIRY_PATH, nac.AUTHZ_SESSIONS_BY_MAC_PATH, session.MAC_AUTH_SESSION_PATH.format(mac=self.MAC))
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        for async_synapse in (nac.async_synapse, session.async_synapse):
+            async_synapse.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_replace_async(self):
+        first = nac.RedisMacAuthorization(mac=self.MAC, assign_vlan='eth0.1', allow_on=['eth0.1'], bridge_to=[], till_disconnect=False, till=1000)
+        self.assertEqual(self.run_async(nac.RedisMacAuthorization.replace_async(self.MAC, first)), (None, True))
+        self.assertIsNotNone(first.local_id)
+        self.assertEqual(nac.RedisMacAuthorization.getByMac(self.MAC).local_id, first.local_id)
+        self.assertEqual(nac.synapse.zscore(nac.AUTHZ_MAC_EXPIRY_PATH, self.MAC), 1000)
+
+        same = nac.RedisMacAuthorization(mac=self.MAC, assign_vlan='eth0.1', allow_on=['eth0.1'], bridge_to=[], till_disconnect=False, till=1000)
+        current, replaced = self.run_async(nac.RedisMacAuthorization.replace_async(self.MAC, same))
+        self.assertFalse(replaced)
+        self.assertEqual(current.local_id, first.local_id)
+
+        self.assertEqual(self.run_async(nac.RedisMacAuthorization.replace_async(self.MAC, None)), (first, True))
+        self.assertIsNone(nac.RedisMacAuthorization.getByMac(self.MAC))
+        self.assertIsNone(nac.synapse.zscore(nac.AUTHZ_MAC_EXPIRY_PATH, self.MAC))
+
+    @mock.patch('elan.nac.notify_new_authorization_session')
+    @mock.patch('elan.nac.authzChanged')
+    def test_newAuthz_async(self, authzChanged, notify_new):
+        requests = []
+
+        def device_authorization(request):
+            requests.append(request)
+            if request['auth_sessions']:
+                return dict(assign_vlan='eth0.1', allow_on=['eth0.1'], bridge_to=[], till_disconnect=True)
+
+        provider = Dendrite()
+        try:
+            provider.provide('device-authorization', device_authorization)
+            time.sleep(0.5)
+
+            session.add_authentication_session(self.MAC, source='radius-dot1x', login='former')
+            authz = self.run_async(nac.newAuthz_async(self.MAC, source='radius-dot1x', no_duplicate_source=True, login='john'))
+        finally:
+            provider.finish()
+
+        self.assertEqual(authz, nac.RedisMacAuthorization.getByMac(self.MAC))
+        self.assertEqual(authz.assign_vlan, 'eth0.1')
+        authzChanged.assert_called_once_with(self.MAC)
+        notify_new.assert_called_once_with(authz)
+        self.assertEqual(requests[0]['auth_sessions'], [{'source': 'radius-dot1x', 'login': 'john', 'till_disconnect': True}])
+        self.assertEqual(session.get_authentication_sessions(self.MAC), requests[0]['auth_sessions'])
@@ -0,0 +1,233 @@
+from unittest import mock
+import threading
+import time
+import unittest
+
+from elan import nac
+from elan.nac.manager import CoalescingQueue, ExpiryScheduler, MacAuthorizationManager
+from elan.nft import FakeNft, element_commands, parse_elements
+
+
+class ElementCommandsTest(unittest.TestCase):
+
+    def test_element_commands(self):
+        self.assertEqual(
+                element_commands('add', 'mac_on_vlan', [('aa:bb:cc:dd:ee:01', 'eth0.1')]),
+                ['add element bridge elan mac_on_vlan { aa:bb:cc:dd:ee:01 . eth0.1 }']
+        )
+        # Missing elements must not abort the batch
+        self.assertEqual(
+                element_commands('delete', 'ac_ifs', ['eth0']),
+                ['add element bridge elan ac_ifs { eth0 }', 'delete element bridge elan ac_ifs { eth0 }']
+        )
+
+    def test_parse_elements(self):
+        output = '''{"nftables": [{"metainfo": {"json_schema_version": 1}}, {"set": {"family": "bridge", "name": "mac_on_vlan", "table": "elan",
+                    "type": ["ether_addr", "iface_index"], "elem": [{"concat": ["aa:bb:cc:dd:ee:01", "eth0.1"]},
+                    {"elem": {"val": {"concat": ["aa:bb:cc:dd:ee:02", "eth0"]}, "timeout": 60}}]}}]}'''
+        self.assertEqual(parse_elements(output), {('aa:bb:cc:dd:ee:01', 'eth0.1'), ('aa:bb:cc:dd:ee:02', 'eth0')})
+
+
+class CoalescingQueueTest(unittest.TestCase):
+
+    def test_coalescing(self):
+        processed = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def handler(key, flags):
+            if not processed:
+                started.set()
+                release.wait(2)
+            processed.append((key, flags))
+
+        queue = CoalescingQueue(handler, workers=2)
+        queue.put('a', 'changed')
+        self.assertTrue(started.wait(2))
+
+        # 'a' is being processed: it is kept for later, not given to the other worker
+        queue.put('a', 'changed')
+        queue.put('a', 'disconnected')
+        release.set()
+
+        self.assertTrue(queue.wait_idle(2))
+        self.assertEqual(processed, [('a', {'changed'}), ('a', {'changed', 'disconnected'})])
+
+    def test_bursts_are_collapsed(self):
+        processed = []
+        release = threading.Event()
+
+        def handler(key, flags):
+            release.wait(2)
+            processed.append((key, flags))
+
+        queue = CoalescingQueue(handler, workers=1)
+        queue.put('blocker')
+        for _ in range(100):
+            queue.put('a', 'changed')
+            queue.put('b', 'check')
+        release.set()
+
+        self.assertTrue(queue.wait_idle(2))
+        self.assertEqual(processed, [('blocker', set()), ('a', {'changed'}), ('b', {'check'})])
+
+
+class ExpirySchedulerTest(unittest.TestCase):
+
+    def test_due_keys_expire_together(self):
+        expired = []
+        done = threading.Event()
+
+        def on_expired(keys):
+            expired.append(sorted(keys))
+            done.set()
+
+        scheduler = ExpiryScheduler(on_expired)
+        scheduler.start()
+        try:
+            expiry = time.time() + 0.1
+            scheduler.schedule('a', expiry)
+            scheduler.schedule('b', expiry)
+            scheduler.schedule('c', expiry)
+            scheduler.schedule('c', expiry + 60)  # extended
+            scheduler.schedule('d', expiry)
+            scheduler.unschedule('d')
+
+            self.assertTrue(done.wait(2))
+            self.assertEqual(expired, [['a', 'b']])
+            self.assertEqual(scheduler.expiries, {'c': expiry + 60})
+        finally:
+            scheduler.stop()
+
+
+class MacAuthorizationManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        nac.synapse.delete(nac.AUTHZ_MAC_EXPIRY_PATH, nac.AUTHZ_SESSIONS_BY_MAC_PATH)
+
+    def test_init_macs_reconciles_sets(self):
+        for index in range(3):
+            nac.RedisMacAuthorization(
+                    mac='aa:bb:cc:dd:ee:0{}'.format(index), assign_vlan='eth0.1', allow_on=['eth0.1'], bridge_to=[], till_disconnect=False
+            ).save()
+
+        nft = FakeNft(sets={
+                ('bridge', 'elan', 'mac_on_vlan'): {('aa:bb:cc:dd:ee:00', 'eth0.1'), ('aa:bb:cc:dd:ee:00', 'eth0.2')},
+                ('bridge', 'elan', 'mac_to_vlan'): {('aa:bb:cc:dd:ee:09', 'eth0.3')},
+        })
+        manager = MacAuthorizationManager(nft=nft)
+
+        # Only differences, in one batch
+        self.assertEqual(nft.batches, [[
+            'add element bridge elan mac_on_vlan { aa:bb:cc:dd:ee:00 . eth0.2 }',
+            'delete element bridge elan mac_on_vlan { aa:bb:cc:dd:ee:00 . eth0.2 }',
+            'add element bridge elan mac_on_vlan { aa:bb:cc:dd:ee:01 . eth0.1 }',
+            'add element bridge elan mac_on_vlan { aa:bb:cc:dd:ee:02 . eth0.1 }',
+            'add element bridge elan mac_to_vlan { aa:bb:cc:dd:ee:09 . eth0.3 }',
+            'delete element bridge elan mac_to_vlan { aa:bb:cc:dd:ee:09 . eth0.3 }',
+        ]])
+        self.assertEqual(nft.list_elements('mac_to_vlan'), set())
+        self.assertEqual(manager.fw_allowed_vlans('aa:bb:cc:dd:ee:00'), {'eth0.1'})
+
+        # Nothing to do when in sync
+        nft.batches.clear()
+        manager.init_macs()
+        self.assertEqual(nft.batches, [])
+
+    def test_fw_allow_mac(self):
+        nft = FakeNft()
+        manager = MacAuthorizationManager(nft=nft)
+        mac = 'aa:bb:cc:dd:ee:01'
+
+        manager.fw_allow_mac(mac, on=['eth0.1', 'eth0.2'], to=['eth0.3'])
+        self.assertEqual(manager.fw_allowed_vlans(mac), {'eth0.1', 'eth0.2'})
+        self.assertEqual(manager.fw_bridged_vlans(mac), {'eth0.3'})
+
+        nft.batches.clear()
+        manager.fw_allow_mac(mac, on=['eth0.1'])
+        self.assertEqual(nft.batches, [[
+            'add element bridge elan mac_on_vlan { aa:bb:cc:dd:ee:01 . eth0.2 }',
+            'delete element bridge elan mac_on_vlan { aa:bb:cc:dd:ee:01 . eth0.2 }',
+            'add element bridge elan mac_to_vlan { aa:bb:cc:dd:ee:01 . eth0.3 }',
+            'delete element bridge elan mac_to_vlan { aa:bb:cc:dd:ee:01 . eth0.3 }',
+        ]])
+
+        nft.batches.clear()
+        manager.fw_disallow_mac(mac)
+        self.assertEqual(manager.fw_allowed_vlans(mac), set())
+        self.assertEqual(len(nft.batches), 1)
+
+        # nothing to change: nothing to run
+        nft.batches.clear()
+        manager.fw_disallow_mac(mac)
+        self.assertEqual(nft.batches, [])
+
+    @mock.patch('elan.nac.manager.checkAuthz')
+    def test_expiry(self, checkAuthz):
+        till = time.time() + 0.2
+        for index in range(3):
+            nac.RedisMacAuthorization(
+                    mac='aa:bb:cc:dd:ee:0{}'.format(index), assign_vlan='eth0.1', allow_on=['eth0.1'], bridge_to=[], till_disconnect=False, till=till
+            ).save()
+        nac.RedisMacAuthorization(mac='aa:bb:cc:dd:ee:09', assign_vlan='eth0.1', allow_on=['eth0.1'], bridge_to=[], till_disconnect=False).save()
+        # already expired
+        nac.RedisMacAuthorization(mac='aa:bb:cc:dd:ee:10', assign_vlan='eth0.1', allow_on=['eth0.1'], bridge_to=[], till_disconnect=False, till=1000).save()
+
+        nft = FakeNft()
+        manager = MacAuthorizationManager(nft=nft)
+        self.assertEqual(manager.fw_allowed_vlans('aa:bb:cc:dd:ee:10'), set())
+
+        for _ in range(20):
+            if nac.synapse.zrange(nac.AUTHZ_MAC_EXPIRY_PATH, 0, -1) == ['aa:bb:cc:dd:ee:09']:
+                break
+            time.sleep(0.1)
+        self.assertTrue(manager.queue.wait_idle(2))
+        self.assertIsNotNone(nac.RedisMacAuthorization.getByMac('aa:bb:cc:dd:ee:09'))
+        self.assertEqual(nac.synapse.zrange(nac.AUTHZ_MAC_EXPIRY_PATH, 0, -1), ['aa:bb:cc:dd:ee:09'])
+        self.assertEqual(nft.list_elements('mac_on_vlan'), {('aa:bb:cc:dd:ee:09', 'eth0.1')})
+
+    @mock.patch('elan.nac.manager.checkAuthz')
+    @mock.patch('elan.nac.manager.notify_end_authorization_session')
+    def test_expiry_renewed_meanwhile(self, notify_end, checkAuthz):
+        mac = 'aa:bb:cc:dd:ee:01'
+        nac.RedisMacAuthorization(mac=mac, assign_vlan='eth0.1', allow_on=['eth0.1'], bridge_to=[], till_disconnect=False, till=time.time() + 3600).save()
+        nft = FakeNft()
+        manager = MacAuthorizationManager(nft=nft)
+        manager.expiry.unschedule(mac)
+
+        # due for the scheduler, but renewed (with another vlan) before the expiry is processed
+        renewed = nac.RedisMacAuthorization(mac=mac, assign_vlan='eth0.2', allow_on=['eth0.2'], bridge_to=[], till_disconnect=False, till=time.time() + 3600)
+        nac.RedisMacAuthorization.replace(mac, renewed)
+        manager.expire_authz([mac])
+        self.assertTrue(manager.queue.wait_idle(2))
+
+        self.assertEqual(nac.RedisMacAuthorization.getByMac(mac).local_id, renewed.local_id)
+        self.assertEqual(notify_end.call_count, 0)
+        self.assertEqual(nft.list_elements('mac_on_vlan'), {(mac, 'eth0.2')})
+        self.assertEqual(manager.expiry.expiries[mac], renewed.till)
+
+        # expired: deleted and firewall closed
+        self.assertEqual(nac.RedisMacAuthorization.deleteIfExpired(mac, now=renewed.till - 1), None)
+        nac.synapse.zadd(nac.AUTHZ_MAC_EXPIRY_PATH, 1000, mac)
+        manager.expire_authz([mac])
+        self.assertTrue(manager.queue.wait_idle(2))
+
+        self.assertIsNone(nac.RedisMacAuthorization.getByMac(mac))
+        notify_end.assert_called_once_with(renewed, reason='expired')
+        self.assertEqual(nft.list_elements('mac_on_vlan'), set())
+
+    def test_disconnection(self):
+        mac = 'aa:bb:cc:dd:ee:01'
+        nac.RedisMacAuthorization(mac=mac, assign_vlan='eth0.1', allow_on=['eth0.1'], bridge_to=[], till_disconnect=True).save()
+        nft = FakeNft()
+        manager = MacAuthorizationManager(nft=nft)
+        self.assertEqual(manager.fw_allowed_vlans(mac), {'eth0.1'})
+
+        for _ in range(10):
+            manager.handle_authz_changed(mac)
+            manager.handle_disconnection(mac)
+        self.assertTrue(manager.queue.wait_idle(2))
+
+        self.assertIsNone(nac.RedisMacAuthorization.getByMac(mac))
+        self.assertEqual(manager.fw_allowed_vlans(mac), set())
+        self.assertEqual(nft.list_elements('mac_on_vlan'), set())
@@ -1,3 +1,4 @@
+import time
 import unittest
 
 from elan import rdns
@@ -38,3 +39,104 @@ class RdnsTest(unittest.TestCase):
         self.assertEqual(rdns.get_cached_rdns('1.2.3.4', 'mac2'), 'fqdn2')
         self.assertEqual(rdns.get_cached_rdns('1.2.3.4'), 'fqdn2')
         self.assertEqual(rdns.get_cached_rdns('4.4.4.4'), None)
+
+    def test_many(self):
+        rdns.add_entries(
+            dict(mac='mac1', source='1.2.3.4', rdns='fqdn1', ttl=5),
+            dict(mac='mac1', source='fqdn1', rdns='fqdn2', ttl=6),
+            dict(mac='mac2', source='5.6.7.8', rdns='fqdn3', ttl=6),
+        )
+
+        lookups = [('1.2.3.4', 'mac1'), ('1.2.3.4', 'mac2'), ('5.6.7.8', 'mac2'), ('5.6.7.8', None), ('4.4.4.4', 'mac1')]
+        self.assertEqual(
+                rdns.get_cached_rdns_many(lookups),
+                [rdns.get_cached_rdns(source, mac) for source, mac in lookups]
+        )
+        self.assertEqual(rdns.get_cached_rdns_many(lookups), ['fqdn2', 'fqdn2', 'fqdn3', 'fqdn3', None])
+        self.assertEqual(rdns.get_cached_rdns_many([]), [])
+
+    def test_many_cname_loop(self):
+        rdns.add_entries(
+            dict(mac='mac1', source='fqdn1', rdns='fqdn2', ttl=5),
+            dict(mac='mac1', source='fqdn2', rdns='fqdn1', ttl=5),
+        )
+
+        self.assertIn(rdns.get_cached_rdns_many([('fqdn1', 'mac1')])[0], ('fqdn1', 'fqdn2'))
+
+
+class RdnsCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        clear_redis_rdns_info()
+
+    def tearDown(self):
+        rdns.disable_cache()
+
+    def test_lru_and_ttl(self):
+        cache = rdns.RdnsCache(max_size=2)
+        cache.add('path1', 'fqdn1', 10)
+        cache.add('path2', 'fqdn2', 10)
+        cache.get('path1')
+        cache.add('path3', 'fqdn3', 10)
+
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('path1'), 'fqdn1')
+        self.assertIsNone(cache.get('path2'))
+
+        cache.add('path4', 'fqdn4', 0)
+        self.assertIsNone(cache.get('path4'))
+
+    def test_get_rdns(self):
+        cache = rdns.RdnsCache(complete=True)
+        cache.add_entries(
+            dict(mac='mac1', source='1.2.3.4', rdns='fqdn1', ttl=5),
+            dict(mac='mac1', source='fqdn1', rdns='fqdn2', ttl=6),
+            dict(mac='mac2', source='5.6.7.8', rdns='fqdn3', ttl=6),
+        )
+
+        self.assertEqual(cache.get_rdns('1.2.3.4', 'mac1'), 'fqdn2')
+        self.assertEqual(cache.get_rdns('5.6.7.8', 'mac1'), 'fqdn3')
+        self.assertEqual(cache.get_rdns('5.6.7.8'), 'fqdn3')
+        self.assertIsNone(cache.get_rdns('4.4.4.4', 'mac1'))
+
+    def test_incomplete_cache(self):
+        cache = rdns.RdnsCache()
+        cache.add_entries(dict(mac='mac1', source='1.2.3.4', rdns='fqdn1', ttl=5))
+
+        # not warmed up: fqdn1 may be a CNAME in Redis only
+        self.assertIsNone(cache.get_rdns('1.2.3.4', 'mac1'))
+
+    def test_evicted_entries(self):
+        entries = [
+            dict(mac='mac1', source='1.2.3.4', rdns='fqdn1', ttl=5),
+            dict(mac='mac1', source='fqdn1', rdns='fqdn2', ttl=6),
+            dict(mac='mac2', source='1.2.3.4', rdns='other', ttl=6),
+        ]
+        rdns.add_entries(*entries)
+        cache = rdns.enable_cache(max_size=4, warm_up=False)
+        cache.warm_up()
+        cache.entries.clear()
+        cache.add_entries(*entries)  # known order: mac1 entries evicted by '*' entries of mac2
+        self.assertEqual(len(cache), 4)
+
+        # would be 'other' ('*' entry) or 'fqdn1' (partial chain) without Redis
+        self.assertIsNone(cache.get_rdns('1.2.3.4', 'mac1'))
+        self.assertEqual(rdns.get_cached_rdns('1.2.3.4', 'mac1'), 'fqdn2')
+        self.assertEqual(rdns.get_cached_rdns_many([('1.2.3.4', 'mac1'), ('1.2.3.4', 'mac3')]), ['fqdn2', 'other'])
+        self.assertEqual(cache.get_rdns('1.2.3.4', 'mac3'), 'other')
+
+    def test_fed_by_redis(self):
+        rdns.add_entries(dict(mac='mac1', source='1.2.3.4', rdns='fqdn1', ttl=5))
+        cache = rdns.enable_cache()
+        self.assertEqual(cache.get_rdns('1.2.3.4', 'mac1'), 'fqdn1')  # warm up
+
+        rdns.add_entries(dict(mac='mac2', source='5.6.7.8', rdns='fqdn2', ttl=5))
+        for _ in range(20):
+            if cache.get_rdns('5.6.7.8', 'mac2'):
+                break
+            time.sleep(0.05)
+        self.assertEqual(cache.get_rdns('5.6.7.8', 'mac2'), 'fqdn2')
+
+        clear_redis_rdns_info()
+        self.assertEqual(rdns.get_cached_rdns('5.6.7.8', 'mac2'), 'fqdn2')
+        self.assertEqual(rdns.get_cached_rdns_many([('1.2.3.4', 'mac1'), ('4.4.4.4', 'mac1')]), ['fqdn1', None])
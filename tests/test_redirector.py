@@ -0,0 +1,106 @@
+from unittest import mock
+import sys
+import unittest
+
+from elan.nft import FakeNft, NftError
+
+sys.path.insert(0, "bin")
+import redirector
+
+
+class FailingNft(FakeNft):
+    ''' Rejects batches with a command containing one of `bad` strings, or all batches if `bad` is None '''
+
+    def __init__(self, bad=None):
+        super().__init__()
+        self.bad = bad
+
+    def run(self, commands):
+        if self.bad is None or any(bad in command for command in commands for bad in self.bad):
+            raise NftError('rejected')
+        super().run(commands)
+
+
+class RedirectorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.nft = FakeNft()
+        self.redirector = redirector.Redirector(nft=self.nft)
+
+    def test_batch(self):
+        for port in range(1000, 1100):
+            self.redirector.do_redirect('10.0.0.1', port, '1.2.3.4', 80, 'add')
+        self.redirector.do_redirect('2001:db8::1', 1000, '2001:db8::2', 80, 'add')
+        self.assertEqual(self.nft.batches, [])
+
+        self.redirector.flush()
+        self.assertEqual(len(self.nft.batches), 1)
+        self.assertEqual(len(self.nft.list_elements('ip_conn2mark')), 100)
+        self.assertEqual(self.nft.list_elements('ip6_conn2mark'), {('2001:db8::1', '1000', '2001:db8::2', '80')})
+
+        # Already there
+        self.redirector.do_redirect('10.0.0.1', 1000, '1.2.3.4', 80, 'add')
+        self.redirector.do_redirect('10.0.0.1', 1001, '1.2.3.4', 80, 'remove')
+        self.redirector.flush()
+        self.assertEqual(self.nft.batches[1], [
+            'add element bridge elan ip_conn2mark { 10.0.0.1 . 1001 . 1.2.3.4 . 80 }',
+            'delete element bridge elan ip_conn2mark { 10.0.0.1 . 1001 . 1.2.3.4 . 80 }',
+        ])
+
+    def test_added_and_removed_before_flush(self):
+        self.redirector.do_redirect('10.0.0.1', 1000, '1.2.3.4', 80, 'add')
+        self.redirector.do_redirect('10.0.0.1', 1000, '1.2.3.4', 80, 'remove')
+        self.redirector.flush()
+        self.assertEqual(self.nft.batches, [])
+
+    def test_flush_deadline(self):
+        with mock.patch('time.monotonic', return_value=100):
+            self.redirector.do_redirect('10.0.0.1', 1000, '1.2.3.4', 80, 'add')
+            self.redirector.tick()
+        self.assertEqual(self.nft.batches, [])
+        self.assertEqual(self.redirector.next_deadline(), 100 + self.redirector.flush_delay)
+
+        with mock.patch('time.monotonic', return_value=101):
+            self.redirector.tick()
+        self.assertEqual(len(self.nft.batches), 1)
+        self.assertEqual(self.redirector.next_deadline(), 100 + redirector.Redirector.REDIRECTION_EXPIRY)
+
+    def test_expiry(self):
+        with mock.patch('time.monotonic', return_value=100):
+            self.redirector.do_redirect('10.0.0.1', 1000, '1.2.3.4', 80, 'add')
+            self.redirector.do_redirect('10.0.0.1', 1001, '1.2.3.4', 80, 'add')
+            self.redirector.flush()
+        with mock.patch('time.monotonic', return_value=130):
+            self.redirector.do_redirect('10.0.0.1', 1000, '1.2.3.4', 80, 'add')  # seen again
+
+        with mock.patch('time.monotonic', return_value=165):
+            self.redirector.do_cleanup()
+            self.redirector.flush()
+        self.assertEqual(self.nft.list_elements('ip_conn2mark'), {('10.0.0.1', '1000', '1.2.3.4', '80')})
+        self.assertEqual(self.redirector.live_redirections, {('10.0.0.1', 1000, '1.2.3.4', 80): 190})
+
+    @mock.patch('redirector.ExceptionEvent')
+    def test_flush_failure(self, ExceptionEvent):
+        self.redirector.nft = nft = FailingNft()
+        self.redirector.do_redirect('10.0.0.1', 1000, '1.2.3.4', 80, 'add')
+        self.redirector.flush()
+        self.assertTrue(ExceptionEvent.called)
+        self.assertEqual(self.redirector.live_redirections, {})
+
+        # SYN retry queues it again
+        nft.bad = []
+        self.redirector.do_redirect('10.0.0.1', 1000, '1.2.3.4', 80, 'add')
+        self.redirector.flush()
+        self.assertEqual(nft.list_elements('ip_conn2mark'), {('10.0.0.1', '1000', '1.2.3.4', '80')})
+
+    @mock.patch('redirector.ExceptionEvent')
+    def test_flush_failure_of_one_element(self, ExceptionEvent):
+        self.redirector.nft = nft = FailingNft(bad=[' 1001 '])
+        for port in (1000, 1001, 1002):
+            self.redirector.do_redirect('10.0.0.1', port, '1.2.3.4', 80, 'add')
+        self.redirector.flush()
+
+        # others applied anyway
+        self.assertEqual(nft.list_elements('ip_conn2mark'), {('10.0.0.1', '1000', '1.2.3.4', '80'), ('10.0.0.1', '1002', '1.2.3.4', '80')})
+        self.assertEqual(set(self.redirector.live_redirections), {('10.0.0.1', 1000, '1.2.3.4', 80), ('10.0.0.1', 1002, '1.2.3.4', 80)})
+        ExceptionEvent.return_value.add_data.return_value.add_data.assert_called_with('failed', 1)
@@ -1,4 +1,5 @@
 from unittest import mock
+import asyncio
 import unittest
 
 from elan import session
@@ -6,7 +7,7 @@ from elan import session
 
 def clear_redis_session_info():
     paths = [
-        session.LAST_SEEN_PATH, session.SESSION_IDS_PATH, session.MAC_PORT_PATH, session.MAC_LAST_PORT_PATH,
+        session.LAST_SEEN_PATH, session.LAST_SEEN_MIGRATED_PATH, session.SESSION_IDS_PATH, session.MAC_PORT_PATH, session.MAC_LAST_PORT_PATH,
         *session.synapse.keys(session.MAC_VLANS_PATH.format(mac='*', vlan='*', ip='*')),
         *session.synapse.keys(session.MAC_VLAN_IPS_PATH.format(mac='*', vlan='*')),
         *session.synapse.keys(session.MAC_AUTH_SESSION_PATH.format(mac='*'))
@@ -157,6 +158,36 @@ class SessionTest(unittest.TestCase):
         self.assertEqual(notify_MAC_port.call_count, 1)
         self.assertEqual(notify_end_MAC_session.call_count, 2, 'No session end on same port')
 
+    @mock.patch('elan.session.notify_end_MAC_session', wraps=session.notify_end_MAC_session)
+    @mock.patch('elan.session.notify_new_VLAN_session', wraps=session.notify_new_VLAN_session)
+    @mock.patch('elan.session.notify_new_MAC_session', wraps=session.notify_new_MAC_session)
+    def test_seen_async(self, notify_new_MAC_session, notify_new_VLAN_session, notify_end_MAC_session):
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(
+                    loop.run_until_complete(session.seen_async(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1', port={'local_id': 1, 'interface': 'i1'})),
+                    (True, True, False)
+            )
+            self.assertEqual(notify_new_VLAN_session.call_count, 1)
+            self.assertTrue(session.is_online(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1'))
+            self.assertEqual(session.mac_port('aa:bb:cc:dd:ee:01'), {'local_id': 1, 'interface': 'i1'})
+
+            self.assertEqual(session.seen(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1'), (False, False, False))
+            self.assertEqual(loop.run_until_complete(session.seen_async(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1')), (False, False, False))
+
+            # change of port ends session
+            self.assertEqual(
+                    loop.run_until_complete(session.seen_async(mac='aa:bb:cc:dd:ee:01', port={'local_id': 1, 'interface': 'i2'})),
+                    (True, False, False)
+            )
+            self.assertEqual(notify_end_MAC_session.call_count, 1)
+            self.assertEqual(notify_new_MAC_session.call_count, 1)
+            self.assertEqual(session.mac_port('aa:bb:cc:dd:ee:01'), {'local_id': 1, 'interface': 'i2'})
+        finally:
+            session.async_synapse.close()
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+
     @mock.patch('elan.session.notify_end_MAC_session', wraps=session.notify_end_MAC_session)
     @mock.patch('elan.session.notify_end_VLAN_session', wraps=session.notify_end_VLAN_session)
     @mock.patch('elan.session.notify_end_IP_session', wraps=session.notify_end_IP_session)
@@ -186,6 +217,35 @@ class SessionTest(unittest.TestCase):
         self.assertFalse(session.is_online('aa:bb:cc:dd:ee:03', vlan='eth0.3', ip='1.2.3.3'))
         self.assertEqual(notify_end_IP_session.call_count, 1)
 
+    @mock.patch('elan.session.notify_end_MAC_session', wraps=session.notify_end_MAC_session)
+    @mock.patch('elan.session.notify_end_VLAN_session', wraps=session.notify_end_VLAN_session)
+    def test_end_async(self, notify_end_VLAN_session, notify_end_MAC_session):
+        port = {'local_id': 1, 'interface': 'i1'}
+        session.seen(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1', ip='1.2.3.1', port=port)
+        session.seen(mac='aa:bb:cc:dd:ee:02', vlan='eth0.2', ip='1.2.3.2')
+        session.add_authentication_session('aa:bb:cc:dd:ee:01', source='test')
+
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(loop.run_until_complete(session.port_macs_async(port)), {'aa:bb:cc:dd:ee:01'})
+
+            loop.run_until_complete(session.end_async(mac='aa:bb:cc:dd:ee:02', vlan='eth0.2'))
+            self.assertTrue(session.is_online('aa:bb:cc:dd:ee:02'))
+            self.assertFalse(session.is_online('aa:bb:cc:dd:ee:02', vlan='eth0.2', ip='1.2.3.2'))
+            self.assertEqual(notify_end_VLAN_session.call_count, 1)
+
+            loop.run_until_complete(session.end_async(mac='aa:bb:cc:dd:ee:01'))
+            self.assertFalse(session.is_online('aa:bb:cc:dd:ee:01'))
+            self.assertFalse(session.is_online('aa:bb:cc:dd:ee:01', vlan='eth0.1', ip='1.2.3.1'))
+            self.assertEqual(notify_end_MAC_session.call_count, 1)
+            self.assertIsNone(session.mac_port('aa:bb:cc:dd:ee:01'))
+            self.assertEqual(loop.run_until_complete(session.port_macs_async(port)), set())
+            self.assertEqual(session.get_authentication_sessions('aa:bb:cc:dd:ee:01'), [])
+        finally:
+            session.async_synapse.close()
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+
     def test_authentication_sessions_till_disconnect(self):
         mac = 'aa:bb:cc:dd:ee:01'
         session.seen(mac=mac, vlan='eth0.1', ip='1.2.3.1')
@@ -246,3 +306,142 @@ class SessionInternalsTest(unittest.TestCase):
         session.seen(mac='aa:bb:cc:dd:ee:03')
 
         self.assertEqual(session.notify_current_sessions(), 5)
+
+    def test_mark_seen(self):
+        mac_added, vlan_added, ip_added, ids = session.mark_seen(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1', ip='10.0.0.1', time=100)
+
+        self.assertEqual((mac_added, vlan_added, ip_added), (True, True, True))
+        local_id = ids[0]
+        self.assertIsInstance(local_id, int)
+        self.assertEqual(ids, (local_id, local_id, local_id))
+
+        self.assertEqual(session.mark_seen(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1', ip='10.0.0.1'), (False, False, False, ids))
+
+        mac_added, vlan_added, ip_added, ids = session.mark_seen(mac='aa:bb:cc:dd:ee:01', vlan='eth0.2')
+        self.assertEqual((mac_added, vlan_added, ip_added), (False, True, False))
+        self.assertEqual(ids[0], local_id)
+        self.assertGreater(ids[1], local_id)
+        self.assertIsNone(ids[2])
+
+        self.assertTrue(session.mac_has_ip_on_vlan('aa:bb:cc:dd:ee:01', '10.0.0.1', 'eth0.1'))
+        self.assertEqual(session.synapse.smembers(session.MAC_VLANS_PATH.format(mac='aa:bb:cc:dd:ee:01')), {'eth0.1', 'eth0.2'})
+        self.assertEqual(session.get_current_session_ids()[('aa:bb:cc:dd:ee:01', 'eth0.2', None)], ids[1])
+
+    @mock.patch('elan.session.notify_MAC_port', wraps=session.notify_MAC_port)
+    @mock.patch('elan.session.notify_new_VLAN_session', wraps=session.notify_new_VLAN_session)
+    @mock.patch('elan.session.notify_new_MAC_session', wraps=session.notify_new_MAC_session)
+    def test_seen_many(self, notify_new_MAC_session, notify_new_VLAN_session, notify_MAC_port):
+        session.seen(mac='aa:bb:cc:dd:ee:03', port={'local_id': 1, 'interface': 'i1'})
+        notify_new_MAC_session.reset_mock()
+
+        response = session.seen_many([
+            ('aa:bb:cc:dd:ee:01', None, {'local_id': 1, 'interface': 'i1'}, None, None),
+            ('aa:bb:cc:dd:ee:02', 'eth0.1', None, None, 100),
+            ('aa:bb:cc:dd:ee:02', 'eth0.1', None, None, 101),
+            ('aa:bb:cc:dd:ee:03', None, {'local_id': 1, 'interface': 'i2'}, None, None),
+        ])
+
+        self.assertEqual(response, [(True, False, False), (True, True, False), (False, False, False), (True, False, False)])  # port change ends session
+        self.assertEqual(notify_new_MAC_session.call_count, 2)
+        self.assertEqual(notify_new_VLAN_session.call_count, 1)
+        self.assertEqual(notify_MAC_port.call_count, 0)
+        self.assertEqual(session.mac_port('aa:bb:cc:dd:ee:01'), {'local_id': 1, 'interface': 'i1'})
+        self.assertEqual(session.mac_port('aa:bb:cc:dd:ee:03'), {'local_id': 1, 'interface': 'i2'})
+        self.assertEqual([session.is_online(mac) for mac in ('aa:bb:cc:dd:ee:01', 'aa:bb:cc:dd:ee:02', 'aa:bb:cc:dd:ee:04')], [True, True, False])
+
+        session_ids = session.get_current_session_ids()
+        self.assertEqual(len({session_ids[('aa:bb:cc:dd:ee:01', None, None)], session_ids[('aa:bb:cc:dd:ee:02', None, None)]}), 2)
+        self.assertEqual(session.seen_many([]), [])
+
+    def test_last_seen_member(self):
+        for mac, vlan, ip in (('aa:bb:cc:dd:ee:01', None, None), ('aa:bb:cc:dd:ee:01', 'eth0.1', None), ('aa:bb:cc:dd:ee:01', 'eth0.1', 'fe80::1')):
+            self.assertEqual(session.parse_last_seen_member(session.last_seen_member(mac, vlan, ip)), (mac, vlan, ip))
+        self.assertEqual(session.last_seen_member('aa:bb:cc:dd:ee:01', 'eth0.1', '10.0.0.1'), 'aa:bb:cc:dd:ee:01|eth0.1|10.0.0.1')
+        self.assertEqual(session.last_seen_member('aa:bb:cc:dd:ee:01', None, '10.0.0.1'), 'aa:bb:cc:dd:ee:01')
+
+    def test_migrate_last_seen(self):
+        session.synapse.zadd(session.LAST_SEEN_PATH, 100, dict(mac='aa:bb:cc:dd:ee:01'))
+        session.synapse.zadd(session.LAST_SEEN_PATH, 101, dict(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1', ip='10.0.0.1'))
+        session.synapse.zadd(session.LAST_SEEN_PATH, 102, 'aa:bb:cc:dd:ee:02')
+
+        self.assertEqual(session.migrate_last_seen(), 2)
+
+        self.assertEqual(
+                session.synapse.zrange(session.LAST_SEEN_PATH, 0, -1, withscores=True),
+                [('aa:bb:cc:dd:ee:01', 100), ('aa:bb:cc:dd:ee:01|eth0.1|10.0.0.1', 101), ('aa:bb:cc:dd:ee:02', 102)]
+        )
+        self.assertEqual(session.migrate_last_seen(), 0)
+
+    def test_seen_after_former_format(self):
+        session.synapse.zadd(session.LAST_SEEN_PATH, 100, dict(mac='aa:bb:cc:dd:ee:01'))
+        session.synapse.zadd(session.LAST_SEEN_PATH, 100, dict(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1'))
+
+        with mock.patch('elan.session._last_seen_migrated', False):
+            self.assertEqual(session.seen(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1', time=110), (False, False, False))
+
+        self.assertEqual(
+                session.synapse.zrange(session.LAST_SEEN_PATH, 0, -1, withscores=True),
+                [('aa:bb:cc:dd:ee:01', 110), ('aa:bb:cc:dd:ee:01|eth0.1', 110)]
+        )
+
+    def test_migration_done_once(self):
+        with mock.patch('elan.session._last_seen_migrated', False):
+            session.ensure_last_seen_migrated()
+        self.assertTrue(session.synapse.exists(session.LAST_SEEN_MIGRATED_PATH))
+
+        # other processes do not scan last seen members again
+        with mock.patch('elan.session._last_seen_migrated', False), mock.patch('elan.session.migrate_last_seen') as migrate_last_seen:
+            session.ensure_last_seen_migrated()
+        migrate_last_seen.assert_not_called()
+
+
+class LastSeenAggregatorTest(unittest.TestCase):
+
+    def setUp(self):
+        clear_redis_session_info()
+
+    def test_known_sessions_buffered(self):
+        aggregator = session.LastSeenAggregator()
+
+        self.assertEqual(aggregator.seen(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1', ip='10.0.0.1', time=100), (True, True, True))
+        with mock.patch('elan.session.seen') as seen:
+            self.assertEqual(aggregator.seen(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1', ip='10.0.0.1', time=110), (False, False, False))
+            self.assertEqual(aggregator.seen(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1', ip='10.0.0.1', time=105), (False, False, False))
+            self.assertEqual(seen.call_count, 0)
+
+        self.assertEqual(session.synapse.zscore(session.LAST_SEEN_PATH, session.last_seen_member('aa:bb:cc:dd:ee:01', 'eth0.1', '10.0.0.1')), 100)
+
+        self.assertEqual(aggregator.flush(), 1)
+
+        for member in (('aa:bb:cc:dd:ee:01',), ('aa:bb:cc:dd:ee:01', 'eth0.1'), ('aa:bb:cc:dd:ee:01', 'eth0.1', '10.0.0.1')):
+            self.assertEqual(session.synapse.zscore(session.LAST_SEEN_PATH, session.last_seen_member(*member)), 110)
+        self.assertEqual(aggregator.flush(), 0)
+
+    def test_new_sessions_not_buffered(self):
+        aggregator = session.LastSeenAggregator()
+
+        aggregator.seen(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1', time=100)
+        self.assertEqual(aggregator.seen(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1', ip='10.0.0.1', time=101), (False, False, True))
+        self.assertEqual(aggregator.seen(mac='aa:bb:cc:dd:ee:01', vlan='eth0.2', time=102), (False, True, False))
+        self.assertTrue(session.is_online(mac='aa:bb:cc:dd:ee:01', vlan='eth0.2'))
+
+    def test_ended_session_replayed(self):
+        on_added = mock.Mock()
+        aggregator = session.LastSeenAggregator(on_added=on_added)
+
+        aggregator.seen(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1', ip='10.0.0.1', time=100)
+        aggregator.seen(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1', ip='10.0.0.1', time=110)
+        session.end(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1')
+
+        aggregator.flush()
+
+        on_added.assert_called_once_with('aa:bb:cc:dd:ee:01', 'eth0.1', '10.0.0.1', False, True, True)
+        self.assertEqual(session.synapse.zscore(session.LAST_SEEN_PATH, session.last_seen_member('aa:bb:cc:dd:ee:01', 'eth0.1', '10.0.0.1')), 110)
+
+    def test_forget(self):
+        aggregator = session.LastSeenAggregator(forget_after=0)
+
+        aggregator.seen(mac='aa:bb:cc:dd:ee:01', time=100)
+        aggregator.flush()
+
+        self.assertEqual(aggregator.known, {})
@@ -0,0 +1,143 @@
+from unittest import mock
+import socket
+import sys
+import unittest
+
+from elan import session
+
+sys.path.insert(0, "bin")
+import session_trackerd
+
+
+class CheckSessions(unittest.TestCase):
+
+    def setUp(self):
+        session.synapse.delete(session.LAST_SEEN_PATH)
+
+    @mock.patch('session_trackerd.Prober.probe_many')
+    @mock.patch('elan.session.end')
+    def test_check_sessions(self, end, probe_many):
+        expired = 1000  # long ago
+        for member in (
+                ('aa:bb:cc:dd:ee:01',), ('aa:bb:cc:dd:ee:01', 'eth0.1'), ('aa:bb:cc:dd:ee:01', 'eth0.1', '10.0.0.1'),
+                ('aa:bb:cc:dd:ee:02', 'eth0.1'), ('aa:bb:cc:dd:ee:02', 'eth0.1', '10.0.0.2'),
+                ('aa:bb:cc:dd:ee:03', 'eth0.1', '10.0.0.3'),
+        ):
+            session.synapse.zadd(session.LAST_SEEN_PATH, expired, session.last_seen_member(*member))
+
+        session_trackerd.SessionTracker().check_sessions()
+
+        # Only highest expired level is ended, lower levels are ended with it
+        self.assertCountEqual(end.call_args_list, [
+            mock.call(mac='aa:bb:cc:dd:ee:01', time=expired),
+            mock.call(mac='aa:bb:cc:dd:ee:02', vlan='eth0.1', time=expired),
+            mock.call(mac='aa:bb:cc:dd:ee:03', vlan='eth0.1', ip='10.0.0.3', time=expired),
+        ])
+        # No need to ping expired objects
+        probe_many.assert_not_called()
+
+    @mock.patch('session_trackerd.Prober.probe_many')
+    @mock.patch('elan.session.end')
+    def test_deadlines(self, end, probe_many):
+        now = 100000
+        session.synapse.zadd(session.LAST_SEEN_PATH, now - 250, session.last_seen_member('aa:bb:cc:dd:ee:01'))
+        session.synapse.zadd(session.LAST_SEEN_PATH, now - 250, session.last_seen_member('aa:bb:cc:dd:ee:01', 'eth0.1', '10.0.0.1'))
+        session.synapse.zadd(session.LAST_SEEN_PATH, now - 100, session.last_seen_member('aa:bb:cc:dd:ee:02', 'eth0.1', '10.0.0.2'))
+
+        tracker = session_trackerd.SessionTracker()
+
+        # IPs idle for PING_OBJECTS_AFTER are pinged, then every PING_EVERY
+        self.assertEqual(tracker.check_sessions(now), now + session_trackerd.PING_EVERY)
+        probe_many.assert_called_once_with([('aa:bb:cc:dd:ee:01', 'eth0.1', '10.0.0.1')])
+
+        probe_many.reset_mock()
+        self.assertEqual(tracker.check_sessions(now + 5), now + session_trackerd.PING_EVERY)
+        probe_many.assert_not_called()
+
+        # IP answered
+        session.synapse.zadd(session.LAST_SEEN_PATH, now + 8, session.last_seen_member('aa:bb:cc:dd:ee:01', 'eth0.1', '10.0.0.1'))
+        self.assertEqual(tracker.check_sessions(now + 10), now + 50)  # MAC expiry
+        probe_many.assert_not_called()
+
+        self.assertEqual(tracker.check_sessions(now + 50), now + 140)  # next object crossing PING_OBJECTS_AFTER
+        end.assert_called_once_with(mac='aa:bb:cc:dd:ee:01', time=now - 250)
+        probe_many.assert_not_called()
+
+        self.assertEqual(tracker.check_sessions(now + 140), now + 150)
+        probe_many.assert_called_once_with([('aa:bb:cc:dd:ee:02', 'eth0.1', '10.0.0.2')])
+
+        # Ended sessions are forgotten
+        session.synapse.zrem(session.LAST_SEEN_PATH, session.last_seen_member('aa:bb:cc:dd:ee:02', 'eth0.1', '10.0.0.2'))
+        self.assertEqual(tracker.check_sessions(now + 150), now + 248)
+        self.assertEqual(tracker.scheduled, {})
+
+
+    @mock.patch('session_trackerd.Prober.probe_many')
+    @mock.patch('elan.session.end')
+    def test_rescan_behind_cursor(self, end, probe_many):
+        now = 100000
+        tracker = session_trackerd.SessionTracker()
+        self.assertEqual(tracker.check_sessions(now), now + session_trackerd.PING_OBJECTS_AFTER)
+
+        # written with a time already behind the cursor (late trap time, delayed flush...)
+        session.synapse.zadd(session.LAST_SEEN_PATH, now - 250, session.last_seen_member('aa:bb:cc:dd:ee:01', 'eth0.1', '10.0.0.1'))
+        self.assertEqual(tracker.check_sessions(now + 10), now + 10 + session_trackerd.PING_OBJECTS_AFTER)
+        self.assertEqual(tracker.check_sessions(now + 10 + session_trackerd.PING_OBJECTS_AFTER), now + session_trackerd.RESCAN_EVERY)
+        probe_many.assert_not_called()
+
+        end.assert_not_called()
+
+        tracker.check_sessions(now + session_trackerd.RESCAN_EVERY)
+        end.assert_called_once_with(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1', ip='10.0.0.1', time=now - 250)
+
+    @mock.patch('session_trackerd.Prober.probe_many')
+    @mock.patch('elan.session.end')
+    def test_rescan_when_clock_goes_backwards(self, end, probe_many):
+        now = 100000
+        tracker = session_trackerd.SessionTracker()
+        tracker.check_sessions(now)
+
+        session.synapse.zadd(session.LAST_SEEN_PATH, now - 1000, session.last_seen_member('aa:bb:cc:dd:ee:01', 'eth0.1', '10.0.0.1'))
+        tracker.check_sessions(now - 60)
+        end.assert_called_once_with(mac='aa:bb:cc:dd:ee:01', vlan='eth0.1', ip='10.0.0.1', time=now - 1000)
+
+class ProberTest(unittest.TestCase):
+
+    def setUp(self):
+        self.prober = session_trackerd.Prober(burst=2, rate=100)
+        self.prober.src_mac = bytes.fromhex('020000000001')
+        self.prober.src_ipv4 = socket.inet_pton(socket.AF_INET, '10.0.0.254')
+        self.prober.src_ipv6 = socket.inet_pton(socket.AF_INET6, '2001:db8::1')
+
+    def test_arp_frame(self):
+        if_name, frame = self.prober.frame('aa:bb:cc:dd:ee:01', 'eth0.0', '10.0.0.5')
+
+        self.assertEqual(if_name, 'eth0')
+        self.assertEqual(
+                frame.hex(),
+                'aabbccddee01' '020000000001' '0806'  # ethernet
+                '0001' '0800' '06' '04' '0001' '020000000001' '0a0000fe' 'aabbccddee01' '0a000005'  # ARP who-has
+        )
+
+    def test_ns_frame_with_vlan(self):
+        if_name, frame = self.prober.frame('aa:bb:cc:dd:ee:01', 'eth0.3', '2001:db8::5')
+
+        self.assertEqual(if_name, 'eth0')
+        self.assertEqual(
+                frame.hex(),
+                'aabbccddee01' '020000000001' '8100' '0003' '86dd'  # ethernet with 802.1Q tag
+                '60000000' '0018' '3a' 'ff' '20010db8000000000000000000000001' '20010db8000000000000000000000005'  # IPv6, hop limit 255
+                '87' '00' 'ef76' '00000000' '20010db8000000000000000000000005'  # Neighbor Solicitation
+        )
+
+    def test_probe_many_by_bursts(self):
+        targets = [('aa:bb:cc:dd:ee:01', 'eth0.1', '10.0.0.{}'.format(i)) for i in range(5)]
+        with mock.patch.object(self.prober, 'refresh'), \
+             mock.patch.object(self.prober, 'send') as send, \
+             mock.patch('time.monotonic', return_value=0), \
+             mock.patch('time.sleep') as sleep:
+            self.assertEqual(self.prober.probe_many(targets), 5)
+
+        self.assertEqual(send.call_count, 5)
+        # 3 bursts of 2 frames at 100 frames/s: 2nd burst at 20ms, 3rd at 40ms
+        self.assertEqual(sleep.call_args_list, [mock.call(0.02), mock.call(0.04)])
@@ -0,0 +1,159 @@
+from unittest import mock
+import asyncio
+import unittest
+
+import serialized_redis
+
+from elan.async_synapse import AsyncSynapse
+from elan.neuron import Synapse
+
+KEYS = ['test:async:string', 'test:async:hash', 'test:async:set', 'test:async:zset', 'test:async:counter', 'test:async:list']
+
+
+class AsyncSynapseTest(unittest.TestCase):
+    'These tests require Redis'
+
+    def setUp(self):
+        self.synapse = Synapse()
+        self.synapse.delete(*KEYS)
+        self.async_synapse = AsyncSynapse()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.async_synapse.close()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+        self.synapse.delete(*KEYS)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_same_serialization_as_synapse(self):
+        value = {'b': [1, 2], 'a': 'x'}
+        self.run_async(self.async_synapse.set('test:async:string', value))
+        self.run_async(self.async_synapse.hset('test:async:hash', 'field', value))
+        self.run_async(self.async_synapse.sadd('test:async:set', value))
+        self.run_async(self.async_synapse.zadd('test:async:zset', 10, value))
+
+        self.assertEqual(self.synapse.get('test:async:string'), value)
+        self.assertEqual(self.synapse.hget('test:async:hash', 'field'), value)
+        self.assertEqual(self.synapse.smembers_as_list('test:async:set'), [value])
+        self.assertEqual(self.synapse.zscore('test:async:zset', value), 10)
+
+        self.synapse.hset('test:async:hash', 'other', [1])
+        self.synapse.sadd('test:async:set', 'member')
+
+        self.assertEqual(self.run_async(self.async_synapse.get('test:async:string')), value)
+        self.assertEqual(self.run_async(self.async_synapse.hgetall('test:async:hash')), {'field': value, 'other': [1]})
+        self.assertEqual(self.run_async(self.async_synapse.hmget('test:async:hash', ['other', 'unknown'])), [[1], None])
+        self.assertCountEqual(self.run_async(self.async_synapse.smembers_as_list('test:async:set')), [value, 'member'])
+        self.assertEqual(self.run_async(self.async_synapse.zmembers('test:async:zset')), [value])
+        self.assertEqual(self.run_async(self.async_synapse.zscore('test:async:zset', value)), 10.0)
+        self.assertIsNone(self.run_async(self.async_synapse.get('test:async:unknown')))
+
+    def test_get_unique_id(self):
+        self.assertEqual(self.run_async(self.async_synapse.get_unique_id('test:async:counter')), 1)
+        self.assertEqual(self.synapse.get_unique_id('test:async:counter'), 2)
+        self.assertEqual(self.run_async(self.async_synapse.get_unique_id('test:async:counter')), 3)
+
+    def test_concurrent_commands(self):
+
+        async def commands():
+            return await asyncio.gather(*[self.async_synapse.incr('test:async:counter') for _ in range(500)])
+
+        self.assertEqual(sorted(self.run_async(commands())), list(range(1, 501)))
+
+    def test_pipeline(self):
+        with self.async_synapse.pipeline() as pipe:
+            pipe.hset('test:async:hash', 'field', 'value')
+            pipe.hget('test:async:hash', 'field')
+            pipe.sadd('test:async:set', 'a', 'b')
+            results = self.run_async(pipe.execute())
+
+        self.assertEqual(results, [1, 'value', 2])
+
+        with self.async_synapse.pipeline() as pipe:
+            pipe.set('test:async:string', 'value')
+            pipe.hget('test:async:string', 'field')  # wrong type
+            with self.assertRaises(serialized_redis.redis.ResponseError):
+                self.run_async(pipe.execute())
+
+        self.assertEqual(self.synapse.get('test:async:string'), 'value')
+
+    def test_error(self):
+        self.synapse.set('test:async:string', 'value')
+
+        with self.assertRaises(serialized_redis.redis.ResponseError):
+            self.run_async(self.async_synapse.hget('test:async:string', 'field'))
+
+        # connection still usable
+        self.assertEqual(self.run_async(self.async_synapse.get('test:async:string')), 'value')
+
+    def test_new_loop(self):
+        self.run_async(self.async_synapse.set('test:async:string', 1))
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertEqual(loop.run_until_complete(self.async_synapse.get('test:async:string')), 1)
+        finally:
+            self.async_synapse.close()
+            loop.run_until_complete(asyncio.sleep(0))
+            loop.close()
+
+    def test_run_script(self):
+        script = self.synapse.register_script("return redis.call('INCRBY', KEYS[1], ARGV[1])")
+        self.synapse.script_flush()
+
+        # loaded if unknown
+        self.assertEqual(self.run_async(self.async_synapse.run_script(script, keys=['test:async:counter'], args=[2])), 2)
+        self.assertEqual(self.run_async(self.async_synapse.run_script(script, keys=['test:async:counter'], args=[3])), 5)
+
+    def test_connection_lost(self):
+        self.run_async(self.async_synapse.execute_command('CLIENT', 'SETNAME', 'test-async-synapse'))
+
+        async def kill_while_waiting():
+            waiting = asyncio.ensure_future(self.async_synapse.execute_command('BLPOP', 'test:async:list', 5))
+            await asyncio.sleep(0.2)
+            for client in self.synapse.client_list():
+                if client['name'] == 'test-async-synapse':
+                    self.synapse.client_kill(client['addr'])
+            return await asyncio.wait_for(waiting, 2)
+
+        with self.assertRaises(serialized_redis.redis.ConnectionError):
+            self.run_async(kill_while_waiting())
+
+        # reconnected on next command
+        self.run_async(self.async_synapse.set('test:async:string', 1))
+        self.assertEqual(self.run_async(self.async_synapse.get('test:async:string')), 1)
+
+    def test_cancelled_command(self):
+
+        async def commands():
+            await self.async_synapse.set('test:async:string', 'value')
+            blocked = asyncio.ensure_future(self.async_synapse.execute_command('BLPOP', 'test:async:list', 1))
+            await asyncio.sleep(0)  # sent
+            # pipelined after BLPOP: replied after it
+            following = [asyncio.ensure_future(self.async_synapse.get('test:async:string')) for _ in range(3)]
+            await asyncio.sleep(0.2)
+            blocked.cancel()
+            return await asyncio.gather(*following)
+
+        # reply of cancelled command is not given to the next ones
+        self.assertEqual(self.run_async(commands()), ['value'] * 3)
+        self.assertEqual(self.run_async(self.async_synapse.incr('test:async:counter')), 1)
+
+    @mock.patch('asyncio.open_connection', wraps=asyncio.open_connection)
+    def test_cancelled_while_connecting(self, open_connection):
+
+        async def commands():
+            first = asyncio.ensure_future(self.async_synapse.incr('test:async:counter'))
+            second = asyncio.ensure_future(self.async_synapse.incr('test:async:counter'))
+            await asyncio.sleep(0)
+            first.cancel()
+            await asyncio.sleep(0)
+            # still connecting: same connection is used
+            third = asyncio.ensure_future(self.async_synapse.incr('test:async:counter'))
+            return sorted(await asyncio.gather(second, third))
+
+        self.assertEqual(self.run_async(commands()), [1, 2])
+        self.assertEqual(self.run_async(self.async_synapse.incr('test:async:counter')), 3)
+        self.assertEqual(open_connection.call_count, 1)